@@ -0,0 +1,29 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+from . import crud
+from .database import SessionLocal
+
+# Loans returned more than LIBRARY_ARCHIVE_AFTER_DAYS ago move from loans to
+# loans_archive, so the live table (and its indexes) only holds what checkout,
+# returns and the overdue scan actually touch. Each batch is its own short
+# write transaction and the pause between batches lets queued writers in, so
+# archiving a long history never holds the write lock for long.
+ARCHIVE_AFTER_DAYS = int(os.environ.get("LIBRARY_ARCHIVE_AFTER_DAYS", "365"))
+ARCHIVE_BATCH = int(os.environ.get("LIBRARY_ARCHIVE_BATCH", "1000"))
+ARCHIVE_PAUSE = float(os.environ.get("LIBRARY_ARCHIVE_PAUSE_MS", "10")) / 1000
+
+def archive_loans(days: int = ARCHIVE_AFTER_DAYS, batch_size: int = ARCHIVE_BATCH, pause: float = ARCHIVE_PAUSE):
+    before = datetime.now() - timedelta(days=days)
+    archived = 0
+    db = SessionLocal()
+    try:
+        while True:
+            moved = crud.archive_loan_batch(db, before, batch_size=batch_size)
+            archived += moved
+            if moved < batch_size:
+                return archived
+            time.sleep(pause)
+    finally:
+        db.close()
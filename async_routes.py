@@ -0,0 +1,321 @@
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.routing import APIRoute
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud, instrumentation, models, schemas, serializers, writer
+from .cache import catalog_cache
+from .database import AsyncReadSessionLocal, AsyncSessionLocal
+from .main import BOOK_TABLES, CATEGORY_TABLES, apply_write_async, cache_response, cached, check_cursor, hash_password, make_etag, not_modified, read_shape, set_next_cursor, shape_key
+
+# Async versions of the routes in main, mounted in their place when
+# LIBRARY_DB_MODE=async. Routes without an async version keep running on
+# the threadpool against the sync engine. The database work is the same crud
+# call main makes, run on the aiosqlite connection through run_sync, so both
+# modes share their queries, rules and cache invalidation.
+router = APIRouter(route_class=instrumentation.TimedRoute if instrumentation.ENABLED else APIRoute)
+
+# Dependency
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+async def get_read_db():
+    async with AsyncReadSessionLocal() as db:
+        yield db
+
+async def run_and_validate(db: AsyncSession, schema, function, *args, **kwargs):
+    # For crud writes whose row still has relationships to lazy load, which
+    # only works inside run_sync
+    def run(session):
+        return schema.from_orm(function(session, *args, **kwargs))
+    return await db.run_sync(run)
+
+@router.post("/users/", response_model=schemas.User, status_code=201, tags=["Users"])
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
+    password_hash = await hash_password(user.password)
+    if writer.ENABLED:
+        try:
+            return await apply_write_async(writer.create_user, user, password_hash)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    db_user = await db.run_sync(crud.get_user_by_email, email=user.email)
+    if db_user:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    return await run_and_validate(db, schemas.User, crud.create_user, user=user, password_hash=password_hash)
+
+@router.get("/users/", response_model=list[schemas.User], status_code=200, tags=["Users"])
+async def read_users(skip: int = 0, limit: int = 100, cursor: str = None, fields: str = None, expand: str = None, db: AsyncSession = Depends(get_read_db)):
+    check_cursor(models.User, cursor)
+    shape = read_shape(schemas.User, fields, expand)
+    users = await db.run_sync(crud.get_users, skip=skip, limit=limit, cursor=cursor, shape=shape)
+    response = serializers.render(schemas.User, users, shape=shape)
+    set_next_cursor(response, models.User, users, limit)
+    return response
+
+@router.patch("/users/{user_id}", response_model=schemas.User, status_code=200, tags=["Users"])
+async def update_user(user_id: int, user: schemas.UserUpdate, db: AsyncSession = Depends(get_db)):
+    db_user = await db.run_sync(crud.get_user_by_id, user_id=user_id)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    try:
+        return await run_and_validate(db, schemas.User, crud.update_user, user_id=user_id, user=user)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.delete("/users/{user_id}", status_code=200, tags=["Users"])
+async def delete_user(user_id: int, db: AsyncSession = Depends(get_db)):
+    db_user = await db.run_sync(crud.get_user_by_id, user_id=user_id)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    await db.run_sync(crud.delete_user, user_id=user_id)
+    return {"message": f"User {user_id} deleted"}
+
+@router.get("/users/{user_id}", response_model=schemas.User, status_code=200, tags=["Users"])
+async def read_user(user_id: int, fields: str = None, expand: str = None, db: AsyncSession = Depends(get_read_db)):
+    shape = read_shape(schemas.User, fields, expand)
+    db_user = await db.run_sync(crud.get_user_by_id, user_id=user_id, shape=shape)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return serializers.render(schemas.User, db_user, shape=shape)
+
+@router.get("/users/email/{email}", response_model=schemas.User, status_code=200, tags=["Users"])
+async def read_user_email(email: str, db: AsyncSession = Depends(get_read_db)):
+    db_user = await db.run_sync(crud.get_user_by_email, email=email)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return serializers.render(schemas.User, db_user)
+
+@router.post("/books/", status_code=201, tags=["Books"])
+async def create_book(book: schemas.BookCreate, db: AsyncSession = Depends(get_db)):
+    db_book = await db.run_sync(crud.create_book, book=book)
+    return db_book
+
+@router.delete("/books/{book_id}", status_code=200, tags=["Books"])
+async def delete_book(book_id: int, db: AsyncSession = Depends(get_db)):
+    db_book = await db.run_sync(crud.get_book_by_id, book_id=book_id)
+    if db_book is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+    await db.run_sync(crud.delete_book, book_id=book_id)
+    return {"message": f"Book {book_id} deleted"}
+
+@router.get("/books/", response_model=list[schemas.Book], status_code=200, tags=["Books"])
+async def read_books(request: Request, skip: int = 0, limit: int = 100, cursor: str = None, fields: str = None, expand: str = None, db: AsyncSession = Depends(get_read_db)):
+    check_cursor(models.Book, cursor)
+    shape = read_shape(schemas.Book, fields, expand)
+    etag = make_etag(await db.run_sync(crud.get_table_versions, BOOK_TABLES), request)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    books = await db.run_sync(crud.get_books, skip=skip, limit=limit, cursor=cursor, shape=shape)
+    response = serializers.render(schemas.Book, books, headers={"ETag": etag}, shape=shape)
+    set_next_cursor(response, models.Book, books, limit)
+    return response
+
+@router.get("/books/{book_id}", response_model=schemas.Book, status_code=200, tags=["Books"])
+async def read_book(book_id: int, fields: str = None, expand: str = None, db: AsyncSession = Depends(get_read_db)):
+    shape = read_shape(schemas.Book, fields, expand)
+    key = shape_key(f"book:{book_id}", shape)
+    response = cached(key)
+    if response is not None:
+        return response
+    generation = catalog_cache.generation(f"book:{book_id}")
+    db_book = await db.run_sync(crud.get_book_by_id, book_id=book_id, shape=shape)
+    if db_book is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+    return cache_response(key, schemas.Book, db_book, tags=[f"book:{book_id}"], shape=shape, generation=generation)
+
+@router.get("/books/category/{category_id}", response_model=list[schemas.Book], status_code=200, tags=["Books"])
+async def read_books_category(category_id: int, db: AsyncSession = Depends(get_read_db)):
+    db_books = await db.run_sync(crud.get_books_by_category, category_id=category_id)
+    if db_books is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+    return serializers.render(schemas.Book, db_books)
+
+@router.get("/books/author/{author}", response_model=list[schemas.Book], status_code=200, tags=["Books"])
+async def read_books_title(author: str, db: AsyncSession = Depends(get_read_db)):
+    db_books = await db.run_sync(crud.get_books_by_author, author=author)
+    if db_books is None:
+        raise HTTPException(status_code=404, detail="Author not found")
+    return serializers.render(schemas.Book, db_books)
+
+@router.get("/books/editorial/{editorial}", response_model=list[schemas.Book], status_code=200, tags=["Books"])
+async def read_books_editorial(editorial: str, db: AsyncSession = Depends(get_read_db)):
+    db_books = await db.run_sync(crud.get_books_by_editorial, editorial=editorial)
+    if db_books is None:
+        raise HTTPException(status_code=404, detail="Editorial not found")
+    return serializers.render(schemas.Book, db_books)
+
+@router.post("/categories/", response_model=schemas.Category, status_code=201, tags=["Categories"])
+async def create_category(category: schemas.CategoryCreate, db: AsyncSession = Depends(get_db)):
+    return await run_and_validate(db, schemas.Category, crud.create_category, category=category)
+
+@router.delete("/categories/{category_id}", status_code=200, tags=["Categories"])
+async def delete_category(category_id: int, db: AsyncSession = Depends(get_db)):
+    db_category = await db.run_sync(crud.get_category, category_id=category_id)
+    if db_category is None:
+        raise HTTPException(status_code=404, detail="Category not found")
+    await db.run_sync(crud.delete_category, category_id=category_id)
+    return {"message": "Category deleted"}
+
+@router.get("/categories/", response_model=list[schemas.Category], status_code=200, tags=["Categories"])
+async def read_categories(request: Request, skip: int = 0, limit: int = 100, cursor: str = None, fields: str = None, expand: str = None, db: AsyncSession = Depends(get_read_db)):
+    check_cursor(models.Category, cursor)
+    shape = read_shape(schemas.Category, fields, expand)
+    etag = make_etag(await db.run_sync(crud.get_table_versions, CATEGORY_TABLES), request)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    categories = await db.run_sync(crud.get_categories, skip=skip, limit=limit, cursor=cursor, shape=shape)
+    response = serializers.render(schemas.Category, categories, headers={"ETag": etag}, shape=shape)
+    set_next_cursor(response, models.Category, categories, limit)
+    return response
+
+@router.get("/categories/{category_id}", response_model=schemas.Category, status_code=200, tags=["Categories"])
+async def read_category(category_id: int, fields: str = None, expand: str = None, db: AsyncSession = Depends(get_read_db)):
+    shape = read_shape(schemas.Category, fields, expand)
+    key = shape_key(f"category:{category_id}", shape)
+    response = cached(key)
+    if response is not None:
+        return response
+    generation = catalog_cache.generation(f"category:{category_id}")
+    db_category = await db.run_sync(crud.get_category, category_id=category_id, shape=shape)
+    if db_category is None:
+        raise HTTPException(status_code=404, detail="Category not found")
+    return cache_response(key, schemas.Category, db_category, tags=[f"category:{category_id}"], shape=shape, generation=generation)
+
+@router.get("/categories/name/{name}", response_model=schemas.Category, status_code=200, tags=["Categories"])
+async def read_category_name(name: str, db: AsyncSession = Depends(get_read_db)):
+    key = f"category_name:{name}"
+    response = cached(key)
+    if response is not None:
+        return response
+    # The category's tag is only known after the query
+    generation = catalog_cache.generation()
+    db_category = await db.run_sync(crud.get_category_by_name, name=name)
+    if db_category is None:
+        raise HTTPException(status_code=404, detail="Category not found")
+    return cache_response(key, schemas.Category, db_category, tags=[f"category:{db_category.id}"], generation=generation)
+
+@router.post("/copies/", response_model=schemas.Copy, status_code=201, tags=["Copies"])
+async def create_copy(copy: schemas.CopyCreate, db: AsyncSession = Depends(get_db)):
+    if writer.ENABLED:
+        return await apply_write_async(writer.create_copy, copy)
+    db_copy = await db.run_sync(crud.create_copy, copy=copy)
+    return db_copy
+
+@router.delete("/copies/{copy_id}", status_code=200, tags=["Copies"])
+async def delete_copy(copy_id: int, db: AsyncSession = Depends(get_db)):
+    db_copy = await db.run_sync(crud.get_copy, copy_id=copy_id)
+    if db_copy is None:
+        raise HTTPException(status_code=404, detail="Copy not found")
+    await db.run_sync(crud.delete_copy, copy_id=copy_id)
+    return {"message": f"Copy {copy_id} deleted"}
+
+@router.get("/copies/", response_model=list[schemas.Copy], status_code=200, tags=["Copies"])
+async def read_copies(skip: int = 0, limit: int = 100, cursor: str = None, fields: str = None, db: AsyncSession = Depends(get_read_db)):
+    check_cursor(models.Copy, cursor)
+    shape = read_shape(schemas.Copy, fields)
+    copies = await db.run_sync(crud.get_copies, skip=skip, limit=limit, cursor=cursor, shape=shape)
+    response = serializers.render(schemas.Copy, copies, shape=shape)
+    set_next_cursor(response, models.Copy, copies, limit)
+    return response
+
+@router.get("/copies/{copy_id}", response_model=schemas.Copy, status_code=200, tags=["Copies"])
+async def read_copy(copy_id: int, db: AsyncSession = Depends(get_read_db)):
+    db_copy = await db.run_sync(crud.get_copy, copy_id=copy_id)
+    if db_copy is None:
+        raise HTTPException(status_code=404, detail="Copy not found")
+    return serializers.render(schemas.Copy, db_copy)
+
+@router.get("/copies/book/{book_id}", response_model=list[schemas.Copy], status_code=200, tags=["Copies"])
+async def read_copies_book(book_id: int, db: AsyncSession = Depends(get_read_db)):
+    key = f"copies_by_book:{book_id}"
+    response = cached(key)
+    if response is not None:
+        return response
+    generation = catalog_cache.generation(f"book:{book_id}")
+    db_copies = await db.run_sync(crud.get_copies_by_book, book_id=book_id)
+    if db_copies is None:
+        raise HTTPException(status_code=404, detail="Book not found")
+    return cache_response(key, schemas.Copy, db_copies, tags=[f"book:{book_id}"], generation=generation)
+
+@router.get("/copies/book/available/{book_id}", response_model=list[schemas.Copy], status_code=200, tags=["Copies"])
+async def read_copies_book_available(book_id: int, db: AsyncSession = Depends(get_read_db)):
+    db_copies = await db.run_sync(crud.get_copies_available_by_book, book_id=book_id)
+    if db_copies is None:
+        raise HTTPException(status_code=404, detail="No copies available")
+    return serializers.render(schemas.Copy, db_copies)
+
+@router.post("/loans/", response_model=schemas.Loan, status_code=201, tags=["Loans"])
+async def create_loan(loan: schemas.LoanCreate, db: AsyncSession = Depends(get_db)):
+    if loan.return_date <= loan.loan_date:
+        raise HTTPException(status_code=400, detail="Return date must be after loan date")
+    try:
+        if writer.ENABLED:
+            return await apply_write_async(writer.checkout_loan, loan)
+        return await db.run_sync(crud.checkout_loan, loan=loan)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.delete("/loans/{loan_id}", status_code=200, tags=["Loans"])
+async def delete_loan(loan_id: int, db: AsyncSession = Depends(get_db)):
+    if writer.ENABLED:
+        try:
+            return await apply_write_async(writer.return_loan, loan_id)
+        except LookupError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+    db_loan = await db.run_sync(crud.get_loan, loan_id=loan_id)
+    if db_loan is None:
+        raise HTTPException(status_code=404, detail="Loan not found")
+    await db.run_sync(crud.update_copy_not_available, copy_id=db_loan.copy_id)
+    await db.run_sync(crud.delete_loan, loan_id=loan_id)
+    
+    return {"message": "Loan deleted"}
+
+@router.patch("/loans/{loan_id}", response_model=schemas.Loan, status_code=200, tags=["Loans"])
+async def update_loan(loan_id: int, loan: schemas.LoanUpdate, db: AsyncSession = Depends(get_db)):
+    db_loan = await db.run_sync(crud.get_loan, loan_id=loan_id)
+    if db_loan is None:
+        raise HTTPException(status_code=404, detail="Loan not found")
+    if loan.return_date <= loan.loan_date:
+        raise HTTPException(status_code=400, detail="Return date must be after loan date")
+    return await db.run_sync(crud.update_loan, loan_id=loan_id, loan=loan)
+
+@router.get("/loans/", response_model=list[schemas.Loan], tags=["Loans"])
+async def read_loans(skip: int = 0, limit: int = 100, cursor: str = None, fields: str = None, db: AsyncSession = Depends(get_read_db)):
+    check_cursor(models.Loan, cursor)
+    shape = read_shape(schemas.Loan, fields)
+    loans = await db.run_sync(crud.get_loans, skip=skip, limit=limit, cursor=cursor, shape=shape)
+    response = serializers.render(schemas.Loan, loans, shape=shape)
+    set_next_cursor(response, models.Loan, loans, limit)
+    return response
+
+@router.get("/loans/overdue", response_model=list[schemas.Loan], tags=["Loans"])
+async def read_overdue_loans(skip: int = 0, limit: int = 100, cursor: str = None, db: AsyncSession = Depends(get_read_db)):
+    check_cursor("overdue", cursor)
+    loans = await db.run_sync(crud.get_overdue_loans, skip=skip, limit=limit, cursor=cursor)
+    response = serializers.render(schemas.Loan, loans)
+    set_next_cursor(response, "overdue", loans, limit)
+    return response
+
+@router.get("/loans/{loan_id}", response_model=schemas.Loan, tags=["Loans"])
+async def read_loan(loan_id: int, db: AsyncSession = Depends(get_read_db)):
+    db_loan = await db.run_sync(crud.get_loan, loan_id=loan_id)
+    if db_loan is None:
+        raise HTTPException(status_code=404, detail="Loan not found")
+    return serializers.render(schemas.Loan, db_loan)
+
+@router.get("/loans/user/{user_id}", response_model=list[schemas.Loan], status_code=200, tags=["Loans"])
+async def read_loans_user(user_id: int, history: bool = False, db: AsyncSession = Depends(get_read_db)):
+    db_loans = await db.run_sync(crud.get_loans_by_user, user_id=user_id, history=history)
+    if db_loans is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return serializers.render(schemas.Loan, db_loans)
+
+@router.get("/loans/copy/{copy_id}", response_model=list[schemas.Loan], status_code=200, tags=["Loans"])
+async def read_loans_copy(copy_id: int, history: bool = False, db: AsyncSession = Depends(get_read_db)):
+    db_loans = await db.run_sync(crud.get_loans_by_copy, copy_id=copy_id, history=history)
+    if db_loans is None:
+        raise HTTPException(status_code=404, detail="Copy not found")
+    return serializers.render(schemas.Loan, db_loans)
@@ -0,0 +1,96 @@
+"""Compare loan latency before and after archiving the loan history.
+
+Generates a library (see benchmarks.generate), times checkout, return and
+the per-user and per-copy loan lists against the full loans table, moves
+every loan returned more than --days ago into loans_archive with
+archive.archive_loans, and times the same operations again. Run from the
+parent directory of the project package:
+
+    python -m package.benchmarks.archive --scale large --cycles 2000
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from .db_mode import percentile
+
+
+def timed(latencies: dict, name: str, function, *args, **kwargs):
+    started = time.perf_counter()
+    result = function(*args, **kwargs)
+    latencies.setdefault(name, []).append(time.perf_counter() - started)
+    return result
+
+
+def return_loan(db, loan_id: int):
+    from .. import crud
+
+    crud.remove_loan(db, loan_id)
+    db.commit()
+
+
+def measure(cycles: int, copy_ids: list, user_ids: list):
+    from .. import crud, schemas
+    from ..database import SessionLocal
+
+    latencies = {}
+    db = SessionLocal()
+    try:
+        for copy_id, user_id in zip(copy_ids[:cycles], user_ids[:cycles]):
+            now = datetime.now()
+            loan = schemas.LoanCreate(copy_id=copy_id, user_id=user_id, loan_date=now, return_date=now + timedelta(days=8))
+            db_loan = timed(latencies, "checkout", crud.checkout_loan, db, loan)
+            timed(latencies, "return", return_loan, db, db_loan.id)
+            timed(latencies, "loans by user", crud.get_loans_by_user, db, user_id)
+            timed(latencies, "loans by copy", crud.get_loans_by_copy, db, copy_id)
+            db.expunge_all()
+    finally:
+        db.close()
+    return {name: (percentile(values, 0.50) * 1000, percentile(values, 0.99) * 1000) for name, values in latencies.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", help="reuse the library generated here instead of generating one")
+    parser.add_argument("--scale", choices=("small", "medium", "large"), default="small")
+    parser.add_argument("--cycles", type=int, default=1000, help="checkouts timed before and after archiving")
+    parser.add_argument("--days", type=int, default=365, help="archive loans returned more than this many days ago")
+    args = parser.parse_args()
+
+    # The database path is resolved when the package is first imported
+    os.chdir(args.dir or tempfile.mkdtemp())
+    from .generate import SCALES, generate
+
+    if not os.path.exists("library-project.db"):
+        started = time.perf_counter()
+        generate("library-project.db", **SCALES[args.scale])
+        print(f"generated {args.scale} library in {time.perf_counter() - started:.1f}s")
+
+    from .. import archive, models
+    from ..database import SessionLocal
+
+    db = SessionLocal()
+    copy_ids = [row.id for row in db.query(models.Copy.id).filter(models.Copy.available == True).limit(2 * args.cycles)]
+    user_ids = [row.id for row in db.query(models.User.id).filter(models.User.active == True).limit(2 * args.cycles)]
+    live = db.query(models.Loan).count()
+    db.close()
+    # Distinct copies and users on each side, so the second run is not
+    # reading pages the first one just brought into the cache
+    half = min(len(copy_ids), len(user_ids)) // 2
+    before = measure(args.cycles, copy_ids[:half], user_ids[:half])
+
+    started = time.perf_counter()
+    archived = archive.archive_loans(days=args.days)
+    elapsed = time.perf_counter() - started
+    print(f"archived {archived} of {live} loans in {elapsed:.1f}s")
+
+    after = measure(args.cycles, copy_ids[half:], user_ids[half:])
+    print(f"{'operation':>14} {'before p50':>11} {'before p99':>11} {'after p50':>10} {'after p99':>10}")
+    for name in before:
+        print(f"{name:>14} {before[name][0]:>11.2f} {before[name][1]:>11.2f} {after[name][0]:>10.2f} {after[name][1]:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Concurrent loan checkout stress test.
+
+Many threads check out random copies at once; afterwards every copy must
+have at most one active loan and every successful checkout must match a
+claimed copy. Set LIBRARY_WRITE_POOL_SIZE above 1 to also exercise SQLite's
+own locking between connections. Run from the parent directory of the
+project package:
+
+    python -m package.benchmarks.checkout --threads 16 --copies 2000
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--copies", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--attempts", type=int, default=4000)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    from .. import crud, models, schemas
+    from ..database import SessionLocal, engine
+
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(models.Category.__table__.insert(), [{"name": "bench"}])
+        conn.execute(models.Book.__table__.insert(), [{"title": "bench", "author": "bench", "editorial": "bench", "pub_year": 2000, "edition": 1, "category_id": 1}])
+        conn.execute(models.Copy.__table__.insert(), [{"book_id": 1, "available": True, "atention": False} for _ in range(args.copies)])
+        conn.execute(models.User.__table__.insert(), [{"name": "bench", "last_name": "bench", "email": f"user{i}@example.com", "phone": "5555", "active": True} for i in range(args.users)])
+
+    attempts = iter(range(args.attempts))
+    lock = threading.Lock()
+    outcomes = {"loaned": 0, "rejected": 0, "errors": 0}
+
+    def worker():
+        rng = random.Random()
+        while True:
+            with lock:
+                if next(attempts, None) is None:
+                    return
+            now = datetime.now()
+            loan = schemas.LoanCreate(copy_id=rng.randint(1, args.copies), user_id=rng.randint(1, args.users), loan_date=now, return_date=now + timedelta(days=8))
+            db = SessionLocal()
+            try:
+                crud.checkout_loan(db, loan)
+                outcome = "loaned"
+            except ValueError:
+                outcome = "rejected"
+            except Exception:
+                outcome = "errors"
+            finally:
+                db.close()
+            with lock:
+                outcomes[outcome] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    db = SessionLocal()
+    double_loaned = db.query(models.Loan.copy_id).filter(models.Loan.active == True).group_by(models.Loan.copy_id).having(func.count() > 1).count()
+    claimed = db.query(models.Copy).filter(models.Copy.available == False).count()
+    over_limit = db.query(models.Loan.user_id).filter(models.Loan.active == True).group_by(models.Loan.user_id).having(func.count() > crud.MAX_ACTIVE_LOANS).count()
+    db.close()
+
+    print(f"checkouts/s      {args.attempts / elapsed:.1f}")
+    print(f"loaned           {outcomes['loaned']}")
+    print(f"rejected         {outcomes['rejected']}")
+    print(f"errors           {outcomes['errors']}")
+    print(f"copies claimed   {claimed}")
+    print(f"double loaned    {double_loaned}")
+    print(f"users over limit {over_limit}")
+    assert double_loaned == 0 and over_limit == 0 and claimed == outcomes["loaned"]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Mixed reader/writer throughput under different SQLite settings.
+
+Each configuration runs in its own process, because the pragmas are read
+when the database module is imported. Run from the parent directory of the
+project package:
+
+    python -m package.benchmarks.concurrency --readers 8 --writers 4 --seconds 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+CONFIGURATIONS = {
+    "rollback journal": {"LIBRARY_SQLITE_JOURNAL_MODE": "DELETE", "LIBRARY_SQLITE_SYNCHRONOUS": "FULL"},
+    "wal + normal": {},
+}
+
+
+def run_worker(args):
+    os.chdir(tempfile.mkdtemp())
+    from .. import crud, models, schemas
+    from ..database import ReadSessionLocal, SessionLocal, engine
+
+    models.Base.metadata.create_all(bind=engine)
+    db = SessionLocal()
+    category = crud.create_category(db, schemas.CategoryCreate(name="bench"))
+    for i in range(200):
+        crud.create_book(db, schemas.BookCreate(title=f"title {i}", author="author", editorial="editorial", pub_year=2000, edition=1, category_id=category.id))
+    db.close()
+
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.seconds
+
+    def loop(session_factory, operation, key):
+        while time.perf_counter() < deadline:
+            db = session_factory()
+            try:
+                operation(db)
+                outcome = key
+            except Exception:
+                outcome = "errors"
+            finally:
+                db.close()
+            with lock:
+                counts[outcome] += 1
+
+    def read(db):
+        crud.get_books(db, limit=50)
+
+    def write(db):
+        crud.create_copy(db, schemas.CopyCreate(available=True, atention=False, book_id=1))
+
+    threads = [threading.Thread(target=loop, args=(ReadSessionLocal, read, "reads")) for _ in range(args.readers)]
+    threads += [threading.Thread(target=loop, args=(SessionLocal, write, "writes")) for _ in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(json.dumps({key: value / args.seconds for key, value in counts.items()}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        return run_worker(args)
+
+    print(f"{'configuration':>18} {'reads/s':>10} {'writes/s':>10} {'errors/s':>10}")
+    for name, env in CONFIGURATIONS.items():
+        output = subprocess.check_output(
+            [sys.executable, "-m", __spec__.name, "--worker", "--readers", str(args.readers), "--writers", str(args.writers), "--seconds", str(args.seconds)],
+            env={**os.environ, **env},
+            cwd=os.getcwd(),
+        )
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        print(f"{name:>18} {result['reads']:>10.1f} {result['writes']:>10.1f} {result['errors']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
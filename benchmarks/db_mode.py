@@ -0,0 +1,99 @@
+"""Compare throughput and latency of the sync and async database modes.
+
+Each mode runs in its own process, because LIBRARY_DB_MODE is read when the
+app is imported. Run from the parent directory of the project package:
+
+    python -m package.benchmarks.db_mode --requests 2000 --concurrency 100
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+PATHS = ["/books/?limit=20", "/categories/?limit=5", "/users/?limit=20", "/copies/book/1", "/loans/user/1"]
+
+
+def percentile(values, fraction: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def seed(client):
+    for c in range(10):
+        client.post("/categories/", json={"name": f"category {c}"})
+    for b in range(100):
+        client.post("/books/", json={"title": f"title {b}", "author": "author", "editorial": "editorial", "pub_year": 2000, "edition": 1, "category_id": b % 10 + 1})
+    for c in range(300):
+        client.post("/copies/", json={"available": True, "atention": False, "book_id": c % 100 + 1})
+    for u in range(50):
+        client.post("/users/", json={"name": "name", "last_name": "last", "email": f"user{u}@example.com", "phone": "5555", "active": True, "password": "secret"})
+    for l in range(100):
+        client.post("/loans/", json={"copy_id": l + 1, "user_id": l % 50 + 1})
+
+
+async def drive(app, requests: int, concurrency: int):
+    import httpx
+
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(PATHS[i % len(PATHS)])
+
+    async def worker(client):
+        while not queue.empty():
+            path = queue.get_nowait()
+            started = time.perf_counter()
+            response = await client.get(path)
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200, (path, response.status_code)
+
+    # Inside the app lifespan on this event loop, where the async engines
+    # hand out their connections
+    async with app.router.lifespan_context(app), httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return {
+        "requests_per_second": requests / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def run_mode(args):
+    os.chdir(tempfile.mkdtemp())
+    from fastapi.testclient import TestClient
+
+    from ..main import app
+
+    with TestClient(app) as client:
+        seed(client)
+    print(json.dumps(asyncio.run(drive(app, args.requests, args.concurrency))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        return run_mode(args)
+
+    print(f"{'mode':>6} {'req/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for mode in ("sync", "async"):
+        output = subprocess.check_output(
+            [sys.executable, "-m", __spec__.name, "--worker", "--requests", str(args.requests), "--concurrency", str(args.concurrency)],
+            env={**os.environ, "LIBRARY_DB_MODE": mode},
+            cwd=os.getcwd(),
+        )
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        print(f"{mode:>6} {result['requests_per_second']:>10.1f} {result['p50_ms']:>10.2f} {result['p99_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Memory and time-to-first-byte of the streamed loans export.
+
+Seeds a loans table (1M rows by default) and consumes export.stream_table
+while tracing allocations, next to the list-based approach of the paginated
+routes for a fraction of the rows. Each export fails if its traced peak
+goes over --max-peak-mib, since streaming should keep it at a few chunks
+whatever the row count. Run from the parent directory of the project package:
+
+    python -m package.benchmarks.export --rows 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from .. import crud, export, models, schemas
+from .pagination import seed_loans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--list-rows", type=int, default=100000)
+    parser.add_argument("--max-peak-mib", type=float, default=16, help="fail if a streamed export's peak memory goes over this")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "export.db")
+    engine = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(bind=engine)
+    seed_loans(engine, args.rows)
+
+    print(f"{'method':>16} {'rows':>9} {'first byte ms':>14} {'total s':>8} {'peak MiB':>9}")
+    for format in ("ndjson", "csv"):
+        tracemalloc.start()
+        started = time.perf_counter()
+        first_byte = None
+        size = 0
+        for chunk in export.stream_table("loans", format, bind=engine):
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            size += len(chunk)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{'export ' + format:>16} {args.rows:>9} {first_byte * 1000:>14.1f} {elapsed:>8.1f} {peak / 2 ** 20:>9.1f}")
+        assert peak / 2 ** 20 <= args.max_peak_mib, f"export {format} peaked at {peak / 2 ** 20:.1f} MiB, over --max-peak-mib {args.max_peak_mib}"
+
+    db = sessionmaker(bind=engine)()
+    tracemalloc.start()
+    started = time.perf_counter()
+    loans = [schemas.Loan.from_orm(loan).json() for loan in crud.get_loans(db, limit=args.list_rows)]
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    db.close()
+    print(f"{'list + schemas':>16} {len(loans):>9} {'-':>14} {elapsed:>8.1f} {peak / 2 ** 20:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Seeded synthetic library data generator.
+
+Creates <dir>/library-project.db with the application schema and fills the
+five tables at the requested scale using plain executemany inserts, then
+applies the migrations so the search index and availability counters are
+built once at the end. Every date is relative to --today, so the same seed
+and anchor date give the same file. Run from the parent directory of the
+project package:
+
+    python -m package.benchmarks.generate --scale large --dir /tmp/library
+"""
+import argparse
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+
+from .. import crud, migrations, models
+
+SCALES = {
+    "small": {"users": 1000, "copies": 10000, "loans": 100000},
+    "medium": {"users": 10000, "copies": 100000, "loans": 1000000},
+    "large": {"users": 100000, "copies": 1000000, "loans": 10000000},
+}
+COPIES_PER_BOOK = 5
+CATEGORIES = 50
+CHUNK = 50000
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+TODAY = "2024-01-01"
+
+WORDS = (
+    "shadow river garden night empire silver winter glass storm house ocean mountain letters "
+    "secret kingdom memory fire island journey city dream stone forest song daughter light"
+).split()
+AUTHORS = ["Garcia", "Rulfo", "Paz", "Fuentes", "Castellanos", "Poniatowska", "Esquivel", "Bolano"]
+EDITORIALS = ["Penguin", "Anagrama", "Alfaguara", "Planeta", "Era"]
+
+
+def chunks(rows, size: int = CHUNK):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def insert(conn, table: str, columns, rows):
+    statement = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    count = 0
+    for chunk in chunks(rows):
+        conn.executemany(statement, chunk)
+        count += len(chunk)
+    conn.commit()
+    return count
+
+
+def parse_date(value: str):
+    return datetime.strptime(value, "%Y-%m-%d")
+
+
+def generate(path: str, users: int, copies: int, loans: int, seed: int = 42, today: datetime = None):
+    rng = random.Random(seed)
+    books = max(1, copies // COPIES_PER_BOOK)
+    now = today or parse_date(TODAY)
+    history_start = now - timedelta(days=5 * 365)
+
+    engine = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(bind=engine)
+    engine.dispose()
+
+    # The most recent loans are the active ones: each on its own copy and at
+    # most MAX_ACTIVE_LOANS per user, matching what checkout allows.
+    active = min(loans, copies // 10, users * crud.MAX_ACTIVE_LOANS)
+    active_copies = rng.sample(range(1, copies + 1), active)
+    loaned = set(active_copies)
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    counts = {}
+    counts["categories"] = insert(conn, "categories", ("id", "name"), ((i, f"Category {i}") for i in range(1, CATEGORIES + 1)))
+    counts["books"] = insert(
+        conn, "books", ("id", "title", "author", "editorial", "pub_year", "edition", "category_id"),
+        (
+            (i, " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))), rng.choice(AUTHORS), rng.choice(EDITORIALS), rng.randint(1900, 2023), rng.randint(1, 5), rng.randint(1, CATEGORIES))
+            for i in range(1, books + 1)
+        ),
+    )
+    counts["copies"] = insert(
+        conn, "copies", ("id", "book_id", "available", "atention"),
+        ((i, rng.randint(1, books), i not in loaned, rng.random() < 0.02) for i in range(1, copies + 1)),
+    )
+    counts["users"] = insert(
+        conn, "users", ("id", "name", "last_name", "email", "phone", "active", "register_date", "expiration_date"),
+        (
+            (i, f"Name {i}", f"Last {i}", f"user{i}@example.com", f"55{i:08d}", True, history_start.strftime(DATE_FORMAT), (now + timedelta(days=120)).strftime(DATE_FORMAT))
+            for i in range(1, users + 1)
+        ),
+    )
+
+    def loan_rows():
+        span = (now - history_start).total_seconds()
+        history = loans - active
+        for i in range(1, loans + 1):
+            if i <= history:
+                loan_date = history_start + timedelta(seconds=span * i / max(history, 1))
+                copy_id, user_id, is_active = rng.randint(1, copies), rng.randint(1, users), False
+            else:
+                j = i - history - 1
+                loan_date = now - timedelta(days=7) + timedelta(seconds=j)
+                copy_id, user_id, is_active = active_copies[j], j % users + 1, True
+            return_date = loan_date + timedelta(days=8)
+            overdue = is_active and crud.loan_overdue(return_date, now)
+            yield (i, copy_id, user_id, loan_date.strftime(DATE_FORMAT), return_date.strftime(DATE_FORMAT), is_active, overdue)
+
+    counts["loans"] = insert(conn, "loans", ("id", "copy_id", "user_id", "loan_date", "return_date", "active", "overdue"), loan_rows())
+    conn.close()
+
+    engine = create_engine(f"sqlite:///{path}")
+    migrations.migrate(engine)
+    engine.dispose()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", default=".")
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--copies", type=int)
+    parser.add_argument("--loans", type=int)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--today", type=parse_date, default=TODAY, help="date the generated data is anchored to, YYYY-MM-DD")
+    parser.add_argument("--force", action="store_true", help="replace an existing database")
+    args = parser.parse_args()
+
+    path = os.path.join(args.dir, "library-project.db")
+    if os.path.exists(path):
+        if not args.force:
+            parser.error(f"{path} already exists, pass --force to replace it")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    os.makedirs(args.dir, exist_ok=True)
+
+    scale = {key: getattr(args, key) or value for key, value in SCALES[args.scale].items()}
+    started = time.perf_counter()
+    counts = generate(path, seed=args.seed, today=args.today, **scale)
+    elapsed = time.perf_counter() - started
+    for table, count in counts.items():
+        print(f"{table:>10} {count:>10}")
+    print(f"generated {path} in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Compare write throughput of per-request commits and group commit.
+
+Each configuration runs in its own process, because LIBRARY_WRITE_MODE and the
+pragmas are read when the app is imported. Every cycle registers a user,
+adds a copy, checks it out and returns it, so all four queued operations are
+exercised. Direct mode is measured with synchronous=NORMAL (the default) and
+with synchronous=FULL, the durability group mode gives every acknowledged
+write. Run from the parent directory of the project package:
+
+    python -m package.benchmarks.group_commit --cycles 500 --concurrency 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from .db_mode import percentile, seed
+
+# (label, environment)
+CONFIGS = [
+    ("direct", {"LIBRARY_WRITE_MODE": "direct"}),
+    ("direct+full", {"LIBRARY_WRITE_MODE": "direct", "LIBRARY_SQLITE_SYNCHRONOUS": "FULL"}),
+    ("group", {"LIBRARY_WRITE_MODE": "group"}),
+]
+
+
+async def drive(app, cycles: int, concurrency: int):
+    import httpx
+
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(cycles):
+        queue.put_nowait(i)
+
+    async def write(client, method: str, path: str, body=None):
+        started = time.perf_counter()
+        response = await client.request(method, path, json=body)
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code in (200, 201), (path, response.status_code, response.text)
+        return response.json()
+
+    async def worker(client):
+        while not queue.empty():
+            i = queue.get_nowait()
+            user = await write(client, "POST", "/users/", {"name": "name", "last_name": "last", "email": f"bench{i}@example.com", "phone": "5555", "active": True, "password": "secret"})
+            copy = await write(client, "POST", "/copies/", {"available": True, "atention": False, "book_id": i % 100 + 1})
+            loan = await write(client, "POST", "/loans/", {"copy_id": copy["id"], "user_id": user["id"]})
+            await write(client, "DELETE", f"/loans/{loan['id']}")
+
+    async with httpx.AsyncClient(app=app, base_url="http://bench", timeout=60) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return {
+        "writes_per_second": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def run_config(args):
+    os.chdir(tempfile.mkdtemp())
+    from fastapi.testclient import TestClient
+
+    from .. import writer
+    from ..main import app
+
+    with TestClient(app) as client:
+        seed(client)
+    result = asyncio.run(drive(app, args.cycles, args.concurrency))
+    if writer.ENABLED:
+        result["average_batch"] = writer.group_writer.stats()["average_batch"]
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cycles", type=int, default=500, help="user, copy, checkout and return per cycle")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        return run_config(args)
+
+    print(f"{'config':>12} {'writes/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'batch':>7}")
+    for label, env in CONFIGS:
+        output = subprocess.check_output(
+            [sys.executable, "-m", __spec__.name, "--worker", "--cycles", str(args.cycles), "--concurrency", str(args.concurrency)],
+            # A cheap password hash, so registrations measure the commit
+            env={**os.environ, "LIBRARY_SCRYPT_N": "1024", **env},
+            cwd=os.getcwd(),
+        )
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        batch = f"{result['average_batch']:.1f}" if "average_batch" in result else "-"
+        print(f"{label:>12} {result['writes_per_second']:>10.1f} {result['p50_ms']:>10.2f} {result['p99_ms']:>10.2f} {batch:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Bulk ingest throughput in rows per second.
+
+Streams generated copies through POST /copies/bulk as NDJSON and as CSV and
+compares them with one POST /copies/ per row. Run from the parent directory
+of the project package:
+
+    python -m package.benchmarks.ingest --rows 500000
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+
+def ndjson_rows(rows: int, batch: int = 10000):
+    for start in range(0, rows, batch):
+        yield "".join(
+            json.dumps({"available": True, "atention": False, "book_id": i % 100 + 1}) + "\n"
+            for i in range(start, min(start + batch, rows))
+        ).encode()
+
+
+def csv_rows(rows: int, batch: int = 10000):
+    yield b"available,atention,book_id\n"
+    for start in range(0, rows, batch):
+        yield "".join(f"1,0,{i % 100 + 1}\n" for i in range(start, min(start + batch, rows))).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--single-rows", type=int, default=500)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    from fastapi.testclient import TestClient
+
+    from ..main import app
+
+    with TestClient(app) as client:
+        client.post("/categories/", json={"name": "bench"})
+        for b in range(100):
+            client.post("/books/", json={"title": f"title {b}", "author": "author", "editorial": "editorial", "pub_year": 2000, "edition": 1, "category_id": 1})
+
+        print(f"{'method':>14} {'rows':>9} {'rows/s':>10}")
+        started = time.perf_counter()
+        for i in range(args.single_rows):
+            client.post("/copies/", json={"available": True, "atention": False, "book_id": i % 100 + 1})
+        print(f"{'POST /copies/':>14} {args.single_rows:>9} {args.single_rows / (time.perf_counter() - started):>10.0f}")
+
+        for name, body, content_type in (
+            ("bulk ndjson", ndjson_rows(args.rows), "application/x-ndjson"),
+            ("bulk csv", csv_rows(args.rows), "text/csv"),
+        ):
+            started = time.perf_counter()
+            result = client.post("/copies/bulk", content=body, headers={"content-type": content_type}).json()
+            elapsed = time.perf_counter() - started
+            assert result["inserted"] == args.rows, result
+            print(f"{name:>14} {args.rows:>9} {args.rows / elapsed:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
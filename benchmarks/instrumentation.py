@@ -0,0 +1,59 @@
+"""Measure the overhead of the per-request SQL instrumentation.
+
+Runs the same read workload with LIBRARY_INSTRUMENTATION on and off, each in
+its own process because the setting is read when the app is imported. The
+slow-query threshold is raised so logging does not show up in the numbers.
+Run from the parent directory of the project package:
+
+    python -m package.benchmarks.instrumentation --requests 5000 --repeat 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from .db_mode import drive, seed
+
+
+def run_mode(args):
+    os.chdir(tempfile.mkdtemp())
+    from fastapi.testclient import TestClient
+
+    from ..main import app
+
+    with TestClient(app) as client:
+        seed(client)
+    asyncio.run(drive(app, min(args.requests, 500), args.concurrency))
+    results = [asyncio.run(drive(app, args.requests, args.concurrency)) for _ in range(args.repeat)]
+    print(json.dumps(max(results, key=lambda result: result["requests_per_second"])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3, help="report the best of this many runs")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        return run_mode(args)
+
+    results = {}
+    print(f"{'instrumentation':>15} {'req/s':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    for mode, enabled in (("off", "0"), ("on", "1")):
+        output = subprocess.check_output(
+            [sys.executable, "-m", __spec__.name, "--worker", "--requests", str(args.requests), "--concurrency", str(args.concurrency), "--repeat", str(args.repeat)],
+            env={**os.environ, "LIBRARY_INSTRUMENTATION": enabled, "LIBRARY_SLOW_QUERY_MS": "1000000"},
+            cwd=os.getcwd(),
+        )
+        result = results[mode] = json.loads(output.decode().strip().splitlines()[-1])
+        print(f"{mode:>15} {result['requests_per_second']:>10.1f} {result['p50_ms']:>10.2f} {result['p99_ms']:>10.2f}")
+    overhead = results["off"]["requests_per_second"] / results["on"]["requests_per_second"] - 1
+    print(f"overhead: {overhead * 100:+.1f}% time per request")
+
+
+if __name__ == "__main__":
+    main()
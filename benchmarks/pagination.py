@@ -0,0 +1,73 @@
+"""Compare OFFSET and keyset page latency on a large loans table.
+
+Run from the parent directory of the project package, e.g.
+
+    python -m package.benchmarks.pagination --rows 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from .. import crud, models
+
+
+def seed_loans(engine, rows: int, chunk: int = 50000):
+    start = datetime(2000, 1, 1)
+    with engine.begin() as conn:
+        for offset in range(0, rows, chunk):
+            conn.execute(
+                models.Loan.__table__.insert(),
+                [
+                    {
+                        "copy_id": i % 5000 + 1,
+                        "user_id": i % 1000 + 1,
+                        "loan_date": start + timedelta(minutes=i),
+                        "return_date": start + timedelta(minutes=i, days=8),
+                        "active": False,
+                    }
+                    for i in range(offset, min(offset + chunk, rows))
+                ],
+            )
+
+
+def timed(read, repeat: int = 5):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = read()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "pagination.db")
+    engine = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(bind=engine)
+    seed_loans(engine, args.rows)
+    db = sessionmaker(bind=engine)()
+
+    print(f"{'depth':>8} {'offset ms':>10} {'cursor ms':>10}")
+    for depth in (0.0, 0.25, 0.5, 0.75, 0.99):
+        skip = int(args.rows * depth)
+        offset_time, _ = timed(lambda: crud.get_loans(db, skip=skip, limit=args.limit))
+        # The cursor for a page is taken from the last row of the page before it.
+        previous = crud.get_loans(db, skip=max(skip - 1, 0), limit=1)
+        cursor = crud.encode_cursor(models.Loan, previous[0]) if skip else None
+        cursor_time, _ = timed(lambda: crud.get_loans(db, limit=args.limit, cursor=cursor))
+        print(f"{depth:>8.0%} {offset_time * 1000:>10.2f} {cursor_time * 1000:>10.2f}")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
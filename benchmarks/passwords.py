@@ -0,0 +1,105 @@
+"""Measure catalog read latency during login and registration bursts.
+
+Reads the catalog routes on their own, then again while a burst of logins
+and registrations runs alongside them, and reports p50/p99 of the reads
+for both along with how the burst itself fared (completed, 503s). Password
+hashing runs on passwords.pool, sized with LIBRARY_PASSWORD_WORKERS and
+LIBRARY_PASSWORD_QUEUE. Run from the parent directory of the project package:
+
+    python -m package.benchmarks.passwords --reads 2000 --burst 200
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from .db_mode import percentile, seed
+
+PATHS = ["/books/?limit=20", "/categories/?limit=5", "/copies/book/1", "/books/1"]
+
+
+async def read_catalog(client, requests: int, concurrency: int):
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(PATHS[i % len(PATHS)])
+
+    async def worker():
+        while not queue.empty():
+            path = queue.get_nowait()
+            started = time.perf_counter()
+            response = await client.get(path)
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200, (path, response.status_code)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return percentile(latencies, 0.50) * 1000, percentile(latencies, 0.99) * 1000
+
+
+async def password_burst(client, requests: int, concurrency: int, kind: str):
+    statuses = []
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+
+    async def worker():
+        while not queue.empty():
+            i = queue.get_nowait()
+            if kind == "login" or (kind == "mixed" and i % 2):
+                response = await client.post("/users/login", json={"email": f"user{i % 50}@example.com", "password": "secret"})
+            else:
+                response = await client.post("/users/", json={"name": "name", "last_name": "last", "email": f"burst{i}@example.com", "phone": "5555", "active": True, "password": "secret"})
+            statuses.append(response.status_code)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return statuses, time.perf_counter() - started
+
+
+async def run(app, args):
+    import httpx
+
+    async with httpx.AsyncClient(app=app, base_url="http://bench", timeout=120) as client:
+        await read_catalog(client, min(args.reads, 200), args.concurrency)
+        alone = await read_catalog(client, args.reads, args.concurrency)
+        burst = asyncio.create_task(password_burst(client, args.burst, args.burst_concurrency, args.burst_kind))
+        during = await read_catalog(client, args.reads, args.concurrency)
+        statuses, elapsed = await burst
+    return alone, during, statuses, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reads", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--burst", type=int, default=200, help="password requests in the burst")
+    parser.add_argument("--burst-concurrency", type=int, default=50)
+    parser.add_argument("--burst-kind", choices=("mixed", "login", "register"), default="mixed")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    from fastapi.testclient import TestClient
+
+    from .. import passwords
+    from ..main import app
+
+    with TestClient(app) as client:
+        seed(client)
+    passwords.pool.start()
+    try:
+        alone, during, statuses, elapsed = asyncio.run(run(app, args))
+    finally:
+        passwords.pool.stop()
+
+    print(f"password workers: {passwords.pool.workers}, queue limit: {passwords.pool.queue_size}")
+    print(f"{'catalog reads':>16} {'p50 ms':>10} {'p99 ms':>10}")
+    print(f"{'alone':>16} {alone[0]:>10.2f} {alone[1]:>10.2f}")
+    print(f"{'during burst':>16} {during[0]:>10.2f} {during[1]:>10.2f}")
+    completed = sum(1 for status in statuses if status in (200, 201))
+    rejected = sum(1 for status in statuses if status == 503)
+    print(f"burst: {completed} completed, {rejected} rejected (503) in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""Scenario runner and latency report for the API.
+
+Drives a weighted mix of routes through the ASGI app in-process against the
+database in <dir> (see benchmarks.generate) and writes throughput and
+p50/p95/p99 latency per endpoint as JSON. Pass --baseline with an earlier
+report to print the change per endpoint. Checkouts and returns modify the
+database, so regenerate it before each run being compared. Run from the
+parent directory of the project package:
+
+    python -m package.benchmarks.run --dir /tmp/library --scenario mixed --out report.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import time
+
+# Each scenario is a list of (weight, action); an action picks its request
+# from the data ranges found in the database.
+SCENARIOS = {
+    "browse": [
+        (20, "list_categories"),
+        (20, "list_books"),
+        (25, "read_book"),
+        (15, "copies_of_book"),
+        (10, "search"),
+        (10, "availability"),
+    ],
+    "circulation": [
+        (40, "checkout"),
+        (30, "return"),
+        (15, "loans_of_user"),
+        (15, "read_user"),
+    ],
+    "mixed": [
+        (15, "list_books"),
+        (20, "read_book"),
+        (10, "copies_of_book"),
+        (10, "search"),
+        (10, "availability"),
+        (15, "checkout"),
+        (10, "return"),
+        (10, "loans_of_user"),
+    ],
+}
+SEARCH_TERMS = ["storm", "sil", "garden night", "rulfo", "pen", "memory", "ci"]
+
+
+class Workload:
+    def __init__(self, path: str, seed: int):
+        conn = sqlite3.connect(path)
+        self.books = conn.execute("SELECT MAX(id) FROM books").fetchone()[0] or 1
+        self.copies = conn.execute("SELECT MAX(id) FROM copies").fetchone()[0] or 1
+        self.users = conn.execute("SELECT MAX(id) FROM users").fetchone()[0] or 1
+        conn.close()
+        self.rng = random.Random(seed)
+        self.loaned = []
+
+    def request(self, action: str):
+        # Returns (endpoint label, method, url, json body)
+        rng = self.rng
+        if action == "list_categories":
+            return "GET /categories/", "GET", "/categories/?limit=5", None
+        if action == "list_books":
+            return "GET /books/", "GET", f"/books/?limit=20&skip={rng.randint(0, 200)}", None
+        if action == "read_book":
+            book_id = rng.randint(1, self.books)
+            return "GET /books/{book_id}", "GET", f"/books/{book_id}", None
+        if action == "copies_of_book":
+            book_id = rng.randint(1, self.books)
+            return "GET /copies/book/{book_id}", "GET", f"/copies/book/{book_id}", None
+        if action == "search":
+            return "GET /books/search", "GET", f"/books/search?q={rng.choice(SEARCH_TERMS)}", None
+        if action == "availability":
+            ids = ",".join(str(rng.randint(1, self.books)) for _ in range(20))
+            return "GET /books/availability", "GET", f"/books/availability?ids={ids}", None
+        if action == "checkout":
+            body = {"copy_id": rng.randint(1, self.copies), "user_id": rng.randint(1, self.users)}
+            return "POST /loans/", "POST", "/loans/", body
+        if action == "return":
+            if not self.loaned:
+                return self.request("checkout")
+            return "DELETE /loans/{loan_id}", "DELETE", f"/loans/{self.loaned.pop(rng.randrange(len(self.loaned)))}", None
+        if action == "loans_of_user":
+            user_id = rng.randint(1, self.users)
+            return "GET /loans/user/{user_id}", "GET", f"/loans/user/{user_id}", None
+        if action == "read_user":
+            user_id = rng.randint(1, self.users)
+            return "GET /users/{user_id}", "GET", f"/users/{user_id}", None
+        raise ValueError(f"Unknown action {action}")
+
+
+def percentile(values, fraction: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def summarize(latencies, statuses, elapsed: float):
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "statuses": {str(status): statuses.count(status) for status in sorted(set(statuses))},
+    }
+
+
+async def run_scenario(app, workload: Workload, scenario: str, requests: int, concurrency: int):
+    import httpx
+
+    weights, actions = zip(*SCENARIOS[scenario])
+    plan = workload.rng.choices(actions, weights=weights, k=requests)
+    results = {}
+
+    async def worker(client):
+        while plan:
+            label, method, url, body = workload.request(plan.pop())
+            started = time.perf_counter()
+            response = await client.request(method, url, json=body)
+            latency = time.perf_counter() - started
+            if label == "POST /loans/" and response.status_code == 201:
+                workload.loaned.append(response.json()["id"])
+            latencies, statuses = results.setdefault(label, ([], []))
+            latencies.append(latency)
+            statuses.append(response.status_code)
+
+    # The app's startup and shutdown handlers run on this event loop, as
+    # under a server, so the writer, password pool and async engines are
+    # started where the requests use them
+    async with app.router.lifespan_context(app), httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    all_latencies = [latency for latencies, _ in results.values() for latency in latencies]
+    all_statuses = [status for _, statuses in results.values() for status in statuses]
+    return {
+        "total": summarize(all_latencies, all_statuses, elapsed),
+        "endpoints": {label: summarize(latencies, statuses, elapsed) for label, (latencies, statuses) in sorted(results.items())},
+    }
+
+
+def compare(report, baseline):
+    print(f"{'endpoint':>28} {'req/s':>9} {'Δ':>7} {'p99 ms':>9} {'Δ':>7}")
+    rows = [("total", report["total"], baseline.get("total"))]
+    rows += [(label, stats, baseline.get("endpoints", {}).get(label)) for label, stats in report["endpoints"].items()]
+    for label, stats, before in rows:
+        if before:
+            throughput = f"{(stats['throughput'] / before['throughput'] - 1) * 100:+.0f}%"
+            p99 = f"{(stats['p99_ms'] / before['p99_ms'] - 1) * 100:+.0f}%"
+        else:
+            throughput = p99 = "new"
+        print(f"{label:>28} {stats['throughput']:>9.1f} {throughput:>7} {stats['p99_ms']:>9.2f} {p99:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", default=".")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="mixed")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="benchmark-report.json")
+    parser.add_argument("--baseline")
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out)
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    os.chdir(args.dir)
+    # The generated dates are anchored to generate --today, so the in-app
+    # overdue scan, which compares them against the clock, would flag a
+    # different set of loans depending on the day of the run
+    os.environ.setdefault("LIBRARY_OVERDUE_INTERVAL_SECONDS", "0")
+    workload = Workload("library-project.db", args.seed)
+    from ..main import app
+
+    report = {
+        "scenario": args.scenario,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "db_mode": os.environ.get("LIBRARY_DB_MODE", "sync"),
+        **asyncio.run(run_scenario(app, workload, args.scenario, args.requests, args.concurrency)),
+    }
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if baseline:
+        with open(baseline) as f:
+            compare(report, json.load(f))
+    else:
+        compare(report, {})
+    print(f"wrote {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Latency of GET /books/search style queries on a large catalog.
+
+Seeds a books table (1M titles by default) through the FTS sync triggers
+and times word, prefix and deep-page queries. Run from the parent directory
+of the project package:
+
+    python -m package.benchmarks.search --books 1000000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from .. import crud, migrations, models
+
+WORDS = (
+    "shadow river garden night empire silver winter glass storm house ocean mountain letters "
+    "secret kingdom memory fire island journey city dream stone forest song daughter light"
+).split()
+AUTHORS = ["Garcia", "Rulfo", "Paz", "Fuentes", "Castellanos", "Poniatowska", "Esquivel", "Bolano"]
+EDITORIALS = ["Penguin", "Anagrama", "Alfaguara", "Planeta", "Era"]
+
+
+def seed_books(engine, books: int, chunk: int = 50000):
+    rng = random.Random(42)
+    with engine.begin() as conn:
+        conn.execute(models.Category.__table__.insert(), [{"name": "bench"}])
+        for offset in range(0, books, chunk):
+            conn.execute(
+                models.Book.__table__.insert(),
+                [
+                    {
+                        "title": " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5))) + f" {i}",
+                        "author": rng.choice(AUTHORS),
+                        "editorial": rng.choice(EDITORIALS),
+                        "pub_year": rng.randint(1900, 2024),
+                        "edition": 1,
+                        "category_id": 1,
+                    }
+                    for i in range(offset, min(offset + chunk, books))
+                ],
+            )
+
+
+def timed(read, repeat: int = 5):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = read()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--books", type=int, default=1000000)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "search.db")
+    engine = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(bind=engine)
+    migrations.migrate(engine)
+    started = time.perf_counter()
+    seed_books(engine, args.books)
+    print(f"seeded {args.books} books in {time.perf_counter() - started:.1f}s")
+    db = sessionmaker(bind=engine)()
+
+    print(f"{'query':>22} {'ms':>8} {'rows':>5}")
+    for q in ("rulfo", "storm", "sto", "si", "silver night", "garden anag", f"{args.books // 2}"):
+        elapsed, (books, _) = timed(lambda: crud.search_books(db, q, limit=args.limit))
+        print(f"{q:>22} {elapsed * 1000:>8.2f} {len(books):>5}")
+
+    cursor = None
+    for page in range(1, 51):
+        books, cursor = crud.search_books(db, "penguin", limit=args.limit, cursor=cursor)
+        if page in (1, 10, 50):
+            elapsed, _ = timed(lambda: crud.search_books(db, "penguin", limit=args.limit, cursor=cursor))
+            print(f"{f'penguin page {page + 1}':>22} {elapsed * 1000:>8.2f} {len(books):>5}")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
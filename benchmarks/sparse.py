@@ -0,0 +1,74 @@
+"""Compare payload size and latency of full and sparse responses.
+
+Generates a database with benchmarks.generate (or reuses the one in --dir)
+and requests each list route in full, with expand= to drop the nested
+relationships and with fields= on top of that. Run from the parent directory
+of the project package:
+
+    python -m package.benchmarks.sparse --scale small --requests 50
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+# (label, path); every route is measured in each of the MODES
+ROUTES = [
+    ("categories", "/categories/?limit=10"),
+    ("books", "/books/?limit=100"),
+    ("users", "/users/?limit=100"),
+]
+MODES = {
+    "categories": [("full", ""), ("expand=books", "&expand=books"), ("shallow", "&expand="), ("fields=name", "&expand=&fields=name")],
+    "books": [("full", ""), ("shallow", "&expand="), ("fields=title", "&expand=&fields=title")],
+    "users": [("full", ""), ("shallow", "&expand="), ("fields=email", "&expand=&fields=email")],
+}
+
+
+def percentile(values, fraction: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def measure(app, path: str, requests: int):
+    import httpx
+
+    latencies = []
+    async with httpx.AsyncClient(app=app, base_url="http://bench") as client:
+        size = len((await client.get(path)).content)
+        for _ in range(requests):
+            started = time.perf_counter()
+            response = await client.get(path)
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200, (path, response.status_code)
+    return size, percentile(latencies, 0.50), percentile(latencies, 0.95)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dir", help="directory with an existing library-project.db")
+    parser.add_argument("--scale", choices=("small", "medium", "large"), default="small")
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    # The database modules resolve the relative database path when they are
+    # imported, so nothing from the package is imported before the chdir.
+    if args.dir:
+        os.chdir(args.dir)
+    else:
+        os.chdir(tempfile.mkdtemp())
+        from .generate import SCALES, generate
+
+        generate("library-project.db", **SCALES[args.scale])
+    from ..main import app
+
+    print(f"{'route':>12} {'mode':>14} {'bytes':>10} {'p50 ms':>9} {'p95 ms':>9}")
+    for label, path in ROUTES:
+        for mode, suffix in MODES[label]:
+            size, p50, p95 = asyncio.run(measure(app, path + suffix, args.requests))
+            print(f"{label:>12} {mode:>14} {size:>10} {p50 * 1000:>9.2f} {p95 * 1000:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Measure time to first request of a freshly started app process.
+
+Each run is a new interpreter, as a restarted or newly scaled worker would
+be: it imports the app, runs the startup handlers, then sends its first
+request to each of a few routes and finally fetches /openapi.json. Runs use a
+generated library (see benchmarks.generate) that is already migrated, except
+the "fresh database" configuration, which starts on an empty directory and
+creates the schema during startup. Run from the parent directory of the
+project package:
+
+    python -m package.benchmarks.startup --runs 5
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PATHS = ["/books/?limit=20", "/books/1", "/categories/?limit=5", "/copies/book/1", "/loans/user/1"]
+
+# (label, environment, keep the OpenAPI cache from the previous run, fresh database)
+CONFIGS = [
+    ("no warmup", {"LIBRARY_WARMUP": "0"}, False, False),
+    ("warmup", {}, False, False),
+    ("warmup+cached", {}, True, False),
+    ("fresh database", {}, False, True),
+]
+
+
+def run_worker(args):
+    booted = time.time()
+    # The database path is resolved when the package is first imported
+    os.chdir(args.dir)
+    from fastapi.testclient import TestClient
+
+    from ..main import app
+
+    imported = time.time()
+    with TestClient(app) as client:
+        ready = time.time()
+        for path in PATHS:
+            response = client.get(path)
+            assert response.status_code in (200, 404), (path, response.status_code)
+        answered = time.time()
+        assert client.get("/openapi.json").status_code == 200
+        documented = time.time()
+    print(json.dumps({
+        "boot_ms": (booted - args.started) * 1000,
+        "import_ms": (imported - booted) * 1000,
+        "startup_ms": (ready - imported) * 1000,
+        "first_requests_ms": (answered - ready) * 1000,
+        "total_ms": (answered - args.started) * 1000,
+        "openapi_ms": (documented - answered) * 1000,
+    }))
+
+
+def run_config(env: dict, directory: str):
+    started = time.time()
+    output = subprocess.check_output(
+        [sys.executable, "-m", __spec__.name, "--worker", "--dir", directory, "--started", repr(started)],
+        # The schedulers would otherwise start scanning alongside the first requests
+        env={**os.environ, "LIBRARY_OVERDUE_INTERVAL_SECONDS": "0", "LIBRARY_CHANGES_COMPACT_INTERVAL_SECONDS": "0", **env},
+        cwd=os.getcwd(),
+    )
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="processes started per configuration")
+    parser.add_argument("--scale", choices=("small", "medium", "large"), default="small")
+    parser.add_argument("--dir", help=argparse.SUPPRESS)
+    parser.add_argument("--started", type=float, help=argparse.SUPPRESS)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        return run_worker(args)
+
+    library = tempfile.mkdtemp()
+    subprocess.check_call(
+        [sys.executable, "-m", f"{__package__}.generate", "--dir", library, "--scale", args.scale],
+        stdout=subprocess.DEVNULL,
+        cwd=os.getcwd(),
+    )
+    openapi_cache = os.path.join(library, "library-openapi.json")
+
+    columns = ("boot_ms", "import_ms", "startup_ms", "first_requests_ms", "total_ms", "openapi_ms")
+    print(f"{'config':>15} " + " ".join(f"{column[:-3]:>14}" for column in columns) + "   (median ms)")
+    for label, env, keep_cache, fresh in CONFIGS:
+        results = []
+        for _ in range(args.runs):
+            if fresh:
+                directory = tempfile.mkdtemp()
+            else:
+                directory = library
+                if not keep_cache and os.path.exists(openapi_cache):
+                    os.remove(openapi_cache)
+            results.append(run_config(env, directory))
+            if fresh:
+                shutil.rmtree(directory)
+        print(f"{label:>15} " + " ".join(f"{statistics.median(result[column] for result in results):>14.1f}" for column in columns))
+    shutil.rmtree(library)
+
+
+if __name__ == "__main__":
+    main()
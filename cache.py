@@ -0,0 +1,254 @@
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Read-through cache for catalog responses. Entries hold the serialized
+# response body and carry tags such as "book:3" or "category:1"; writes in
+# crud invalidate by tag after they commit. The in-memory backend is per
+# process; the sqlite backend keeps entries in a local file so several
+# workers share one cache and see each other's invalidations.
+#
+# A read can race an invalidation: it queries, a write commits and
+# invalidates, then the read stores what it queried. So every invalidate
+# bumps a generation per tag, routes read the generations of their tags with
+# Cache.generation before querying, and set skips the entry if any of them
+# has moved since. Generation ANY_TAG moves on every invalidate, for routes
+# whose tags are only known after the query, and CLEARED on every clear.
+CACHE_BACKEND = os.environ.get("LIBRARY_CACHE_BACKEND", "memory")
+CACHE_SIZE = int(os.environ.get("LIBRARY_CACHE_SIZE", "10000"))
+CACHE_TTL = float(os.environ.get("LIBRARY_CACHE_TTL", "300"))
+CACHE_PATH = os.environ.get("LIBRARY_CACHE_PATH", "./library-cache.db")
+# The sqlite backend records hits in memory and writes their used_at for
+# eviction this many at a time, so reads rarely take the write lock
+CACHE_TOUCH_BATCH = int(os.environ.get("LIBRARY_CACHE_TOUCH_BATCH", "100"))
+BUSY_TIMEOUT = 5
+
+ANY_TAG = "*"
+CLEARED = ""
+
+class MemoryBackend:
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at, tags = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def generation(self, tags):
+        with self.lock:
+            return tuple((tag, self.generations.get(tag, 0)) for tag in (CLEARED, *tags))
+
+    def set(self, key: str, value: bytes, ttl: float, tags, generation=()):
+        with self.lock:
+            if any(self.generations.get(tag, 0) != seen for tag, seen in generation):
+                return False
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, time.monotonic() + ttl, tags)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.size:
+                self._remove(next(iter(self.entries)))
+            return True
+
+    def invalidate(self, tags):
+        with self.lock:
+            for tag in (ANY_TAG, *tags):
+                self.generations[tag] = self.generations.get(tag, 0) + 1
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.generations[CLEARED] = self.generations.get(CLEARED, 0) + 1
+            self.entries.clear()
+            self.tags.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _remove(self, key: str):
+        _, _, tags = self.entries.pop(key)
+        for tag in tags:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+class SQLiteBackend:
+    def __init__(self, size: int, path: str, touch_batch: int = CACHE_TOUCH_BATCH):
+        self.size = size
+        self.touch_batch = touch_batch
+        self.touched = {}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=BUSY_TIMEOUT)
+        self.conn.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=OFF;
+            CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, expires_at REAL, used_at REAL);
+            CREATE INDEX IF NOT EXISTS ix_entries_used_at ON entries (used_at);
+            CREATE TABLE IF NOT EXISTS tags (tag TEXT, key TEXT, PRIMARY KEY (tag, key)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS ix_tags_key ON tags (key);
+            CREATE TABLE IF NOT EXISTS generations (tag TEXT PRIMARY KEY, generation INTEGER) WITHOUT ROWID;
+            """
+        )
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # A failed statement must not leave the shared connection inside an
+        # open transaction, where every later BEGIN would fail
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def best_effort(self, write, *args):
+        # Writes on the read path never wait for the write lock; when another
+        # worker holds it they are given up
+        self.conn.execute("PRAGMA busy_timeout = 0")
+        try:
+            with self.transaction():
+                write(*args)
+        except sqlite3.OperationalError:
+            pass
+        finally:
+            self.conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT * 1000}")
+
+    def get(self, key: str):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self.touched.pop(key, None)
+                self.best_effort(self._delete, "key IN (?)", (key,))
+                return None
+            self.touched[key] = now
+            if len(self.touched) >= self.touch_batch:
+                # Touches that cannot be written are dropped, and the reads
+                # still count as hits
+                self.best_effort(self._write_touched)
+            return row[0]
+
+    def generation(self, tags):
+        tags = (CLEARED, *tags)
+        with self.lock:
+            return tuple((tag, self._generation(tag)) for tag in tags)
+
+    def set(self, key: str, value: bytes, ttl: float, tags, generation=()):
+        now = time.time()
+        with self.lock, self.transaction():
+            if any(self._generation(tag) != seen for tag, seen in generation):
+                return False
+            self.touched.pop(key, None)
+            self.conn.execute("DELETE FROM tags WHERE key = ?", (key,))
+            self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", (key, value, now + ttl, now))
+            self.conn.executemany("INSERT OR IGNORE INTO tags VALUES (?, ?)", [(tag, key) for tag in tags])
+            self._write_touched()
+            overflow = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.size
+            if overflow > 0:
+                self._delete("key IN (SELECT key FROM entries ORDER BY used_at LIMIT ?)", (overflow,))
+            return True
+
+    def invalidate(self, tags):
+        tags = list(tags)
+        with self.lock, self.transaction():
+            self._bump([ANY_TAG, *tags])
+            self._delete(f"key IN (SELECT key FROM tags WHERE tag IN ({', '.join('?' * len(tags))}))", tags)
+
+    def clear(self):
+        with self.lock, self.transaction():
+            self._bump([CLEARED])
+            self.touched.clear()
+            self.conn.execute("DELETE FROM entries")
+            self.conn.execute("DELETE FROM tags")
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _write_touched(self):
+        touched, self.touched = self.touched, {}
+        self.conn.executemany("UPDATE entries SET used_at = ? WHERE key = ?", [(used_at, key) for key, used_at in touched.items()])
+
+    def _generation(self, tag: str):
+        row = self.conn.execute("SELECT generation FROM generations WHERE tag = ?", (tag,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def _bump(self, tags):
+        self.conn.executemany(
+            "INSERT INTO generations VALUES (?, 1) ON CONFLICT (tag) DO UPDATE SET generation = generation + 1",
+            [(tag,) for tag in tags],
+        )
+
+    def _delete(self, condition: str, params):
+        keys = [row[0] for row in self.conn.execute(f"SELECT key FROM entries WHERE {condition}", params)]
+        self.conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in keys])
+        self.conn.executemany("DELETE FROM tags WHERE key = ?", [(key,) for key in keys])
+
+class Cache:
+    def __init__(self, backend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def get(self, key: str):
+        value = self.backend.get(key)
+        with self.backend.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def generation(self, *tags):
+        # Read before the query whose result is passed to set; with no tags,
+        # any invalidation in between makes set skip the entry
+        return self.backend.generation(tags or (ANY_TAG,))
+
+    def set(self, key: str, value: bytes, tags=(), generation=()):
+        if not self.backend.set(key, value, self.ttl, tuple(tags), generation):
+            with self.backend.lock:
+                self.stale += 1
+
+    def invalidate(self, *tags):
+        if tags:
+            self.backend.invalidate(tags)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return {"backend": CACHE_BACKEND, "size": len(self.backend), "hits": self.hits, "misses": self.misses, "stale": self.stale}
+
+def create_backend():
+    if CACHE_BACKEND == "sqlite":
+        return SQLiteBackend(CACHE_SIZE, CACHE_PATH)
+    return MemoryBackend(CACHE_SIZE)
+
+catalog_cache = Cache(create_backend(), CACHE_TTL)
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from starlette.concurrency import run_in_threadpool
+
+from . import crud
+from .database import ReadSessionLocal, SessionLocal
+from .periodic import PeriodicTask
+
+# Change feed over crud.CHANGE_TABLES. GET /changes?since=<seq>&wait=<s>
+# long-polls: with nothing past `since` it re-reads the log every
+# LIBRARY_CHANGES_POLL_MS until something arrives or the wait runs out, so
+# writes from other processes (ingest, manage, other workers) wake it too.
+# Changes older than LIBRARY_CHANGES_RETENTION_HOURS are compacted away every
+# LIBRARY_CHANGES_COMPACT_INTERVAL_SECONDS (0 leaves it to
+# `python -m package.manage compact-changes`); a consumer whose `since` falls
+# before the retained window gets a 410 and has to resync from the tables.
+CHANGES_RETENTION_HOURS = float(os.environ.get("LIBRARY_CHANGES_RETENTION_HOURS", "168"))
+CHANGES_BATCH = int(os.environ.get("LIBRARY_CHANGES_BATCH", "1000"))
+CHANGES_COMPACT_INTERVAL = float(os.environ.get("LIBRARY_CHANGES_COMPACT_INTERVAL_SECONDS", "3600"))
+CHANGES_MAX_WAIT = float(os.environ.get("LIBRARY_CHANGES_MAX_WAIT_SECONDS", "30"))
+CHANGES_POLL_INTERVAL = float(os.environ.get("LIBRARY_CHANGES_POLL_MS", "200")) / 1000
+ENABLED = CHANGES_COMPACT_INTERVAL > 0
+
+logger = logging.getLogger("library.changes")
+
+def read_changes(since: int, limit: int):
+    # Returns (changes, first, last). A fresh read session per call, so a
+    # long poll does not keep a pooled connection while it sleeps.
+    db = ReadSessionLocal()
+    try:
+        first, last = crud.get_change_window(db)
+        changes = crud.get_changes(db, since, limit) if limit else []
+        return changes, first, last
+    finally:
+        db.close()
+
+def behind(since: int, first: int):
+    return first is not None and since < first - 1
+
+async def wait_for_changes(since: int, limit: int, wait: float = 0):
+    deadline = time.monotonic() + min(wait, CHANGES_MAX_WAIT)
+    while True:
+        changes, first, last = await run_in_threadpool(read_changes, since, limit)
+        if changes or behind(since, first) or not limit or time.monotonic() >= deadline:
+            return changes, first, last
+        await asyncio.sleep(CHANGES_POLL_INTERVAL)
+
+def compact_changes(hours: float = CHANGES_RETENTION_HOURS, batch_size: int = CHANGES_BATCH):
+    before = datetime.now() - timedelta(hours=hours)
+    compacted = 0
+    db = SessionLocal()
+    try:
+        while True:
+            deleted = crud.compact_change_batch(db, before, batch_size=batch_size)
+            compacted += deleted
+            if deleted < batch_size:
+                return compacted
+    finally:
+        db.close()
+
+def compact():
+    compacted = compact_changes()
+    if compacted:
+        logger.info("Compacted %d changes", compacted)
+
+compactor = PeriodicTask("Change log compaction", compact, CHANGES_COMPACT_INTERVAL)
@@ -1,13 +1,232 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import DateTime, and_, delete, event, func, insert, literal, or_, select, text, tuple_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload, load_only, selectinload
+from collections import namedtuple
 from datetime import datetime, timedelta
+import base64
+import json
+import os
+import re
 
 from . import models, schemas
-
-def create_user(db: Session, user: schemas.UserCreate):
+from .cache import catalog_cache
+
+# Eager-loading strategy used for the relationships nested in the response
+# schemas, so list endpoints run a fixed number of queries instead of one
+# lazy load per row. "selectin" issues one extra query per relationship level,
+# "joined" folds them into the main query. Set with LIBRARY_LOAD_STRATEGY.
+LOAD_STRATEGY = os.environ.get("LIBRARY_LOAD_STRATEGY", "selectin")
+
+LOADERS = {
+    "selectin": selectinload,
+    "joined": joinedload,
+}
+if LOAD_STRATEGY not in LOADERS:
+    raise ValueError(f"LIBRARY_LOAD_STRATEGY must be one of {', '.join(LOADERS)}")
+
+SCHEMA_RELATIONSHIPS = {
+    schemas.Book: [(models.Book.copies,)],
+    schemas.Category: [(models.Category.books, models.Book.copies)],
+    schemas.User: [(models.User.loans,)],
+}
+
+def load_options(schema, strategy: str = None, expand=None):
+    loader = LOADERS[strategy or LOAD_STRATEGY]
+    options = []
+    for path in SCHEMA_RELATIONSHIPS.get(schema, []):
+        if expand is not None:
+            path = expanded_path(path, expand)
+            if not path:
+                continue
+        option = loader(path[0])
+        for attribute in path[1:]:
+            option = getattr(option, loader.__name__)(attribute)
+        options.append(option)
+    return options
+
+# Sparse responses. fields= keeps only some columns of the top-level rows and
+# expand= lists the nested relationships to include, e.g. "books" or
+# "books.copies" on a category. Both narrow the SQL: relationships left out
+# are never loaded and the top-level SELECT only lists the requested columns
+# plus the keys paging and eager loading need. A shape of None is the full
+# response.
+Shape = namedtuple("Shape", ["fields", "expand"])
+
+def schema_relationships(schema):
+    return [path[0].key for path in SCHEMA_RELATIONSHIPS.get(schema, [])]
+
+def schema_columns(schema):
+    nested = schema_relationships(schema)
+    return [name for name in schema.__fields__ if name not in nested]
+
+def expanded_path(path, expand):
+    depth = 0
+    while depth < len(path) and ".".join(attribute.key for attribute in path[:depth + 1]) in expand:
+        depth += 1
+    return path[:depth]
+
+def parse_shape(schema, fields: str = None, expand: str = None):
+    if fields is None and expand is None:
+        return None
+    if fields is not None:
+        columns = schema_columns(schema)
+        requested = {field.strip() for field in fields.split(",") if field.strip()}
+        unknown = requested - set(columns)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        fields = tuple(column for column in columns if column in requested) or None
+    paths = {
+        ".".join(attribute.key for attribute in path[:depth])
+        for path in SCHEMA_RELATIONSHIPS.get(schema, [])
+        for depth in range(1, len(path) + 1)
+    }
+    if expand is None:
+        expand = paths
+    else:
+        requested = {path.strip() for path in expand.split(",") if path.strip()}
+        unknown = requested - paths
+        if unknown:
+            raise ValueError(f"Unknown expand paths: {', '.join(sorted(unknown))}")
+        # "books.copies" implies "books"
+        expand = {".".join(path.split(".")[:depth]) for path in requested for depth in range(1, path.count(".") + 2)}
+    return Shape(fields, frozenset(expand))
+
+def shape_options(model, schema, shape):
+    if shape is None:
+        return load_options(schema)
+    options = load_options(schema, expand=shape.expand)
+    if shape.fields is not None:
+        keys = {"id", *(column.key for column in PAGE_KEYS[model])}
+        options.append(load_only(*(getattr(model, key) for key in keys.union(shape.fields))))
+    return options
+
+def query_for(db: Session, model, schema=None, shape=None):
+    return db.query(model).options(*shape_options(model, schema, shape))
+
+# Request-scoped dataloader. Each request has its own session, so the loader
+# lives in db.info: rows are memoized by (model, shape, id), misses included,
+# so a route and the crud calls it makes share one lookup per row, and
+# load_many resolves every id it has not seen yet in a single IN query. A row
+# loaded with narrowed columns is never handed to a call that asked for
+# another shape. The memo is dropped whenever the session commits or rolls
+# back.
+class DataLoader:
+    def __init__(self, db: Session):
+        self.db = db
+        self.rows = {}
+
+    def load_many(self, model, ids, schema=None, shape=None):
+        missing = [row_id for row_id in dict.fromkeys(ids) if (model, shape, row_id) not in self.rows]
+        if missing:
+            found = {row.id: row for row in query_for(self.db, model, schema, shape).filter(model.id.in_(missing))}
+            for row_id in missing:
+                self.rows[(model, shape, row_id)] = found.get(row_id)
+        return [self.rows[(model, shape, row_id)] for row_id in ids]
+
+    def load(self, model, row_id: int, schema=None):
+        return self.load_many(model, [row_id], schema)[0]
+
+def get_loader(db: Session):
+    loader = db.info.get("loader")
+    if loader is None:
+        loader = db.info["loader"] = DataLoader(db)
+    return loader
+
+def forget_loader(db: Session):
+    db.info.pop("loader", None)
+
+event.listen(Session, "after_commit", forget_loader)
+event.listen(Session, "after_rollback", forget_loader)
+
+def get_many(db: Session, model, ids, schema=None, shape=None):
+    ids = list(dict.fromkeys(ids))
+    return [row for row in get_loader(db).load_many(model, ids, schema, shape) if row is not None]
+
+# Keyset pagination keys. Loans page in loan date order, everything else by
+# primary key, so a page is an index range scan instead of an OFFSET scan.
+PAGE_KEYS = {
+    models.User: (models.User.id,),
+    models.Book: (models.Book.id,),
+    models.Category: (models.Category.id,),
+    models.Copy: (models.Copy.id,),
+    models.Loan: (models.Loan.loan_date, models.Loan.id),
+    # Orderings other than a model's own are keyed by name
+    "overdue": (models.Loan.return_date, models.Loan.id),
+}
+
+def pack_cursor(values: list):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def unpack_cursor(cursor: str, length: int):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Invalid cursor")
+    return values
+
+def encode_cursor(model, row):
+    values = []
+    for column in PAGE_KEYS[model]:
+        value = getattr(row, column.key)
+        values.append(value.isoformat() if isinstance(value, datetime) else value)
+    return pack_cursor(values)
+
+def decode_cursor(model, cursor: str):
+    columns = PAGE_KEYS[model]
+    values = unpack_cursor(cursor, len(columns))
+    try:
+        return [
+            None if value is None
+            else datetime.fromisoformat(value) if column.type.python_type is datetime
+            else column.type.python_type(value)
+            for column, value in zip(columns, values)
+        ]
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+def next_cursor(model, rows, limit: int):
+    if not rows or len(rows) < limit:
+        return None
+    return encode_cursor(model, rows[-1])
+
+def page(query, model, skip: int = 0, limit: int = 100, cursor: str = None):
+    columns = PAGE_KEYS[model]
+    if cursor is not None:
+        values = decode_cursor(model, cursor)
+        if len(columns) == 1:
+            query = query.filter(columns[0] > values[0])
+        elif values[0] is None:
+            # SQLite sorts NULL first, so after a row with no date come the
+            # rest of the NULL rows by id, then every dated row
+            key, tiebreak = columns
+            query = query.filter(or_(and_(key.is_(None), tiebreak > values[1]), key.isnot(None)))
+        else:
+            # A NULL key compares as NULL and drops out, as it sorted before
+            query = query.filter(tuple_(*columns) > tuple_(*values))
+    return query.order_by(*columns).offset(skip).limit(limit)
+
+def paginate(query, model, skip: int = 0, limit: int = 100, cursor: str = None):
+    return page(query, model, skip=skip, limit=limit, cursor=cursor).all()
+
+# Passwords are hashed by the caller (see passwords.py), off the request
+# threads, so only the finished hash reaches crud.
+def user_values(user: schemas.UserCreate, password_hash: str = None):
     register_date = datetime.now()
     expiration_date = register_date + timedelta(days=30)
-    db_user = models.User(name=user.name, last_name=user.last_name, email=user.email, phone=user.phone, active=user.active, register_date=register_date, expiration_date=expiration_date)
+    return dict(name=user.name, last_name=user.last_name, email=user.email, phone=user.phone, password=password_hash, active=user.active, register_date=register_date, expiration_date=expiration_date)
+
+# The add_/remove_ functions below stage a write without committing it, for
+# callers that commit several writes together (see writer.py).
+def add_user(db: Session, user: schemas.UserCreate, password_hash: str = None):
+    db_user = models.User(**user_values(user, password_hash))
     db.add(db_user)
+    db.flush()
+    return db_user
+
+def create_user(db: Session, user: schemas.UserCreate, password_hash: str = None):
+    db_user = add_user(db, user, password_hash)
     db.commit()
     db.refresh(db_user)
     return db_user
@@ -19,7 +238,11 @@ def update_user(db: Session, user_id: int, user: schemas.UserUpdate):
     db_user.email = user.email
     db_user.phone = user.phone
     db_user.active = user.active
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise ValueError("Email already registered")
     db.refresh(db_user)
     return db_user
 
@@ -28,39 +251,107 @@ def delete_user(db: Session, user_id: int):
     db.commit()
 
 def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+    return query_for(db, models.User, schemas.User).filter(models.User.email == email).first()
+
+def update_password_hash(db: Session, user_id: int, password_hash: str):
+    db.query(models.User).filter(models.User.id == user_id).update({models.User.password: password_hash}, synchronize_session=False)
+    db.commit()
 
-def get_user_by_id(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
+def get_user_by_id(db: Session, user_id: int, shape=None):
+    return query_for(db, models.User, schemas.User, shape).filter(models.User.id == user_id).first()
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+def get_users_by_ids(db: Session, user_ids: list, shape=None):
+    return get_many(db, models.User, user_ids, schemas.User, shape)
+
+def get_users(db: Session, skip: int = 0, limit: int = 100, cursor: str = None, shape=None):
+    return paginate(query_for(db, models.User, schemas.User, shape), models.User, skip=skip, limit=limit, cursor=cursor)
+
+# Cache tags for the catalog entries a write to a book or copy affects. They
+# are looked up before the write and invalidated once it has committed.
+def catalog_tags(db: Session, book_id: int = None, copy_id: int = None):
+    query = db.query(models.Book.id, models.Book.category_id)
+    if copy_id is not None:
+        query = query.join(models.Copy, models.Copy.book_id == models.Book.id).filter(models.Copy.id == copy_id)
+    else:
+        query = query.filter(models.Book.id == book_id)
+    tags = []
+    for row_book_id, category_id in query.all():
+        tags += [f"book:{row_book_id}", f"category:{category_id}"]
+    return tags
 
 def create_book(db: Session, book: schemas.BookCreate):
     db_book = models.Book(title=book.title, author=book.author, editorial=book.editorial, pub_year=book.pub_year, edition=book.edition, category_id=book.category_id)
     db.add(db_book)
     db.commit()
+    catalog_cache.invalidate(f"category:{book.category_id}")
     db.refresh(db_book)
     return db_book
 
 def delete_book(db: Session, book_id: int):
+    tags = catalog_tags(db, book_id=book_id)
     db.query(models.Book).filter(models.Book.id == book_id).delete()
     db.commit()
+    catalog_cache.invalidate(*tags)
 
 def get_books_by_category(db: Session, category_id: int):
-    return db.query(models.Book).filter(models.Book.category_id == category_id).all()
+    return query_for(db, models.Book, schemas.Book).filter(models.Book.category_id == category_id).all()
+
+def get_book_by_id(db: Session, book_id: int, shape=None):
+    return query_for(db, models.Book, schemas.Book, shape).filter(models.Book.id == book_id).first()
 
-def get_book_by_id(db: Session, book_id: int):
-    return db.query(models.Book).filter(models.Book.id == book_id).first()
+def get_books_by_ids(db: Session, book_ids: list, shape=None):
+    return get_many(db, models.Book, book_ids, schemas.Book, shape)
 
-def get_books(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Book).offset(skip).limit(limit).all()
+def get_books(db: Session, skip: int = 0, limit: int = 100, cursor: str = None, shape=None):
+    return paginate(query_for(db, models.Book, schemas.Book, shape), models.Book, skip=skip, limit=limit, cursor=cursor)
 
 def get_books_by_author(db: Session, author: str):
-    return db.query(models.Book).filter(models.Book.author == author).all()
+    return query_for(db, models.Book, schemas.Book).filter(models.Book.author == author).all()
 
 def get_books_by_editorial(db: Session, editorial: str):
-    return db.query(models.Book).filter(models.Book.editorial == editorial).all()
+    return query_for(db, models.Book, schemas.Book).filter(models.Book.editorial == editorial).all()
+
+# Search cost. FTS5 ranks every match of a query before it can order them,
+# and every page runs the MATCH again, so the ranking only looks at the first
+# SEARCH_MAX_MATCHES matches in id order. A last word shorter than the
+# smallest prefix index of books_fts is matched whole, since a prefix of one
+# character would merge the postings of every term it starts.
+SEARCH_MAX_MATCHES = int(os.environ.get("LIBRARY_SEARCH_MAX_MATCHES", "1000"))
+SEARCH_MIN_PREFIX = 2
+
+def fts_query(q: str):
+    # Every word must match; the last one as a prefix for type-ahead. Words
+    # are quoted so user input can never inject FTS5 query syntax.
+    words = re.findall(r"\w+", q)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    if len(words[-1]) >= SEARCH_MIN_PREFIX:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+def search_books(db: Session, q: str, limit: int = 20, cursor: str = None):
+    # Returns (books, next_cursor), best bm25 rank first. The cursor is the
+    # (rank, id) of the last row: each page matches and ranks the same
+    # capped set again and keeps the rows after it.
+    match = fts_query(q)
+    if match is None:
+        return [], None
+    after_rank, after_id = unpack_cursor(cursor, 2) if cursor is not None else (float("-inf"), 0)
+    try:
+        after_rank, after_id = float(after_rank), int(after_id)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+    ranked = db.execute(
+        text(
+            "SELECT id, rank FROM (SELECT rowid AS id, rank FROM books_fts WHERE books_fts MATCH :match LIMIT :matches) "
+            "WHERE (rank, id) > (:rank, :id) ORDER BY rank, id LIMIT :limit"
+        ),
+        {"match": match, "matches": SEARCH_MAX_MATCHES, "rank": after_rank, "id": after_id, "limit": limit},
+    ).all()
+    books = {book.id: book for book in query_for(db, models.Book, schemas.Book).filter(models.Book.id.in_([row.id for row in ranked]))}
+    next_page = pack_cursor([ranked[-1].rank, ranked[-1].id]) if len(ranked) == limit else None
+    return [books[row.id] for row in ranked if row.id in books], next_page
 
 def create_category(db: Session, category: schemas.CategoryCreate):
     db_category = models.Category(name=category.name)
@@ -72,65 +363,271 @@ def create_category(db: Session, category: schemas.CategoryCreate):
 def delete_category(db: Session, category_id: int):
     db.query(models.Category).filter(models.Category.id == category_id).delete()
     db.commit()
+    catalog_cache.invalidate(f"category:{category_id}")
     
-def get_category(db: Session, category_id: int):
-    return db.query(models.Category).filter(models.Category.id == category_id).first()
+def get_category(db: Session, category_id: int, shape=None):
+    return query_for(db, models.Category, schemas.Category, shape).filter(models.Category.id == category_id).first()
 
-def get_categories(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Category).offset(skip).limit(limit).all()
+def get_categories(db: Session, skip: int = 0, limit: int = 100, cursor: str = None, shape=None):
+    return paginate(query_for(db, models.Category, schemas.Category, shape), models.Category, skip=skip, limit=limit, cursor=cursor)
 
 def get_category_by_name(db: Session, name: str):
-    return db.query(models.Category).filter(models.Category.name == name).first()
+    return query_for(db, models.Category, schemas.Category).filter(models.Category.name == name).first()
 
-def create_copy(db: Session, copy: schemas.CopyCreate):
+def add_copy(db: Session, copy: schemas.CopyCreate):
     db_copy = models.Copy(available=copy.available, atention=copy.atention, book_id=copy.book_id)
     db.add(db_copy)
+    db.flush()
+    return db_copy, catalog_tags(db, book_id=copy.book_id)
+
+def create_copy(db: Session, copy: schemas.CopyCreate):
+    db_copy, tags = add_copy(db, copy)
     db.commit()
+    catalog_cache.invalidate(*tags)
     db.refresh(db_copy)
     return db_copy
 
 def delete_copy(db: Session, copy_id: int):
+    tags = catalog_tags(db, copy_id=copy_id)
     db.query(models.Copy).filter(models.Copy.id == copy_id).delete()
     db.commit()
+    catalog_cache.invalidate(*tags)
 
 def update_copy_not_available(db: Session, copy_id: int):
-    db_copy = db.query(models.Copy).filter(models.Copy.id == copy_id).first()
+    db_copy = get_copy(db, copy_id=copy_id)
     db_copy.available = False
+    tags = catalog_tags(db, copy_id=copy_id)
     db.commit()
+    catalog_cache.invalidate(*tags)
     db.refresh(db_copy)
     return db_copy
 
 def get_copy(db: Session, copy_id: int):
-    return db.query(models.Copy).filter(models.Copy.id == copy_id).first()
+    return get_loader(db).load(models.Copy, copy_id)
+
+def get_copies_by_ids(db: Session, copy_ids: list, shape=None):
+    return get_many(db, models.Copy, copy_ids, shape=shape)
 
 def get_copies_by_book(db: Session, book_id: int):
     return db.query(models.Copy).filter(models.Copy.book_id == book_id).all()
 
-def get_copies(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Copy).offset(skip).limit(limit).all()
+def get_copies(db: Session, skip: int = 0, limit: int = 100, cursor: str = None, shape=None):
+    return paginate(query_for(db, models.Copy, shape=shape), models.Copy, skip=skip, limit=limit, cursor=cursor)
+
+def get_books_availability(db: Session, book_ids: list):
+    rows = {row.book_id: row for row in db.query(models.BookAvailability).filter(models.BookAvailability.book_id.in_(book_ids))}
+    return [rows.get(book_id) or models.BookAvailability(book_id=book_id, total=0, available=0, attention=0) for book_id in book_ids]
+
+# Tables whose triggers bump their row in table_versions on every write
+VERSIONED_TABLES = ("books", "categories", "copies")
+
+def get_table_versions(db: Session, tables):
+    versions = dict(db.query(models.TableVersion.name, models.TableVersion.version).filter(models.TableVersion.name.in_(tables)))
+    return tuple(versions.get(table, 0) for table in tables)
+
+def reconcile_availability(db: Session):
+    # Rebuilds the counters the copies triggers maintain, from scratch.
+    db.execute(text("DELETE FROM book_availability"))
+    db.execute(text(
+        "INSERT INTO book_availability (book_id, total, available, attention) "
+        "SELECT book_id, COUNT(*), SUM(IFNULL(available AND NOT atention, 0)), SUM(IFNULL(atention, 0)) "
+        "FROM copies GROUP BY book_id"
+    ))
 
 def get_copies_available_by_book(db: Session, book_id: int):
     return db.query(models.Copy).filter(models.Copy.book_id == book_id, models.Copy.available == True, models.Copy.atention == False).all()
 
 def create_loan(db: Session, loan: schemas.LoanCreate):
-    db_loan = models.Loan(loan_date=loan.loan_date, return_date=loan.return_date, user_id=loan.user_id, copy_id=loan.copy_id)
+    db_loan = models.Loan(loan_date=loan.loan_date, return_date=loan.return_date, user_id=loan.user_id, copy_id=loan.copy_id, overdue=loan_overdue(loan.return_date))
     db.add(db_loan)
     db.commit()
     db.refresh(db_loan)
     return db_loan
 
+MAX_ACTIVE_LOANS = 3
+OVERDUE_WATERMARK = "overdue"
+
+def loan_overdue(return_date: datetime, now: datetime = None):
+    return return_date is not None and return_date < (now or datetime.now())
+
+def has_overdue_loans(db: Session, user_id: int):
+    # Primary key lookup on the summary the loans triggers keep
+    return db.query(models.UserOverdue.user_id).filter(models.UserOverdue.user_id == user_id, models.UserOverdue.overdue > 0).first() is not None
+
+def mark_overdue(db: Session, now: datetime = None, batch_size: int = 500):
+    # Flags the active loans whose return date passed since the previous run.
+    # The watermark is where that run stopped, so only the new range of
+    # ix_loans_active_return_date is walked, in batched UPDATEs committed one
+    # at a time to keep the write lock short; the loans triggers keep
+    # user_overdue in step. Loans written with a return date that has
+    # already passed are flagged on write, since the scan will not reach them.
+    now = now or datetime.now()
+    watermark = db.get(models.Watermark, OVERDUE_WATERMARK)
+    since = watermark.value if watermark is not None else datetime.min
+    marked = 0
+    while True:
+        rows = (
+            db.query(models.Loan.id, models.Loan.return_date)
+            .filter(models.Loan.active == True, models.Loan.return_date >= since, models.Loan.return_date < now, models.Loan.overdue.isnot(True))
+            .order_by(models.Loan.return_date)
+            .limit(batch_size)
+            .all()
+        )
+        if rows:
+            db.execute(
+                update(models.Loan)
+                .where(models.Loan.id.in_([row.id for row in rows]))
+                .values(overdue=True)
+                .execution_options(synchronize_session=False)
+            )
+            marked += len(rows)
+            since = rows[-1].return_date
+        if len(rows) < batch_size:
+            break
+        db.commit()
+    db.merge(models.Watermark(name=OVERDUE_WATERMARK, value=now))
+    db.commit()
+    return marked
+
+def reconcile_overdue(db: Session):
+    # Rebuilds the per-user counts the loans triggers maintain, from scratch.
+    db.execute(text("DELETE FROM user_overdue"))
+    db.execute(text(
+        "INSERT INTO user_overdue (user_id, overdue) "
+        "SELECT user_id, COUNT(*) FROM loans WHERE active AND overdue GROUP BY user_id"
+    ))
+
+def get_overdue_loans(db: Session, skip: int = 0, limit: int = 100, cursor: str = None):
+    # Read off ix_loans_active_return_date by date, so the list does not wait
+    # for the next mark_overdue run
+    query = db.query(models.Loan).filter(models.Loan.active == True, models.Loan.return_date < datetime.now())
+    return paginate(query, "overdue", skip=skip, limit=limit, cursor=cursor)
+
+# Circulation rollups. Triggers on loans count every loan in copy_loans,
+# book_loans and category_month_loans once, when it is written, towards the
+# category its book has then; a returned (deleted) or archived loan stays in
+# the totals and only leaves the active counts. Edits to a loan move it
+# between rows. Returned loans are kept in loans_returned and archived ones
+# in loans_archive, so rebuild_loan_stats recomputes every rollup exactly
+# from the live loans and those two, and overwrites what the triggers left.
+def rebuild_loan_stats(db: Session):
+    loans = (
+        "(SELECT copy_id, active, loan_date, return_date FROM loans "
+        "UNION ALL SELECT copy_id, active, loan_date, return_date FROM loans_archive "
+        "UNION ALL SELECT copy_id, 0, loan_date, return_date FROM loans_returned) AS loans"
+    )
+    for table in ("copy_loans", "book_loans", "category_month_loans"):
+        db.execute(text(f"DELETE FROM {table}"))
+    db.execute(text(
+        "INSERT INTO copy_loans (copy_id, loans, active, loan_days) "
+        "SELECT copy_id, COUNT(*), SUM(IFNULL(active, 0)), SUM(IFNULL(julianday(return_date) - julianday(loan_date), 0)) "
+        f"FROM {loans} WHERE copy_id IS NOT NULL GROUP BY copy_id"
+    ))
+    db.execute(text(
+        "INSERT INTO book_loans (book_id, loans, active) "
+        "SELECT copies.book_id, COUNT(*), SUM(IFNULL(loans.active, 0)) "
+        f"FROM {loans} JOIN copies ON copies.id = loans.copy_id "
+        "WHERE copies.book_id IS NOT NULL GROUP BY copies.book_id"
+    ))
+    db.execute(text(
+        "INSERT INTO category_month_loans (category_id, month, loans) "
+        "SELECT books.category_id, strftime('%Y-%m', loans.loan_date), COUNT(*) "
+        f"FROM {loans} JOIN copies ON copies.id = loans.copy_id JOIN books ON books.id = copies.book_id "
+        "WHERE books.category_id IS NOT NULL AND loans.loan_date IS NOT NULL "
+        "GROUP BY books.category_id, strftime('%Y-%m', loans.loan_date)"
+    ))
+
+def parse_month(month: str):
+    try:
+        return datetime.strptime(month, "%Y-%m").strftime("%Y-%m")
+    except ValueError:
+        raise ValueError("Months must be given as YYYY-MM")
+
+def get_loans_by_category(db: Session, start: str = None, end: str = None, category_id: int = None):
+    stats = models.CategoryMonthLoans
+    query = (
+        db.query(stats.category_id, models.Category.name, stats.month, stats.loans)
+        .join(models.Category, models.Category.id == stats.category_id)
+        .filter(stats.loans > 0)
+    )
+    if start is not None:
+        query = query.filter(stats.month >= parse_month(start))
+    if end is not None:
+        query = query.filter(stats.month <= parse_month(end))
+    if category_id is not None:
+        query = query.filter(stats.category_id == category_id)
+    return query.order_by(stats.month, stats.category_id).all()
+
+def get_top_books(db: Session, limit: int = 10):
+    stats = models.BookLoans
+    return (
+        db.query(stats.book_id, models.Book.title, models.Book.author, stats.loans, stats.active)
+        .join(models.Book, models.Book.id == stats.book_id)
+        .filter(stats.loans > 0)
+        .order_by(stats.loans.desc(), stats.book_id.desc())
+        .limit(limit)
+        .all()
+    )
+
+def get_copy_utilization(db: Session, book_id: int = None, limit: int = 100):
+    stats = models.CopyLoans
+    query = (
+        db.query(stats.copy_id, models.Copy.book_id, stats.loans, stats.active, stats.loan_days)
+        .join(models.Copy, models.Copy.id == stats.copy_id)
+        .filter(stats.loans > 0)
+    )
+    if book_id is not None:
+        query = query.filter(models.Copy.book_id == book_id)
+    return query.order_by(stats.loan_days.desc(), stats.copy_id.desc()).limit(limit).all()
+
+def add_loan(db: Session, loan: schemas.LoanCreate):
+    # Count the user's active loans, claim the copy with a conditional UPDATE
+    # so two checkouts can never both get it, and insert the loan. The
+    # response is built here so the row does not have to be read back. On a
+    # ValueError the caller rolls back.
+    if has_overdue_loans(db, loan.user_id):
+        raise ValueError("User has overdue loans")
+    active_loans = db.query(func.count(models.Loan.id)).filter(models.Loan.user_id == loan.user_id, models.Loan.active == True).scalar()
+    if active_loans >= MAX_ACTIVE_LOANS:
+        raise ValueError("User has reached the maximum number of loans")
+    claimed = db.execute(
+        update(models.Copy)
+        .where(models.Copy.id == loan.copy_id, models.Copy.available == True)
+        .values(available=False)
+        .execution_options(synchronize_session=False)
+    )
+    if claimed.rowcount != 1:
+        raise ValueError("Copy not available")
+    db_loan = models.Loan(loan_date=loan.loan_date, return_date=loan.return_date, user_id=loan.user_id, copy_id=loan.copy_id, active=True, overdue=loan_overdue(loan.return_date))
+    db.add(db_loan)
+    db.flush()
+    return schemas.Loan.from_orm(db_loan), catalog_tags(db, copy_id=loan.copy_id)
+
+def checkout_loan(db: Session, loan: schemas.LoanCreate):
+    # One transaction and one commit for the whole checkout
+    try:
+        checked_out, tags = add_loan(db, loan)
+    except ValueError:
+        db.rollback()
+        raise
+    db.commit()
+    catalog_cache.invalidate(*tags)
+    return checked_out
+
 def update_loan(db: Session, loan_id: int, loan: schemas.LoanUpdate):
-    db_loan = db.query(models.Loan).filter(models.Loan.id == loan_id).first()
+    db_loan = get_loan(db, loan_id=loan_id)
     db_loan.loan_date = loan.loan_date
     db_loan.return_date = loan.return_date
+    db_loan.overdue = loan_overdue(loan.return_date)
     db.commit()
     db.refresh(db_loan)
     return db_loan
 
 def update_loan_status(db: Session, loan_id: int):
-    db_loan = db.query(models.Loan).filter(models.Loan.id == loan_id).first()
+    db_loan = get_loan(db, loan_id=loan_id)
     if db_loan.active == False:
         db_loan.active = True
+        db_loan.overdue = loan_overdue(db_loan.return_date)
     else:
         db_loan.active = False
     db.commit()
@@ -140,19 +637,140 @@ def update_loan_status(db: Session, loan_id: int):
 def delete_loan(db: Session, loan_id: int):
     db.query(models.Loan).filter(models.Loan.id == loan_id).delete()
     db.commit()
+
+def remove_loan(db: Session, loan_id: int):
+    # The DELETE /loans/{loan_id} route as one staged write: the loan's copy
+    # is updated as update_copy_not_available does and the loan is deleted.
+    db_loan = get_loan(db, loan_id=loan_id)
+    if db_loan is None:
+        raise LookupError("Loan not found")
+    tags = catalog_tags(db, copy_id=db_loan.copy_id)
+    db_copy = get_copy(db, copy_id=db_loan.copy_id)
+    if db_copy is not None:
+        db_copy.available = False
+    db.query(models.Loan).filter(models.Loan.id == loan_id).delete()
+    db.flush()
+    return tags
     
 def get_loan(db: Session, loan_id: int):
-    return db.query(models.Loan).filter(models.Loan.id == loan_id).first()
+    return get_loader(db).load(models.Loan, loan_id)
 
-def get_loans(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Loan).offset(skip).limit(limit).all()
+def get_loans_by_ids(db: Session, loan_ids: list, shape=None):
+    return get_many(db, models.Loan, loan_ids, shape=shape)
 
-def get_loans_by_user(db: Session, user_id: int):
-    return db.query(models.Loan).filter(models.Loan.user_id == user_id).all()
+def get_loans(db: Session, skip: int = 0, limit: int = 100, cursor: str = None, shape=None):
+    return paginate(query_for(db, models.Loan, shape=shape), models.Loan, skip=skip, limit=limit, cursor=cursor)
+
+# history=True adds the user's (or copy's) archived loans after the live ones
+def get_loans_by_user(db: Session, user_id: int, history: bool = False):
+    loans = db.query(models.Loan).filter(models.Loan.user_id == user_id).all()
+    if history:
+        loans += db.query(models.LoanArchive).filter(models.LoanArchive.user_id == user_id).all()
+    return loans
 
 def get_active_loans_by_user(db: Session, user_id: int):
     return db.query(models.Loan).filter(models.Loan.user_id == user_id, models.Loan.active == True).all()
 
-
-def get_loans_by_copy(db: Session, copy_id: int):
-    return db.query(models.Loan).filter(models.Loan.copy_id == copy_id).all()
\ No newline at end of file
+def get_loans_by_copy(db: Session, copy_id: int, history: bool = False):
+    loans = db.query(models.Loan).filter(models.Loan.copy_id == copy_id).all()
+    if history:
+        loans += db.query(models.LoanArchive).filter(models.LoanArchive.copy_id == copy_id).all()
+    return loans
+
+ARCHIVED_COLUMNS = ("id", "copy_id", "user_id", "loan_date", "active", "return_date", "overdue")
+
+def archive_loan_batch(db: Session, before: datetime, batch_size: int = 1000):
+    # Moves up to batch_size inactive loans returned before `before` into
+    # loans_archive and commits, so the write lock is held for one batch at a
+    # time; returns how many were moved. Only returned loans are archived,
+    # so the rollups are left as they are. The archiving row is there only
+    # while the batch deletes, so the change log records those deletes as
+    # 'archive', not 'delete', and they are not copied to loans_returned.
+    ids = [
+        row.id for row in db.query(models.Loan.id)
+        .filter(models.Loan.active == False, models.Loan.return_date < before)
+        .order_by(models.Loan.return_date)
+        .limit(batch_size)
+    ]
+    if not ids:
+        return 0
+    columns = [getattr(models.Loan, name) for name in ARCHIVED_COLUMNS]
+    db.execute(
+        insert(models.LoanArchive).from_select(
+            [*ARCHIVED_COLUMNS, "archived_at"],
+            select(*columns, literal(datetime.now(), DateTime)).where(models.Loan.id.in_(ids)),
+        )
+    )
+    db.execute(insert(models.Archiving).values(id=1))
+    db.execute(delete(models.Loan).where(models.Loan.id.in_(ids)).execution_options(synchronize_session=False))
+    db.execute(delete(models.Archiving))
+    db.commit()
+    return len(ids)
+
+# Change log. Triggers on these tables append every insert, update and
+# delete to changes, whichever path made the write, under a sequence number
+# that only grows; consumers follow it with get_changes instead of re-reading
+# the tables.
+CHANGE_TABLES = ("copies", "loans")
+
+def get_changes(db: Session, since: int, limit: int = 100):
+    return db.query(models.Change).filter(models.Change.seq > since).order_by(models.Change.seq).limit(limit).all()
+
+def get_change_window(db: Session):
+    # (first, last) sequence numbers still in the log, (None, None) when empty
+    return tuple(db.query(func.min(models.Change.seq), func.max(models.Change.seq)).one())
+
+def compact_change_batch(db: Session, before: datetime, batch_size: int = 1000):
+    # Deletes up to batch_size of the oldest changes recorded before `before`
+    # and commits; returns how many went. Sequence numbers follow time, so
+    # this is a range delete on the primary key. The newest change always
+    # stays, so the first retained number tells consumers where the gap is.
+    first, last = get_change_window(db)
+    if first is None:
+        return 0
+    deleted = (
+        db.query(models.Change)
+        .filter(models.Change.seq < min(first + batch_size, last), models.Change.changed_at < before)
+        .delete(synchronize_session=False)
+    )
+    db.commit()
+    return deleted
+
+def bulk_insert(db: Session, model, rows: list, on_inserted=None):
+    # rows are (row_number, values) pairs. The whole chunk goes in as one
+    # executemany; if a constraint fails, it is retried row by row inside
+    # savepoints so only the offending rows are reported.
+    statement = model.__table__.insert()
+    inserted = [values for _, values in rows]
+    errors = []
+    try:
+        db.execute(statement, inserted)
+    except IntegrityError:
+        db.rollback()
+        inserted = []
+        for row_number, values in rows:
+            try:
+                with db.begin_nested():
+                    db.execute(statement, values)
+                inserted.append(values)
+            except IntegrityError as e:
+                errors.append({"row": row_number, "error": str(e.orig)})
+    if on_inserted is not None and inserted:
+        on_inserted(db, inserted)
+    db.commit()
+    if inserted and model in (models.Book, models.Copy, models.Loan):
+        catalog_cache.clear()
+    return len(inserted), errors
+
+def loan_values(loan: schemas.LoanCreate):
+    return dict(loan.dict(), overdue=loan_overdue(loan.return_date))
+
+def claim_loaned_copies(db: Session, loans: list):
+    copy_ids = [loan["copy_id"] for loan in loans if loan["active"]]
+    if copy_ids:
+        db.execute(
+            update(models.Copy)
+            .where(models.Copy.id.in_(copy_ids))
+            .values(available=False)
+            .execution_options(synchronize_session=False)
+        )
@@ -1,12 +1,109 @@
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./library-project.db"
+ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./library-project.db"
+
+# Set LIBRARY_DB_MODE=async to serve requests through the aiosqlite engine.
+DB_MODE = os.environ.get("LIBRARY_DB_MODE", "sync")
+ASYNC_MODE = DB_MODE == "async"
+
+# Pragmas applied to every new connection, each overridable through a
+# LIBRARY_SQLITE_<NAME> environment variable. WAL lets readers keep going
+# while a write commits; NORMAL only fsyncs at checkpoints in WAL mode.
+SQLITE_PRAGMAS = {
+    name: os.environ.get(f"LIBRARY_SQLITE_{name.upper()}", default)
+    for name, default in {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": "5000",
+        "cache_size": "-65536",
+        "mmap_size": "268435456",
+    }.items()
+}
+WRITE_POOL_SIZE = int(os.environ.get("LIBRARY_WRITE_POOL_SIZE", "1"))
+READ_POOL_SIZE = int(os.environ.get("LIBRARY_READ_POOL_SIZE", "8"))
+
+def apply_pragmas(dbapi_connection, read_only: bool = False):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        if read_only and name == "journal_mode":
+            continue
+        cursor.execute(f"PRAGMA {name}={value}")
+    if read_only:
+        cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+def configure_write_engine(sync_engine):
+    # The driver's implicit transactions are replaced with BEGIN IMMEDIATE so
+    # a writer takes the lock up front and waits on busy_timeout, instead of
+    # failing with "database is locked" when upgrading a read transaction.
+    @event.listens_for(sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        apply_pragmas(dbapi_connection)
+
+    @event.listens_for(sync_engine, "begin")
+    def on_begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
 
+def configure_read_engine(sync_engine):
+    @event.listens_for(sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, read_only=True)
+
+# SQLite allows a single writer, so by default writes share one pooled
+# connection and queue on the pool; reads get their own pool of query-only
+# connections.
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=WRITE_POOL_SIZE,
+    max_overflow=0,
 )
+configure_write_engine(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+read_engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=READ_POOL_SIZE,
+    max_overflow=READ_POOL_SIZE,
+)
+configure_read_engine(read_engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+async_engine = None
+AsyncSessionLocal = None
+async_read_engine = None
+AsyncReadSessionLocal = None
+if ASYNC_MODE:
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+    async_engine = create_async_engine(ASYNC_DATABASE_URL)
+    configure_write_engine(async_engine.sync_engine)
+    AsyncSessionLocal = sessionmaker(
+        async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+    )
+
+    # GET routes read through their own query-only pool, so they never take
+    # the write lock with BEGIN IMMEDIATE
+    async_read_engine = create_async_engine(
+        ASYNC_DATABASE_URL,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=READ_POOL_SIZE,
+        max_overflow=READ_POOL_SIZE,
+    )
+    configure_read_engine(async_read_engine.sync_engine)
+    AsyncReadSessionLocal = sessionmaker(
+        async_read_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+    )
+
+Base = declarative_base()
@@ -0,0 +1,54 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+from sqlalchemy import select
+
+from . import models
+from .database import read_engine
+
+# Streamed exports for /export/{table}. Rows come straight off a server-side
+# cursor as plain tuples, EXPORT_CHUNK at a time, and are encoded chunk by
+# chunk, so memory stays flat however large the table is.
+EXPORT_CHUNK = 1000
+
+TABLES = {
+    "loans": (models.Loan, ["id", "copy_id", "user_id", "loan_date", "return_date", "active", "overdue"]),
+    "copies": (models.Copy, ["id", "book_id", "available", "atention"]),
+    "users": (models.User, ["id", "name", "last_name", "email", "phone", "active", "register_date", "expiration_date"]),
+    "books": (models.Book, ["id", "title", "author", "editorial", "pub_year", "edition", "category_id"]),
+    "categories": (models.Category, ["id", "name"]),
+}
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+def encode_value(value):
+    # Same datetime format as the JSON responses of the API
+    if isinstance(value, datetime):
+        return value.isoformat() + "Z"
+    return value
+
+def encode_ndjson(columns, rows):
+    return "".join(
+        json.dumps(dict(zip(columns, map(encode_value, row)))) + "\n" for row in rows
+    ).encode()
+
+def encode_csv(columns, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([map(encode_value, row) for row in rows])
+    return buffer.getvalue().encode()
+
+def stream_table(table: str, format: str = "ndjson", bind=None):
+    model, columns = TABLES[table]
+    encode = encode_csv if format == "csv" else encode_ndjson
+    if format == "csv":
+        yield encode_csv(columns, [columns])
+    statement = select(*(getattr(model, column) for column in columns)).order_by(model.id)
+    with (bind or read_engine).connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(statement)
+        for rows in result.partitions(EXPORT_CHUNK):
+            yield encode(columns, rows)
@@ -0,0 +1,123 @@
+import csv
+import json
+
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from sqlalchemy.orm import Session
+
+from . import crud, models, passwords, schemas
+
+# Streamed bulk ingest for the /<table>/bulk routes. Bodies are NDJSON by
+# default or CSV with a header row when sent as text/csv. Rows are validated
+# against the matching *Create schema and inserted CHUNK_SIZE at a time, one
+# transaction per chunk; invalid rows are reported, never abort the batch.
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+
+def user_values(user: schemas.UserCreate):
+    # The plain password is swapped for its hash by hash_passwords below
+    return crud.user_values(user, password_hash=user.password)
+
+async def hash_passwords(chunk):
+    hashed = await passwords.pool.hash_many([values["password"] for _, values in chunk])
+    for (_, values), password_hash in zip(chunk, hashed):
+        values["password"] = password_hash
+
+# table: (model, schema, to_values, before_insert, on_inserted)
+TABLES = {
+    "books": (models.Book, schemas.BookCreate, lambda book: book.dict(), None, None),
+    "copies": (models.Copy, schemas.CopyCreate, lambda copy: copy.dict(), None, None),
+    "users": (models.User, schemas.UserCreate, user_values, hash_passwords, None),
+    "loans": (models.Loan, schemas.LoanCreate, crud.loan_values, None, crud.claim_loaned_copies),
+}
+
+async def lines(request: Request):
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *complete, buffer = buffer.split(b"\n")
+        for line in complete:
+            yield line.decode("utf-8")
+    if buffer:
+        yield buffer.decode("utf-8")
+
+async def records(request: Request):
+    # Yields (row_number, dict) per record, or (row_number, error) for rows
+    # that cannot be parsed at all.
+    if request.headers.get("content-type", "").startswith("text/csv"):
+        header = None
+        pending = ""
+        row_number = 0
+        async for line in lines(request):
+            # A quoted field may contain newlines; keep reading until the
+            # quotes balance before handing the record to the csv module.
+            pending = f"{pending}\n{line}" if pending else line
+            if pending.count('"') % 2:
+                continue
+            record, pending = pending.rstrip("\r"), ""
+            if not record:
+                continue
+            values = next(csv.reader([record]))
+            if header is None:
+                header = values
+                continue
+            row_number += 1
+            if len(values) != len(header):
+                yield row_number, f"Expected {len(header)} columns, got {len(values)}"
+                continue
+            # Empty cells fall back to the schema defaults.
+            yield row_number, {key: value for key, value in zip(header, values) if value != ""}
+        return
+    row_number = 0
+    async for line in lines(request):
+        if not line.strip():
+            continue
+        row_number += 1
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield row_number, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield row_number, "Expected a JSON object"
+            continue
+        yield row_number, record
+
+async def bulk_ingest(request: Request, db: Session, table: str):
+    model, schema, to_values, before_insert, on_inserted = TABLES[table]
+    inserted = 0
+    failed = 0
+    errors = []
+
+    def report(row_number: int, error):
+        nonlocal failed
+        failed += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({"row": row_number, "error": error})
+
+    async def flush(chunk):
+        nonlocal inserted
+        if before_insert is not None:
+            await before_insert(chunk)
+        chunk_inserted, chunk_errors = await run_in_threadpool(crud.bulk_insert, db, model, chunk, on_inserted)
+        inserted += chunk_inserted
+        for error in chunk_errors:
+            report(error["row"], error["error"])
+
+    chunk = []
+    async for row_number, record in records(request):
+        if isinstance(record, str):
+            report(row_number, record)
+            continue
+        try:
+            chunk.append((row_number, to_values(schema.parse_obj(record))))
+        except ValidationError as e:
+            report(row_number, e.errors())
+            continue
+        if len(chunk) >= CHUNK_SIZE:
+            await flush(chunk)
+            chunk = []
+    if chunk:
+        await flush(chunk)
+    return {"inserted": inserted, "failed": failed, "errors": errors}
@@ -0,0 +1,185 @@
+import asyncio
+import functools
+import logging
+import os
+import re
+import time
+from contextvars import ContextVar
+
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+
+# Per-request SQL and timing instrumentation. Engine events add every
+# query's duration to the stats of the request running it, TimedRoute marks
+# when the endpoint returned so the rest until the response starts counts as
+# serialization, and the middleware turns the stats into a Server-Timing
+# header and per-route Prometheus metrics. Set LIBRARY_INSTRUMENTATION=0 to
+# leave all of it out.
+ENABLED = os.environ.get("LIBRARY_INSTRUMENTATION", "1") != "0"
+SLOW_QUERY_SECONDS = float(os.environ.get("LIBRARY_SLOW_QUERY_MS", "100")) / 1000
+# Longest parameter repr a slow query warning carries
+SLOW_QUERY_PARAMETERS_CHARS = 200
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger("library.sql")
+request_stats = ContextVar("request_stats", default=None)
+
+class RequestStats:
+    __slots__ = ("started", "queries", "db_time", "endpoint_done")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.endpoint_done = None
+
+def explain(conn, statement: str, parameters):
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+        return "; ".join(str(row[-1]) for row in cursor.fetchall())
+    except Exception as e:
+        return f"unavailable ({e})"
+    finally:
+        cursor.close()
+
+def logged_parameters(statement: str, parameters, executemany: bool):
+    # Batches are logged by size only, and nothing bound next to a password
+    # column ever reaches the log
+    if executemany:
+        return f"<{len(parameters)} rows>"
+    if re.search(r"\bpassword\b", statement, re.IGNORECASE):
+        return "<redacted>"
+    logged = repr(parameters)
+    if len(logged) > SLOW_QUERY_PARAMETERS_CHARS:
+        logged = logged[:SLOW_QUERY_PARAMETERS_CHARS] + "..."
+    return logged
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    stats = request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+    if elapsed >= SLOW_QUERY_SECONDS:
+        plan = "executemany" if executemany else explain(conn, statement, parameters)
+        logger.warning(
+            "Slow query (%.1f ms): %s parameters=%s plan=%s",
+            elapsed * 1000, statement, logged_parameters(statement, parameters, executemany), plan,
+        )
+
+def handle_error(context):
+    # A statement that raised never reaches after_cursor_execute
+    if context.connection is not None and context.execution_context is not None:
+        started = context.connection.info.get("query_started")
+        if started:
+            started.pop()
+
+def instrument_engine(sync_engine):
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(sync_engine, "handle_error", handle_error)
+
+def mark_endpoint_done():
+    stats = request_stats.get()
+    if stats is not None:
+        stats.endpoint_done = time.perf_counter()
+
+class TimedRoute(APIRoute):
+    def __init__(self, path: str, endpoint, **kwargs):
+        if asyncio.iscoroutinefunction(endpoint):
+            @functools.wraps(endpoint)
+            async def timed_endpoint(*args, **kwargs):
+                try:
+                    return await endpoint(*args, **kwargs)
+                finally:
+                    mark_endpoint_done()
+        else:
+            @functools.wraps(endpoint)
+            def timed_endpoint(*args, **kwargs):
+                try:
+                    return endpoint(*args, **kwargs)
+                finally:
+                    mark_endpoint_done()
+        super().__init__(path, timed_endpoint, **kwargs)
+
+class Histogram:
+    __slots__ = ("counts", "total", "count", "queries", "db_time")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+        self.queries = 0
+        self.db_time = 0.0
+
+    def observe(self, seconds: float, stats: RequestStats):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.total += seconds
+        self.count += 1
+        self.queries += stats.queries
+        self.db_time += stats.db_time
+
+# (method, route path, status) -> Histogram. Only touched from the event loop.
+histograms = {}
+
+def render_metrics():
+    lines = [
+        "# HELP http_request_duration_seconds Time until the response starts, per route.",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for (method, route, status), histogram in sorted(histograms.items()):
+        labels = f'method="{method}",route="{route}",status="{status}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram.counts):
+            cumulative += count
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+        lines.append(f"http_request_duration_seconds_sum{{{labels}}} {histogram.total}")
+        lines.append(f"http_request_duration_seconds_count{{{labels}}} {histogram.count}")
+    lines += ["# HELP db_queries_total SQL statements executed, per route.", "# TYPE db_queries_total counter"]
+    for (method, route, status), histogram in sorted(histograms.items()):
+        lines.append(f'db_queries_total{{method="{method}",route="{route}",status="{status}"}} {histogram.queries}')
+    lines += ["# HELP db_time_seconds_total Time spent in SQL statements, per route.", "# TYPE db_time_seconds_total counter"]
+    for (method, route, status), histogram in sorted(histograms.items()):
+        lines.append(f'db_time_seconds_total{{method="{method}",route="{route}",status="{status}"}} {histogram.db_time}')
+    return "\n".join(lines) + "\n"
+
+class InstrumentationMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = request_stats.set(stats)
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                now = time.perf_counter()
+                total = now - stats.started
+                serialize = now - stats.endpoint_done if stats.endpoint_done is not None else 0.0
+                timing = (
+                    f'db;dur={stats.db_time * 1000:.2f};desc="{stats.queries} queries", '
+                    f"serialize;dur={serialize * 1000:.2f}, total;dur={total * 1000:.2f}"
+                )
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", timing.encode())]
+                route = scope.get("route")
+                key = (scope["method"], route.path if route is not None else "unmatched", message["status"])
+                histogram = histograms.get(key)
+                if histogram is None:
+                    histogram = histograms[key] = Histogram()
+                histogram.observe(total, stats)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            request_stats.reset(token)
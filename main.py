@@ -1,16 +1,30 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.openapi.utils import get_openapi
 
 from sqlalchemy.orm import Session
 
-from . import crud, models, schemas
-from .database import SessionLocal, engine
+import hashlib
+import queue
 
-models.Base.metadata.create_all(bind=engine)
+from . import changes, crud, export, ingest, instrumentation, models, overdue, passwords, schemas, serializers, startup, writer
+from .cache import catalog_cache
+from .database import ASYNC_MODE, ReadSessionLocal, SessionLocal, async_engine, async_read_engine, engine, read_engine
 
 app = FastAPI()
 
+if instrumentation.ENABLED:
+    # Must be set before the routes below are declared
+    app.router.route_class = instrumentation.TimedRoute
+    app.add_middleware(instrumentation.InstrumentationMiddleware)
+    instrumentation.instrument_engine(engine)
+    instrumentation.instrument_engine(read_engine)
+    if async_engine is not None:
+        instrumentation.instrument_engine(async_engine.sync_engine)
+        instrumentation.instrument_engine(async_read_engine.sync_engine)
+
 origins = ["*"]
 
 app.add_middleware(
@@ -19,23 +33,53 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "X-Last-Seq"],
 )
 
 def custom_openapi():
     if app.openapi_schema:
         return app.openapi_schema
-    openapi_schema = get_openapi(
-        title="Proyecto Bases de Datos - Biblioteca",
-        version="0.0.1",
-        description="Actuaria - FES Acatlán",
-        routes=app.routes,
-    )
+    fingerprint = startup.openapi_fingerprint(app.routes)
+    openapi_schema = startup.load_openapi(fingerprint)
+    if openapi_schema is None:
+        openapi_schema = get_openapi(
+            title="Proyecto Bases de Datos - Biblioteca",
+            version="0.0.1",
+            description="Actuaria - FES Acatlán",
+            routes=app.routes,
+        )
+        startup.save_openapi(fingerprint, openapi_schema)
 
     app.openapi_schema = openapi_schema
     return app.openapi_schema
 
 app.openapi = custom_openapi
 
+MAX_BATCH_IDS = 500
+
+# Runs before every other startup handler, so nothing touches a database
+# that is not migrated yet
+app.add_event_handler("startup", startup.check_schema)
+
+if writer.ENABLED:
+    app.add_event_handler("startup", writer.group_writer.start)
+    app.add_event_handler("shutdown", writer.group_writer.stop)
+
+app.add_event_handler("startup", passwords.pool.start)
+app.add_event_handler("shutdown", passwords.pool.stop)
+
+if overdue.ENABLED:
+    app.add_event_handler("startup", overdue.scheduler.start)
+    app.add_event_handler("shutdown", overdue.scheduler.stop)
+
+if changes.ENABLED:
+    app.add_event_handler("startup", changes.compactor.start)
+    app.add_event_handler("shutdown", changes.compactor.stop)
+
+# Tables whose rows end up in each conditional GET response
+BOOK_TABLES = ("books", "copies")
+CATEGORY_TABLES = ("categories", "books", "copies")
+
 # Dependency
 def get_db():
     db = SessionLocal()
@@ -43,25 +87,150 @@ def get_db():
         yield db
     finally:
         db.close()
+
+# Dependency for GET routes, served from the read-only connection pool
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def check_cursor(model, cursor: str):
+    if cursor is None:
+        return
+    try:
+        crud.decode_cursor(model, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def set_next_cursor(response: Response, model, rows, limit: int):
+    next_cursor = crud.next_cursor(model, rows, limit)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+def cached(key: str):
+    body = catalog_cache.get(key)
+    if body is not None:
+        return Response(body, media_type="application/json")
+
+def cache_response(key: str, schema, rows, tags, shape=None, generation=()):
+    body = serializers.dumps(serializers.to_content(schema, rows, shape))
+    catalog_cache.set(key, body, tags, generation)
+    return Response(body, media_type="application/json")
+
+def apply_write(operation, *args):
+    try:
+        return writer.group_writer.apply(operation, *args)
+    except queue.Full:
+        raise HTTPException(status_code=503, detail="Write queue is full")
+
+async def apply_write_async(operation, *args):
+    try:
+        return await writer.group_writer.apply_async(operation, *args)
+    except queue.Full:
+        raise HTTPException(status_code=503, detail="Write queue is full")
+
+async def hash_password(password: str):
+    try:
+        return await passwords.pool.hash(password)
+    except queue.Full:
+        raise HTTPException(status_code=503, detail="Too many password operations in progress")
+
+async def verify_password(password: str, stored: str):
+    try:
+        return await passwords.pool.verify(password, stored)
+    except queue.Full:
+        raise HTTPException(status_code=503, detail="Too many password operations in progress")
+
+def parse_ids(ids: str):
+    try:
+        row_ids = [int(row_id) for row_id in ids.split(",") if row_id.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma separated list of integers")
+    if len(row_ids) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} ids per request")
+    return row_ids
+
+def read_shape(schema, fields: str = None, expand: str = None):
+    try:
+        return crud.parse_shape(schema, fields=fields, expand=expand)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def shape_key(key: str, shape):
+    if shape is None:
+        return key
+    return f"{key}?fields={','.join(shape.fields or ())}&expand={','.join(sorted(shape.expand))}"
+
+def make_etag(versions, request: Request):
+    # The versions are read before the rows, so a write in between can only
+    # pair newer rows with an older tag, which costs one extra 200 later.
+    digest = hashlib.blake2b(f"{versions}?{request.url.query}".encode(), digest_size=8).hexdigest()
+    return f'"{digest}"'
+
+def not_modified(request: Request, etag: str):
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return None
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    if "*" in tags or etag in tags:
+        return Response(status_code=304, headers={"ETag": etag})
     
+# The password routes are async so the hash is awaited on passwords.pool
+# without holding a request thread; the database calls go to the threadpool.
+# Hashing comes first so no write transaction is open while it runs.
 @app.post("/users/", response_model=schemas.User, status_code=201, tags=["Users"])
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email) 
+async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+    password_hash = await hash_password(user.password)
+    if writer.ENABLED:
+        try:
+            return await apply_write_async(writer.create_user, user, password_hash)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    db_user = await run_in_threadpool(crud.get_user_by_email, db, email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_user(db=db, user=user)
+    return await run_in_threadpool(crud.create_user, db=db, user=user, password_hash=password_hash)
+
+@app.post("/users/login", response_model=schemas.User, status_code=200, tags=["Users"])
+async def login(credentials: schemas.UserLogin, read_db: Session = Depends(get_read_db), db: Session = Depends(get_db)):
+    db_user = await run_in_threadpool(crud.get_user_by_email, read_db, email=credentials.email)
+    # The read connection goes back to the pool before waiting on the hash;
+    # the user and its loans are already loaded
+    await run_in_threadpool(read_db.close)
+    stored = db_user.password if db_user is not None else None
+    if not await verify_password(credentials.password, stored):
+        raise HTTPException(status_code=401, detail="Invalid email or password")
+    if passwords.needs_rehash(stored):
+        await run_in_threadpool(crud.update_password_hash, db, db_user.id, await hash_password(credentials.password))
+    return serializers.render(schemas.User, db_user)
+
+@app.post("/users/bulk", status_code=200, tags=["Users"])
+async def bulk_create_users(request: Request, db: Session = Depends(get_db)):
+    try:
+        return await ingest.bulk_ingest(request, db, "users")
+    except queue.Full:
+        raise HTTPException(status_code=503, detail="Too many password operations in progress")
 
 @app.get("/users/", response_model=list[schemas.User], status_code=200, tags=["Users"])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    users = crud.get_users(db, skip=skip, limit=limit)
-    return users
+def read_users(skip: int = 0, limit: int = 100, cursor: str = None, fields: str = None, expand: str = None, db: Session = Depends(get_read_db)):
+    check_cursor(models.User, cursor)
+    shape = read_shape(schemas.User, fields, expand)
+    users = crud.get_users(db, skip=skip, limit=limit, cursor=cursor, shape=shape)
+    response = serializers.render(schemas.User, users, shape=shape)
+    set_next_cursor(response, models.User, users, limit)
+    return response
 
 @app.patch("/users/{user_id}", response_model=schemas.User, status_code=200, tags=["Users"])
 def update_user(user_id: int, user: schemas.UserUpdate, db: Session = Depends(get_db)):
     db_user = crud.get_user_by_id(db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return crud.update_user(db=db, user_id=user_id, user=user)
+    try:
+        return crud.update_user(db=db, user_id=user_id, user=user)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.delete("/users/{user_id}", status_code=200, tags=["Users"])
 def delete_user(user_id: int, db: Session = Depends(get_db)):
@@ -72,25 +241,35 @@ def delete_user(user_id: int, db: Session = Depends(get_db)):
     db.commit()
     return {"message": f"User {user_id} deleted"}
 
+@app.get("/users/batch", response_model=list[schemas.User], status_code=200, tags=["Users"])
+def read_users_batch(ids: str, fields: str = None, expand: str = None, db: Session = Depends(get_read_db)):
+    shape = read_shape(schemas.User, fields, expand)
+    return serializers.render(schemas.User, crud.get_users_by_ids(db, user_ids=parse_ids(ids), shape=shape), shape=shape)
+
 @app.get("/users/{user_id}", response_model=schemas.User, status_code=200, tags=["Users"])
-def read_user(user_id: int, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_id(db, user_id=user_id)
+def read_user(user_id: int, fields: str = None, expand: str = None, db: Session = Depends(get_read_db)):
+    shape = read_shape(schemas.User, fields, expand)
+    db_user = crud.get_user_by_id(db, user_id=user_id, shape=shape)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return db_user
+    return serializers.render(schemas.User, db_user, shape=shape)
 
 @app.get("/users/email/{email}", response_model=schemas.User, status_code=200, tags=["Users"])
-def read_user_email(email: str, db: Session = Depends(get_db)):
+def read_user_email(email: str, db: Session = Depends(get_read_db)):
     db_user = crud.get_user_by_email(db, email=email)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return db_user
+    return serializers.render(schemas.User, db_user)
 
 @app.post("/books/", status_code=201, tags=["Books"])
 def create_book(book: schemas.BookCreate, db: Session = Depends(get_db)):
     db_book = crud.create_book(db=db, book=book)
     return db_book
 
+@app.post("/books/bulk", status_code=200, tags=["Books"])
+async def bulk_create_books(request: Request, db: Session = Depends(get_db)):
+    return await ingest.bulk_ingest(request, db, "books")
+
 @app.delete("/books/{book_id}", response_model=schemas.Book, status_code=200, tags=["Books"])
 def delete_book(book_id: int, db: Session = Depends(get_db)):
     db_book = crud.get_book_by_id(db, book_id=book_id)
@@ -100,37 +279,73 @@ def delete_book(book_id: int, db: Session = Depends(get_db)):
     return {"message": f"Book {book_id} deleted"}
 
 @app.get("/books/", response_model=list[schemas.Book], status_code=200, tags=["Books"])
-def read_books(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    books = crud.get_books(db, skip=skip, limit=limit)
-    return books
+def read_books(request: Request, skip: int = 0, limit: int = 100, cursor: str = None, fields: str = None, expand: str = None, db: Session = Depends(get_read_db)):
+    check_cursor(models.Book, cursor)
+    shape = read_shape(schemas.Book, fields, expand)
+    etag = make_etag(crud.get_table_versions(db, BOOK_TABLES), request)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    books = crud.get_books(db, skip=skip, limit=limit, cursor=cursor, shape=shape)
+    response = serializers.render(schemas.Book, books, headers={"ETag": etag}, shape=shape)
+    set_next_cursor(response, models.Book, books, limit)
+    return response
+
+@app.get("/books/availability", response_model=list[schemas.BookAvailability], status_code=200, tags=["Books"])
+def read_books_availability(ids: str, db: Session = Depends(get_read_db)):
+    return crud.get_books_availability(db, book_ids=parse_ids(ids))
+
+@app.get("/books/batch", response_model=list[schemas.Book], status_code=200, tags=["Books"])
+def read_books_batch(ids: str, fields: str = None, expand: str = None, db: Session = Depends(get_read_db)):
+    shape = read_shape(schemas.Book, fields, expand)
+    return serializers.render(schemas.Book, crud.get_books_by_ids(db, book_ids=parse_ids(ids), shape=shape), shape=shape)
+
+# Ranks at most crud.SEARCH_MAX_MATCHES matching books, so a query matching
+# more of the catalog than that should be narrowed with more words
+@app.get("/books/search", response_model=list[schemas.Book], status_code=200, tags=["Books"])
+def search_books(q: str, limit: int = 20, cursor: str = None, db: Session = Depends(get_read_db)):
+    try:
+        books, next_cursor = crud.search_books(db, q=q, limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    response = serializers.render(schemas.Book, books)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response
 
 @app.get("/books/{book_id}", response_model=schemas.Book, status_code=200, tags=["Books"])
-def read_book(book_id: int, db: Session = Depends(get_db)):
-    db_book = crud.get_book_by_id(db, book_id=book_id)
+def read_book(book_id: int, fields: str = None, expand: str = None, db: Session = Depends(get_read_db)):
+    shape = read_shape(schemas.Book, fields, expand)
+    key = shape_key(f"book:{book_id}", shape)
+    response = cached(key)
+    if response is not None:
+        return response
+    generation = catalog_cache.generation(f"book:{book_id}")
+    db_book = crud.get_book_by_id(db, book_id=book_id, shape=shape)
     if db_book is None:
         raise HTTPException(status_code=404, detail="Book not found")
-    return db_book
+    return cache_response(key, schemas.Book, db_book, tags=[f"book:{book_id}"], shape=shape, generation=generation)
 
 @app.get("/books/category/{category_id}", response_model=list[schemas.Book], status_code=200, tags=["Books"])
-def read_books_category(category_id: int, db: Session = Depends(get_db)):
+def read_books_category(category_id: int, db: Session = Depends(get_read_db)):
     db_books = crud.get_books_by_category(db, category_id=category_id)
     if db_books is None:
         raise HTTPException(status_code=404, detail="Book not found")
-    return db_books
+    return serializers.render(schemas.Book, db_books)
 
 @app.get("/books/author/{author}", response_model=list[schemas.Book], status_code=200, tags=["Books"])
-def read_books_title(author: str, db: Session = Depends(get_db)):
+def read_books_title(author: str, db: Session = Depends(get_read_db)):
     db_books = crud.get_books_by_author(db, author=author)
     if db_books is None:
         raise HTTPException(status_code=404, detail="Author not found")
-    return db_books
+    return serializers.render(schemas.Book, db_books)
 
 @app.get("/books/editorial/{editorial}", response_model=list[schemas.Book], status_code=200, tags=["Books"])
-def read_books_editorial(editorial: str, db: Session = Depends(get_db)):
+def read_books_editorial(editorial: str, db: Session = Depends(get_read_db)):
     db_books = crud.get_books_by_editorial(db, editorial=editorial)
     if db_books is None:
         raise HTTPException(status_code=404, detail="Editorial not found")
-    return db_books
+    return serializers.render(schemas.Book, db_books)
 
 @app.post("/categories/", response_model=schemas.Category, status_code=201, tags=["Categories"])
 def create_category(category: schemas.CategoryCreate, db: Session = Depends(get_db)):
@@ -146,29 +361,55 @@ def delete_category(category_id: int, db: Session = Depends(get_db)):
     return {"message": "Category deleted"}
 
 @app.get("/categories/", response_model=list[schemas.Category], status_code=200, tags=["Categories"])
-def read_categories(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    categories = crud.get_categories(db, skip=skip, limit=limit)
-    return categories
+def read_categories(request: Request, skip: int = 0, limit: int = 100, cursor: str = None, fields: str = None, expand: str = None, db: Session = Depends(get_read_db)):
+    check_cursor(models.Category, cursor)
+    shape = read_shape(schemas.Category, fields, expand)
+    etag = make_etag(crud.get_table_versions(db, CATEGORY_TABLES), request)
+    response = not_modified(request, etag)
+    if response is not None:
+        return response
+    categories = crud.get_categories(db, skip=skip, limit=limit, cursor=cursor, shape=shape)
+    response = serializers.render(schemas.Category, categories, headers={"ETag": etag}, shape=shape)
+    set_next_cursor(response, models.Category, categories, limit)
+    return response
 
 @app.get("/categories/{category_id}", response_model=schemas.Category, status_code=200, tags=["Categories"])
-def read_category(category_id: int, db: Session = Depends(get_db)):
-    db_category = crud.get_category(db, category_id=category_id)
+def read_category(category_id: int, fields: str = None, expand: str = None, db: Session = Depends(get_read_db)):
+    shape = read_shape(schemas.Category, fields, expand)
+    key = shape_key(f"category:{category_id}", shape)
+    response = cached(key)
+    if response is not None:
+        return response
+    generation = catalog_cache.generation(f"category:{category_id}")
+    db_category = crud.get_category(db, category_id=category_id, shape=shape)
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
-    return db_category
+    return cache_response(key, schemas.Category, db_category, tags=[f"category:{category_id}"], shape=shape, generation=generation)
 
 @app.get("/categories/name/{name}", response_model=schemas.Category, status_code=200, tags=["Categories"])
-def read_category_name(name: str, db: Session = Depends(get_db)):
+def read_category_name(name: str, db: Session = Depends(get_read_db)):
+    key = f"category_name:{name}"
+    response = cached(key)
+    if response is not None:
+        return response
+    # The category's tag is only known after the query
+    generation = catalog_cache.generation()
     db_category = crud.get_category_by_name(db, name=name)
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
-    return db_category
+    return cache_response(key, schemas.Category, db_category, tags=[f"category:{db_category.id}"], generation=generation)
 
 @app.post("/copies/", response_model=schemas.Copy, status_code=201, tags=["Copies"])
 def create_copy(copy: schemas.CopyCreate, db: Session = Depends(get_db)):
+    if writer.ENABLED:
+        return apply_write(writer.create_copy, copy)
     db_copy = crud.create_copy(db=db, copy=copy)
     return db_copy
 
+@app.post("/copies/bulk", status_code=200, tags=["Copies"])
+async def bulk_create_copies(request: Request, db: Session = Depends(get_db)):
+    return await ingest.bulk_ingest(request, db, "copies")
+
 @app.delete("/copies/{copy_id}", status_code=200, tags=["Copies"])
 def delete_copy(copy_id: int, db: Session = Depends(get_db)):
     db_copy = crud.get_copy(db, copy_id=copy_id)
@@ -178,46 +419,66 @@ def delete_copy(copy_id: int, db: Session = Depends(get_db)):
     return {"message": f"Copy {copy_id} deleted"}
 
 @app.get("/copies/", response_model=list[schemas.Copy], status_code=200, tags=["Copies"])
-def read_copies(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    copies = crud.get_copies(db, skip=skip, limit=limit)
-    return copies
+def read_copies(skip: int = 0, limit: int = 100, cursor: str = None, fields: str = None, db: Session = Depends(get_read_db)):
+    check_cursor(models.Copy, cursor)
+    shape = read_shape(schemas.Copy, fields)
+    copies = crud.get_copies(db, skip=skip, limit=limit, cursor=cursor, shape=shape)
+    response = serializers.render(schemas.Copy, copies, shape=shape)
+    set_next_cursor(response, models.Copy, copies, limit)
+    return response
+
+@app.get("/copies/batch", response_model=list[schemas.Copy], status_code=200, tags=["Copies"])
+def read_copies_batch(ids: str, db: Session = Depends(get_read_db)):
+    return serializers.render(schemas.Copy, crud.get_copies_by_ids(db, copy_ids=parse_ids(ids)))
 
 @app.get("/copies/{copy_id}", response_model=schemas.Copy, status_code=200, tags=["Copies"])
-def read_copy(copy_id: int, db: Session = Depends(get_db)):
+def read_copy(copy_id: int, db: Session = Depends(get_read_db)):
     db_copy = crud.get_copy(db, copy_id=copy_id)
     if db_copy is None:
         raise HTTPException(status_code=404, detail="Copy not found")
-    return db_copy
+    return serializers.render(schemas.Copy, db_copy)
 
 @app.get("/copies/book/{book_id}", response_model=list[schemas.Copy], status_code=200, tags=["Copies"])
-def read_copies_book(book_id: int, db: Session = Depends(get_db)):
+def read_copies_book(book_id: int, db: Session = Depends(get_read_db)):
+    key = f"copies_by_book:{book_id}"
+    response = cached(key)
+    if response is not None:
+        return response
+    generation = catalog_cache.generation(f"book:{book_id}")
     db_copies = crud.get_copies_by_book(db, book_id=book_id)
     if db_copies is None:
         raise HTTPException(status_code=404, detail="Book not found")
-    return db_copies
+    return cache_response(key, schemas.Copy, db_copies, tags=[f"book:{book_id}"], generation=generation)
 
 @app.get("/copies/book/available/{book_id}", response_model=list[schemas.Copy], status_code=200, tags=["Copies"])
-def read_copies_book_available(book_id: int, db: Session = Depends(get_db)):
+def read_copies_book_available(book_id: int, db: Session = Depends(get_read_db)):
     db_copies = crud.get_copies_available_by_book(db, book_id=book_id)
     if db_copies is None:
         raise HTTPException(status_code=404, detail="No copies available")
-    return db_copies
+    return serializers.render(schemas.Copy, db_copies)
 
 @app.post("/loans/", response_model=schemas.Loan, status_code=201, tags=["Loans"])
 def create_loan(loan: schemas.LoanCreate, db: Session = Depends(get_db)):
-    if len(crud.get_active_loans_by_user(db, user_id=loan.user_id)) >= 3:
-        raise HTTPException(status_code=400, detail="User has reached the maximum number of loans")
-    loan_copy = crud.get_copy(db, copy_id=loan.copy_id)
-    if loan_copy.available == False:
-        raise HTTPException(status_code=400, detail="Copy not available")
     if loan.return_date <= loan.loan_date:
         raise HTTPException(status_code=400, detail="Return date must be after loan date")
-    db_loan = crud.create_loan(db=db, loan=loan)
-    crud.update_copy_not_available(db, copy_id=loan.copy_id)
-    return db_loan
+    try:
+        if writer.ENABLED:
+            return apply_write(writer.checkout_loan, loan)
+        return crud.checkout_loan(db=db, loan=loan)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/loans/bulk", status_code=200, tags=["Loans"])
+async def bulk_create_loans(request: Request, db: Session = Depends(get_db)):
+    return await ingest.bulk_ingest(request, db, "loans")
 
 @app.delete("/loans/{loan_id}", status_code=200, tags=["Loans"])
 def delete_loan(loan_id: int, db: Session = Depends(get_db)):
+    if writer.ENABLED:
+        try:
+            return apply_write(writer.return_loan, loan_id)
+        except LookupError as e:
+            raise HTTPException(status_code=404, detail=str(e))
     db_loan = crud.get_loan(db, loan_id=loan_id)
     if db_loan is None:
         raise HTTPException(status_code=404, detail="Loan not found")
@@ -233,32 +494,126 @@ def update_loan(loan_id: int, loan: schemas.LoanUpdate, db: Session = Depends(ge
         raise HTTPException(status_code=404, detail="Loan not found")
     if loan.return_date <= loan.loan_date:
         raise HTTPException(status_code=400, detail="Return date must be after loan date")
-    crud.update_loan(db, loan_id=loan_id, loan=loan)
-    
-    return crud.get_loan(db, loan_id=loan_id)
+    return crud.update_loan(db, loan_id=loan_id, loan=loan)
 
 @app.get("/loans/", response_model=list[schemas.Loan], tags=["Loans"])
-def read_loans(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    loans = crud.get_loans(db, skip=skip, limit=limit)
-    return loans
+def read_loans(skip: int = 0, limit: int = 100, cursor: str = None, fields: str = None, db: Session = Depends(get_read_db)):
+    check_cursor(models.Loan, cursor)
+    shape = read_shape(schemas.Loan, fields)
+    loans = crud.get_loans(db, skip=skip, limit=limit, cursor=cursor, shape=shape)
+    response = serializers.render(schemas.Loan, loans, shape=shape)
+    set_next_cursor(response, models.Loan, loans, limit)
+    return response
+
+@app.get("/loans/overdue", response_model=list[schemas.Loan], tags=["Loans"])
+def read_overdue_loans(skip: int = 0, limit: int = 100, cursor: str = None, db: Session = Depends(get_read_db)):
+    check_cursor("overdue", cursor)
+    loans = crud.get_overdue_loans(db, skip=skip, limit=limit, cursor=cursor)
+    response = serializers.render(schemas.Loan, loans)
+    set_next_cursor(response, "overdue", loans, limit)
+    return response
+
+@app.get("/loans/batch", response_model=list[schemas.Loan], tags=["Loans"])
+def read_loans_batch(ids: str, db: Session = Depends(get_read_db)):
+    return serializers.render(schemas.Loan, crud.get_loans_by_ids(db, loan_ids=parse_ids(ids)))
 
 @app.get("/loans/{loan_id}", response_model=schemas.Loan, tags=["Loans"])
-def read_loan(loan_id: int, db: Session = Depends(get_db)):
+def read_loan(loan_id: int, db: Session = Depends(get_read_db)):
     db_loan = crud.get_loan(db, loan_id=loan_id)
     if db_loan is None:
         raise HTTPException(status_code=404, detail="Loan not found")
-    return db_loan
+    return serializers.render(schemas.Loan, db_loan)
 
 @app.get("/loans/user/{user_id}", response_model=list[schemas.Loan], status_code=200, tags=["Loans"])
-def read_loans_user(user_id: int, db: Session = Depends(get_db)):
-    db_loans = crud.get_loans_by_user(db, user_id=user_id)
+def read_loans_user(user_id: int, history: bool = False, db: Session = Depends(get_read_db)):
+    db_loans = crud.get_loans_by_user(db, user_id=user_id, history=history)
     if db_loans is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return db_loans
+    return serializers.render(schemas.Loan, db_loans)
 
 @app.get("/loans/copy/{copy_id}", response_model=list[schemas.Loan], status_code=200, tags=["Loans"])
-def read_loans_copy(copy_id: int, db: Session = Depends(get_db)):
-    db_loans = crud.get_loans_by_copy(db, copy_id=copy_id)
+def read_loans_copy(copy_id: int, history: bool = False, db: Session = Depends(get_read_db)):
+    db_loans = crud.get_loans_by_copy(db, copy_id=copy_id, history=history)
     if db_loans is None:
         raise HTTPException(status_code=404, detail="Copy not found")
-    return db_loans
\ No newline at end of file
+    return serializers.render(schemas.Loan, db_loans)
+
+@app.get("/stats/loans-by-category", response_model=list[schemas.CategoryMonthLoans], status_code=200, tags=["Stats"])
+def read_loans_by_category(start: str = None, end: str = None, category_id: int = None, db: Session = Depends(get_read_db)):
+    try:
+        return crud.get_loans_by_category(db, start=start, end=end, category_id=category_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/stats/top-books", response_model=list[schemas.BookLoans], status_code=200, tags=["Stats"])
+def read_top_books(limit: int = 10, db: Session = Depends(get_read_db)):
+    return crud.get_top_books(db, limit=limit)
+
+@app.get("/stats/copy-utilization", response_model=list[schemas.CopyLoans], status_code=200, tags=["Stats"])
+def read_copy_utilization(book_id: int = None, limit: int = 100, db: Session = Depends(get_read_db)):
+    return crud.get_copy_utilization(db, book_id=book_id, limit=limit)
+
+@app.get("/changes", response_model=list[schemas.Change], status_code=200, tags=["Changes"])
+async def read_changes(response: Response, since: int = 0, limit: int = Query(100, ge=0, le=changes.CHANGES_BATCH), wait: float = 0):
+    # X-Last-Seq is the newest change in the log; a consumer starting from
+    # scratch reads it with limit=0 before copying the tables
+    rows, first, last = await changes.wait_for_changes(since, limit, wait)
+    if limit and changes.behind(since, first):
+        raise HTTPException(status_code=410, detail=f"Changes after {since} have been compacted, resync from the tables")
+    if last is not None:
+        response.headers["X-Last-Seq"] = str(last)
+    return rows
+
+@app.get("/passwords/stats", status_code=200, tags=["Users"])
+def read_password_stats():
+    return passwords.pool.stats()
+
+@app.get("/writes/stats", status_code=200, tags=["Writes"])
+def read_write_stats():
+    if not writer.ENABLED:
+        return {"mode": writer.WRITE_MODE}
+    return writer.group_writer.stats()
+
+@app.get("/cache/stats", status_code=200, tags=["Cache"])
+def read_cache_stats():
+    return catalog_cache.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse, status_code=200, tags=["Metrics"])
+def read_metrics():
+    if not instrumentation.ENABLED:
+        raise HTTPException(status_code=404, detail="Instrumentation disabled")
+    return PlainTextResponse(instrumentation.render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/export/{table}", status_code=200, tags=["Export"])
+def export_table(table: str, format: str = "ndjson"):
+    if table not in export.TABLES:
+        raise HTTPException(status_code=404, detail="Table not found")
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail="Format must be ndjson or csv")
+    return StreamingResponse(
+        export.stream_table(table, format),
+        media_type=export.FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'},
+    )
+
+if ASYNC_MODE:
+    from .async_routes import router as async_router
+
+    async_routes = {(route.path, method) for route in async_router.routes for method in route.methods}
+    app.router.routes = [
+        route for route in app.router.routes
+        if not any((route.path, method) in async_routes for method in getattr(route, "methods", None) or ())
+    ]
+    app.include_router(async_router)
+
+    # Closes the pooled aiosqlite connections, whose worker threads would
+    # otherwise keep the process from exiting
+    app.add_event_handler("shutdown", async_read_engine.dispose)
+
+# After the async routes, so the OpenAPI document is built over the final
+# route table
+if startup.WARMUP:
+    app.add_event_handler("startup", startup.warm_up)
+    if ASYNC_MODE:
+        app.add_event_handler("startup", startup.warm_up_async)
+    app.add_event_handler("startup", app.openapi)
@@ -0,0 +1,85 @@
+"""Maintenance commands.
+
+    python -m package.manage migrate
+    python -m package.manage reconcile-availability
+    python -m package.manage mark-overdue
+    python -m package.manage reconcile-overdue
+    python -m package.manage rebuild-loan-stats
+    python -m package.manage archive-loans --days 365
+    python -m package.manage compact-changes --hours 168
+    python -m package.manage build-openapi
+"""
+import argparse
+
+from . import archive, changes, crud, migrations, overdue, startup
+from .database import SessionLocal, engine
+
+def migrate(args):
+    for target, description in migrations.create_schema(engine):
+        print(f"Applied migration {target}: {description}")
+
+def reconcile_availability(args):
+    db = SessionLocal()
+    try:
+        crud.reconcile_availability(db)
+        db.commit()
+    finally:
+        db.close()
+    print("Rebuilt book availability counters")
+
+def mark_overdue(args):
+    print(f"Marked {overdue.mark_overdue()} loans overdue")
+
+def reconcile_overdue(args):
+    db = SessionLocal()
+    try:
+        crud.reconcile_overdue(db)
+        db.commit()
+    finally:
+        db.close()
+    print("Rebuilt per-user overdue counts")
+
+def rebuild_loan_stats(args):
+    db = SessionLocal()
+    try:
+        crud.rebuild_loan_stats(db)
+        db.commit()
+    finally:
+        db.close()
+    print("Rebuilt circulation rollups")
+
+def archive_loans(args):
+    days = args.days if args.days is not None else archive.ARCHIVE_AFTER_DAYS
+    print(f"Archived {archive.archive_loans(days=days)} loans returned more than {days} days ago")
+
+def compact_changes(args):
+    hours = args.hours if args.hours is not None else changes.CHANGES_RETENTION_HOURS
+    print(f"Compacted {changes.compact_changes(hours=hours)} changes older than {hours:g} hours")
+
+def build_openapi(args):
+    from .main import app
+
+    app.openapi()
+    print(f"Built the OpenAPI document into {startup.OPENAPI_CACHE}")
+
+COMMANDS = {
+    "migrate": migrate,
+    "reconcile-availability": reconcile_availability,
+    "mark-overdue": mark_overdue,
+    "reconcile-overdue": reconcile_overdue,
+    "rebuild-loan-stats": rebuild_loan_stats,
+    "archive-loans": archive_loans,
+    "compact-changes": compact_changes,
+    "build-openapi": build_openapi,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Library maintenance commands")
+    parser.add_argument("command", choices=COMMANDS)
+    parser.add_argument("--days", type=int, help="archive-loans: minimum age of the loans to archive")
+    parser.add_argument("--hours", type=float, help="compact-changes: minimum age of the changes to drop")
+    args = parser.parse_args()
+    COMMANDS[args.command](args)
+
+if __name__ == "__main__":
+    main()
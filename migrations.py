@@ -0,0 +1,356 @@
+"""Versioned migrations for existing database files.
+
+create_all never alters existing tables, so changes to them live here. The
+version is kept in PRAGMA user_version and every step is idempotent. The app
+only runs create_schema on a file behind LATEST_VERSION, so a new table needs
+a migration here too (even an empty one) to reach existing databases.
+
+    python -m package.manage migrate
+"""
+from sqlalchemy import text
+from sqlalchemy.schema import CreateTable
+
+from . import crud, models
+from .database import engine
+
+def create_indexes(*names):
+    def apply(conn):
+        for table in models.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in names:
+                    if index.unique:
+                        check_unique(conn, index)
+                    index.create(bind=conn, checkfirst=True)
+    return apply
+
+def recreate_indexes(*names):
+    # SQLite breaks a tie between equally good indexes in favour of the one
+    # created last, so a partial index has to come after the full index on
+    # the same columns for the planner to pick it
+    create = create_indexes(*names)
+
+    def apply(conn):
+        for name in names:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+        create(conn)
+    return apply
+
+def check_unique(conn, index):
+    # Older files allowed duplicates; creating the index would fail on them
+    # with a bare IntegrityError, so name the offending values instead
+    columns = ", ".join(column.name for column in index.columns)
+    duplicates = conn.exec_driver_sql(
+        f"SELECT {columns}, COUNT(*) FROM {index.table.name} "
+        f"WHERE {' AND '.join(f'{column.name} IS NOT NULL' for column in index.columns)} "
+        f"GROUP BY {columns} HAVING COUNT(*) > 1 LIMIT 10"
+    ).fetchall()
+    if duplicates:
+        listed = ", ".join(f"{tuple(row[:-1]) if len(row) > 2 else row[0]!r} ({row[-1]} rows)" for row in duplicates)
+        raise RuntimeError(
+            f"Cannot create unique index {index.name}: {index.table.name}.{columns} has duplicates, "
+            f"e.g. {listed}. Merge or change them, then run `python -m package.manage migrate` again."
+        )
+
+def add_column(table: str, name: str, definition: str):
+    def apply(conn):
+        columns = {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+        if name not in columns:
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+    return apply
+
+def execute(*statements):
+    def apply(conn):
+        for statement in statements:
+            conn.exec_driver_sql(statement)
+    return apply
+
+# Trigger bodies for the circulation rollups (see crud.rebuild_loan_stats),
+# counting the loan in `row` (new or old) in or out of each of them
+def count_loan_in(row: str):
+    return f"""
+        INSERT INTO copy_loans (copy_id, loans, active, loan_days)
+        SELECT {row}.copy_id, 1, IFNULL({row}.active, 0), IFNULL(julianday({row}.return_date) - julianday({row}.loan_date), 0)
+        WHERE {row}.copy_id IS NOT NULL
+        ON CONFLICT (copy_id) DO UPDATE SET
+            loans = loans + 1,
+            active = active + excluded.active,
+            loan_days = loan_days + excluded.loan_days;
+        INSERT INTO book_loans (book_id, loans, active)
+        SELECT book_id, 1, IFNULL({row}.active, 0) FROM copies
+        WHERE id = {row}.copy_id AND book_id IS NOT NULL
+        ON CONFLICT (book_id) DO UPDATE SET
+            loans = loans + 1,
+            active = active + excluded.active;
+        INSERT INTO category_month_loans (category_id, month, loans)
+        SELECT books.category_id, strftime('%Y-%m', {row}.loan_date), 1
+        FROM copies JOIN books ON books.id = copies.book_id
+        WHERE copies.id = {row}.copy_id AND books.category_id IS NOT NULL AND {row}.loan_date IS NOT NULL
+        ON CONFLICT (category_id, month) DO UPDATE SET loans = loans + 1;
+    """
+
+def count_loan_out(row: str):
+    return f"""
+        UPDATE copy_loans SET
+            loans = loans - 1,
+            active = active - IFNULL({row}.active, 0),
+            loan_days = loan_days - IFNULL(julianday({row}.return_date) - julianday({row}.loan_date), 0)
+        WHERE copy_id = {row}.copy_id;
+        UPDATE book_loans SET
+            loans = loans - 1,
+            active = active - IFNULL({row}.active, 0)
+        WHERE book_id = (SELECT book_id FROM copies WHERE id = {row}.copy_id);
+        UPDATE category_month_loans SET loans = loans - 1
+        WHERE month = strftime('%Y-%m', {row}.loan_date)
+            AND category_id = (SELECT books.category_id FROM copies JOIN books ON books.id = copies.book_id WHERE copies.id = {row}.copy_id);
+    """
+
+# DELETE /loans/{loan_id} is how a loan is returned, so a deleted loan
+# stays in the totals and only stops counting as active
+def count_loan_returned(row: str):
+    return f"""
+        UPDATE copy_loans SET active = active - 1 WHERE copy_id = {row}.copy_id;
+        UPDATE book_loans SET active = active - 1
+        WHERE book_id = (SELECT book_id FROM copies WHERE id = {row}.copy_id);
+    """
+
+# Triggers appending every write on a change-log table to changes (see
+# crud.CHANGE_TABLES), with the row as JSON after inserts and updates
+def change_triggers(table: str):
+    columns = [column.name for column in models.Base.metadata.tables[table].columns]
+    data = "json_object(" + ", ".join(f"'{column}', new.{column}" for column in columns) + ")"
+    changed = " OR ".join(f"old.{column} IS NOT new.{column}" for column in columns)
+    inserted, updated, deleted = "'insert'", "'update'", "'delete'"
+    if table == "loans":
+        # crud.archive_loan_batch deletes with a row in archiving
+        deleted = "CASE WHEN EXISTS (SELECT 1 FROM archiving) THEN 'archive' ELSE 'delete' END"
+
+    def log(row: str, operation: str, data: str):
+        return f"""
+            INSERT INTO changes (table_name, row_id, operation, data, changed_at)
+            VALUES ('{table}', {row}.id, {operation}, {data}, datetime('now', 'localtime'));
+        """
+
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_changes_insert AFTER INSERT ON {table} BEGIN {log('new', inserted, data)} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_changes_update AFTER UPDATE ON {table} WHEN {changed} BEGIN {log('new', updated, data)} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_changes_delete AFTER DELETE ON {table} BEGIN {log('old', deleted, 'NULL')} END",
+    ]
+
+def autoincrement_loans(conn):
+    # AUTOINCREMENT can only be set when a table is created, so an older
+    # loans table is rebuilt around the same rows, indexes and triggers (in
+    # their original order, see recreate_indexes). The sequence then starts
+    # past every archived id as well, since those left loans before it did.
+    sql = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'loans'").scalar()
+    if "AUTOINCREMENT" not in sql.upper():
+        table = models.Loan.__table__
+        dependents = [row[0] for row in conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE tbl_name = 'loans' AND type IN ('index', 'trigger') AND sql IS NOT NULL ORDER BY rowid"
+        )]
+        columns = ", ".join(column.name for column in table.columns)
+        create = str(CreateTable(table).compile(dialect=conn.dialect))
+        conn.exec_driver_sql(create.replace("CREATE TABLE loans (", "CREATE TABLE loans_rebuilt (", 1))
+        conn.exec_driver_sql(f"INSERT INTO loans_rebuilt ({columns}) SELECT {columns} FROM loans")
+        conn.exec_driver_sql("DROP TABLE loans")
+        conn.exec_driver_sql("ALTER TABLE loans_rebuilt RENAME TO loans")
+        for statement in dependents:
+            conn.exec_driver_sql(statement)
+    conn.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = 'loans'")
+    conn.exec_driver_sql(
+        "INSERT INTO sqlite_sequence (name, seq) "
+        "SELECT 'loans', MAX(IFNULL((SELECT MAX(id) FROM loans), 0), IFNULL((SELECT MAX(id) FROM loans_archive), 0))"
+    )
+
+MIGRATIONS = [
+    (1, "Secondary indexes for filter paths", create_indexes(
+        "ix_users_email",
+        "ix_books_author",
+        "ix_books_editorial",
+        "ix_books_category_id",
+        "ix_categories_name",
+        "ix_copies_book_id_available_atention",
+        "ix_loans_copy_id",
+        "ix_loans_user_id",
+        "ix_loans_user_id_active",
+        "ix_loans_loan_date",
+    )),
+    (2, "Full-text index over book title, author and editorial", execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+            title, author, editorial, content='books', content_rowid='id', prefix='2 3'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts (rowid, title, author, editorial)
+            VALUES (new.id, new.title, new.author, new.editorial);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author, editorial)
+            VALUES ('delete', old.id, old.title, old.author, old.editorial);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author, editorial)
+            VALUES ('delete', old.id, old.title, old.author, old.editorial);
+            INSERT INTO books_fts (rowid, title, author, editorial)
+            VALUES (new.id, new.title, new.author, new.editorial);
+        END
+        """,
+        "INSERT INTO books_fts (books_fts) VALUES ('rebuild')",
+    )),
+    (3, "Per-book availability counters maintained by triggers on copies", execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS copies_availability_insert AFTER INSERT ON copies BEGIN
+            INSERT INTO book_availability (book_id, total, available, attention)
+            VALUES (new.book_id, 1, IFNULL(new.available AND NOT new.atention, 0), IFNULL(new.atention, 0))
+            ON CONFLICT (book_id) DO UPDATE SET
+                total = total + 1,
+                available = available + excluded.available,
+                attention = attention + excluded.attention;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS copies_availability_delete AFTER DELETE ON copies BEGIN
+            UPDATE book_availability SET
+                total = total - 1,
+                available = available - IFNULL(old.available AND NOT old.atention, 0),
+                attention = attention - IFNULL(old.atention, 0)
+            WHERE book_id = old.book_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS copies_availability_update AFTER UPDATE OF book_id, available, atention ON copies
+        WHEN old.book_id IS NOT new.book_id OR old.available IS NOT new.available OR old.atention IS NOT new.atention
+        BEGIN
+            UPDATE book_availability SET
+                total = total - 1,
+                available = available - IFNULL(old.available AND NOT old.atention, 0),
+                attention = attention - IFNULL(old.atention, 0)
+            WHERE book_id = old.book_id;
+            INSERT INTO book_availability (book_id, total, available, attention)
+            VALUES (new.book_id, 1, IFNULL(new.available AND NOT new.atention, 0), IFNULL(new.atention, 0))
+            ON CONFLICT (book_id) DO UPDATE SET
+                total = total + 1,
+                available = available + excluded.available,
+                attention = attention + excluded.attention;
+        END
+        """,
+    )),
+    (4, "Backfill availability counters", crud.reconcile_availability),
+    (5, "Row versions for conditional GETs", execute(
+        # Start from a random version so an ETag from a replaced database
+        # file does not match by accident.
+        *(
+            f"INSERT OR IGNORE INTO table_versions (name, version) VALUES ('{table}', abs(random() % 1000000000000))"
+            for table in crud.VERSIONED_TABLES
+        ),
+        *(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_version_{operation.lower()} AFTER {operation} ON {table} BEGIN
+                UPDATE table_versions SET version = version + 1 WHERE name = '{table}';
+            END
+            """
+            for table in crud.VERSIONED_TABLES
+            for operation in ("INSERT", "UPDATE", "DELETE")
+        ),
+    )),
+    (6, "Overdue flag on loans", add_column("loans", "overdue", "BOOLEAN DEFAULT 0")),
+    (7, "Index for overdue scans", create_indexes("ix_loans_active_return_date")),
+    (8, "Per-user overdue counts maintained by triggers on loans", execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS loans_overdue_insert AFTER INSERT ON loans
+        WHEN IFNULL(new.active AND new.overdue, 0)
+        BEGIN
+            INSERT INTO user_overdue (user_id, overdue) VALUES (new.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET overdue = overdue + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS loans_overdue_delete AFTER DELETE ON loans
+        WHEN IFNULL(old.active AND old.overdue, 0)
+        BEGIN
+            UPDATE user_overdue SET overdue = overdue - 1 WHERE user_id = old.user_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS loans_overdue_update AFTER UPDATE OF user_id, active, overdue ON loans
+        WHEN old.user_id IS NOT new.user_id
+            OR IFNULL(old.active AND old.overdue, 0) IS NOT IFNULL(new.active AND new.overdue, 0)
+        BEGIN
+            UPDATE user_overdue SET overdue = overdue - 1
+            WHERE user_id = old.user_id AND IFNULL(old.active AND old.overdue, 0);
+            INSERT INTO user_overdue (user_id, overdue)
+            SELECT new.user_id, 1 WHERE IFNULL(new.active AND new.overdue, 0)
+            ON CONFLICT (user_id) DO UPDATE SET overdue = overdue + 1;
+        END
+        """,
+    )),
+    (9, "Backfill overdue counts", crud.reconcile_overdue),
+    (10, "Circulation rollups maintained by triggers on loans", execute(
+        f"CREATE TRIGGER IF NOT EXISTS loans_rollup_insert AFTER INSERT ON loans BEGIN {count_loan_in('new')} END",
+        f"CREATE TRIGGER IF NOT EXISTS loans_rollup_delete AFTER DELETE ON loans BEGIN {count_loan_out('old')} END",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS loans_rollup_update AFTER UPDATE OF copy_id, loan_date, return_date, active ON loans
+        WHEN old.copy_id IS NOT new.copy_id OR old.loan_date IS NOT new.loan_date
+            OR old.return_date IS NOT new.return_date OR old.active IS NOT new.active
+        BEGIN {count_loan_out('old')} {count_loan_in('new')} END
+        """,
+    )),
+    (11, "Backfill circulation rollups", crud.rebuild_loan_stats),
+    (12, "Keep archived loans in the circulation rollups", execute(
+        "DROP TRIGGER IF EXISTS loans_rollup_delete",
+        f"""
+        CREATE TRIGGER loans_rollup_delete AFTER DELETE ON loans
+        WHEN NOT EXISTS (SELECT 1 FROM loans_archive WHERE id = old.id)
+        BEGIN {count_loan_out('old')} END
+        """,
+    )),
+    (13, "Change log maintained by triggers on copies and loans", execute(
+        *(statement for table in crud.CHANGE_TABLES for statement in change_triggers(table)),
+    )),
+    (14, "Active loans by user search the partial index", recreate_indexes("ix_loans_user_id_active")),
+    (15, "Count returned loans once in the circulation rollups", execute(
+        "DROP TRIGGER IF EXISTS loans_rollup_delete",
+        f"CREATE TRIGGER loans_rollup_delete AFTER DELETE ON loans WHEN old.active BEGIN {count_loan_returned('old')} END",
+    )),
+    (16, "Loan ids are never reused", autoincrement_loans),
+    (17, "Change log tells archive deletes by the archiving row", execute(
+        "DROP TRIGGER IF EXISTS loans_changes_delete",
+        change_triggers("loans")[2],
+    )),
+    (18, "Returned loans kept for rebuilding the circulation rollups", execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS loans_returned_delete AFTER DELETE ON loans
+        WHEN NOT EXISTS (SELECT 1 FROM archiving)
+        BEGIN
+            INSERT OR REPLACE INTO loans_returned (id, copy_id, user_id, loan_date, return_date, returned_at)
+            VALUES (old.id, old.copy_id, old.user_id, old.loan_date, old.return_date, datetime('now', 'localtime'));
+        END
+        """,
+    )),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def current_version(conn):
+    return conn.execute(text("PRAGMA user_version")).scalar()
+
+def migrate(bind=engine):
+    applied = []
+    with bind.begin() as conn:
+        version = current_version(conn)
+        for target, description, apply in MIGRATIONS:
+            if target <= version:
+                continue
+            apply(conn)
+            conn.execute(text(f"PRAGMA user_version = {int(target)}"))
+            applied.append((target, description))
+    return applied
+
+def create_schema(bind=engine):
+    models.Base.metadata.create_all(bind=bind)
+    return migrate(bind)
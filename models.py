@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Date, DateTime
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, String, Date, DateTime, Float
 from sqlalchemy.orm import relationship
 
 from datetime import datetime, timedelta
@@ -10,11 +10,11 @@ class Book(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String)
-    author = Column(String)
-    editorial = Column(String)
+    author = Column(String, index=True)
+    editorial = Column(String, index=True)
     pub_year = Column(Integer)
     edition = Column(Integer)
-    category_id = Column(Integer, ForeignKey("categories.id"))
+    category_id = Column(Integer, ForeignKey("categories.id"), index=True)
     
     categories = relationship("Category", back_populates="books")
     copies = relationship("Copy", back_populates="books")
@@ -23,7 +23,7 @@ class Category(Base):
     __tablename__ = "categories"
     
     id = Column(Integer, primary_key=True, index=True)
-    name = Column(String)
+    name = Column(String, index=True)
     
     books = relationship("Book", back_populates="categories")
     
@@ -38,18 +38,62 @@ class Copy(Base):
     books = relationship("Book", back_populates="copies")
     loans = relationship("Loan", back_populates="copies")
     
+    __table_args__ = (
+        Index("ix_copies_book_id_available_atention", "book_id", "available", "atention"),
+    )
+    
 class Loan(Base):
     __tablename__ = "loans"
     
     id = Column(Integer, primary_key=True, index=True)
-    copy_id = Column(Integer, ForeignKey("copies.id"))
-    user_id = Column(Integer, ForeignKey("users.id"))
-    loan_date = Column(DateTime, default=datetime.utcnow)
+    copy_id = Column(Integer, ForeignKey("copies.id"), index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    loan_date = Column(DateTime, default=datetime.utcnow, index=True)
     active = Column(Boolean, default=True)
     return_date = Column(DateTime)
+    overdue = Column(Boolean, default=False)
     
     copies = relationship("Copy", back_populates="loans")
     users = relationship("User", back_populates="loans")
+    
+    # Ids are never reused, so a new loan cannot take the id of one that was
+    # deleted or moved to loans_archive
+    __table_args__ = (
+        Index("ix_loans_user_id_active", "user_id", sqlite_where=active == True),
+        Index("ix_loans_active_return_date", "active", "return_date"),
+        {"sqlite_autoincrement": True},
+    )
+
+class LoanArchive(Base):
+    __tablename__ = "loans_archive"
+    
+    id = Column(Integer, primary_key=True)
+    copy_id = Column(Integer, index=True)
+    user_id = Column(Integer, index=True)
+    loan_date = Column(DateTime)
+    active = Column(Boolean)
+    return_date = Column(DateTime)
+    overdue = Column(Boolean)
+    archived_at = Column(DateTime)
+
+class ReturnedLoan(Base):
+    __tablename__ = "loans_returned"
+    
+    # Every loan deleted from loans other than by an archive batch, written
+    # by a trigger, so crud.rebuild_loan_stats still sees returned loans
+    id = Column(Integer, primary_key=True)
+    copy_id = Column(Integer)
+    user_id = Column(Integer)
+    loan_date = Column(DateTime)
+    return_date = Column(DateTime)
+    returned_at = Column(DateTime)
+
+class Archiving(Base):
+    __tablename__ = "archiving"
+    
+    # Holds a row only inside the transaction of an archive batch, so the
+    # triggers on loans can tell its deletes from returns
+    id = Column(Integer, primary_key=True)
 
 class User(Base):
     __tablename__ = "users"
@@ -57,11 +101,87 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String)
     last_name = Column(String)
-    email = Column(String)
+    email = Column(String, unique=True, index=True)
     phone = Column(String)
     password = Column(String)
     active = Column(Boolean)
     register_date = Column(DateTime)
     expiration_date = Column(DateTime)
     
-    loans = relationship("Loan", back_populates="users")
\ No newline at end of file
+    loans = relationship("Loan", back_populates="users")
+
+class BookAvailability(Base):
+    __tablename__ = "book_availability"
+    
+    book_id = Column(Integer, ForeignKey("books.id"), primary_key=True)
+    total = Column(Integer, default=0)
+    available = Column(Integer, default=0)
+    attention = Column(Integer, default=0)
+
+class TableVersion(Base):
+    __tablename__ = "table_versions"
+    
+    name = Column(String, primary_key=True)
+    version = Column(Integer, default=0)
+
+class CopyLoans(Base):
+    __tablename__ = "copy_loans"
+    
+    copy_id = Column(Integer, ForeignKey("copies.id"), primary_key=True)
+    loans = Column(Integer, default=0)
+    active = Column(Integer, default=0)
+    loan_days = Column(Float, default=0)
+    
+    __table_args__ = (
+        Index("ix_copy_loans_loan_days", "loan_days"),
+    )
+
+class BookLoans(Base):
+    __tablename__ = "book_loans"
+    
+    book_id = Column(Integer, ForeignKey("books.id"), primary_key=True)
+    loans = Column(Integer, default=0)
+    active = Column(Integer, default=0)
+    
+    __table_args__ = (
+        Index("ix_book_loans_loans", "loans"),
+    )
+
+class CategoryMonthLoans(Base):
+    __tablename__ = "category_month_loans"
+    
+    category_id = Column(Integer, ForeignKey("categories.id"), primary_key=True)
+    month = Column(String, primary_key=True)
+    loans = Column(Integer, default=0)
+    
+    __table_args__ = (
+        Index("ix_category_month_loans_month", "month"),
+    )
+
+class UserOverdue(Base):
+    __tablename__ = "user_overdue"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    overdue = Column(Integer, default=0)
+
+class Change(Base):
+    __tablename__ = "changes"
+    
+    seq = Column(Integer, primary_key=True)
+    table_name = Column(String)
+    row_id = Column(Integer)
+    operation = Column(String)
+    data = Column(String)
+    changed_at = Column(DateTime)
+    
+    # Sequence numbers are never reused, even after compaction empties the
+    # end of the log
+    __table_args__ = (
+        {"sqlite_autoincrement": True},
+    )
+
+class Watermark(Base):
+    __tablename__ = "watermarks"
+    
+    name = Column(String, primary_key=True)
+    value = Column(DateTime)
@@ -0,0 +1,31 @@
+import logging
+import os
+
+from . import crud
+from .database import SessionLocal
+from .periodic import PeriodicTask
+
+# In-app overdue scan. Every LIBRARY_OVERDUE_INTERVAL_SECONDS the app runs
+# crud.mark_overdue on a worker thread; 0 turns the scheduler off, for
+# deployments that run `python -m package.manage mark-overdue` from cron
+# instead. With several app processes each one scans, which is harmless: a
+# run after another one finds nothing new past the watermark.
+OVERDUE_INTERVAL = float(os.environ.get("LIBRARY_OVERDUE_INTERVAL_SECONDS", "60"))
+OVERDUE_BATCH = int(os.environ.get("LIBRARY_OVERDUE_BATCH", "500"))
+ENABLED = OVERDUE_INTERVAL > 0
+
+logger = logging.getLogger("library.overdue")
+
+def mark_overdue(batch_size: int = OVERDUE_BATCH):
+    db = SessionLocal()
+    try:
+        return crud.mark_overdue(db, batch_size=batch_size)
+    finally:
+        db.close()
+
+def scan():
+    marked = mark_overdue()
+    if marked:
+        logger.info("Marked %d loans overdue", marked)
+
+scheduler = PeriodicTask("Overdue scan", scan, OVERDUE_INTERVAL)
@@ -0,0 +1,157 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import queue
+import secrets
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Password hashing runs on its own pool of worker processes, so a burst of
+# registrations or logins cannot take the GIL or the request threads that
+# serve every other route. At most LIBRARY_PASSWORD_QUEUE hashes are queued
+# or running at once; past that callers get queue.Full (a 503 in the routes)
+# instead of piling up. Stored hashes carry their algorithm and cost, so a
+# new cost or algorithm is applied to each user at their next login.
+ALGORITHMS = ("scrypt", "pbkdf2_sha256")
+ALGORITHM = os.environ.get("LIBRARY_PASSWORD_ALGORITHM", "scrypt")
+SCRYPT_N = int(os.environ.get("LIBRARY_SCRYPT_N", "16384"))
+SCRYPT_R = int(os.environ.get("LIBRARY_SCRYPT_R", "8"))
+SCRYPT_P = int(os.environ.get("LIBRARY_SCRYPT_P", "1"))
+PBKDF2_ITERATIONS = int(os.environ.get("LIBRARY_PBKDF2_ITERATIONS", "600000"))
+PASSWORD_WORKERS = int(os.environ.get("LIBRARY_PASSWORD_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+PASSWORD_QUEUE = int(os.environ.get("LIBRARY_PASSWORD_QUEUE", "64"))
+# Added to the workers' niceness, so when they compete with the request
+# threads for a core the scheduler favours the requests
+PASSWORD_NICE = int(os.environ.get("LIBRARY_PASSWORD_NICE", "10"))
+
+if ALGORITHM not in ALGORITHMS:
+    raise ValueError(f"LIBRARY_PASSWORD_ALGORITHM must be one of {', '.join(ALGORITHMS)}")
+
+# (algorithm, *cost) for new hashes
+def current_params():
+    if ALGORITHM == "scrypt":
+        return ("scrypt", SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return ("pbkdf2_sha256", PBKDF2_ITERATIONS)
+
+def derive(password: str, salt: bytes, params) -> bytes:
+    algorithm, *cost = params
+    if algorithm == "scrypt":
+        n, r, p = cost
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r * p, dklen=32)
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, *cost)
+
+def encode(params, salt: bytes, key: bytes) -> str:
+    return "$".join([*map(str, params), base64.b64encode(salt).decode(), base64.b64encode(key).decode()])
+
+def decode(stored: str):
+    # Returns (params, salt, key); ValueError for anything not written by encode
+    algorithm, *cost, salt, key = stored.split("$")
+    if algorithm not in ALGORITHMS:
+        raise ValueError("Unknown password hash")
+    return (algorithm, *map(int, cost)), base64.b64decode(salt), base64.b64decode(key)
+
+def needs_rehash(stored: str) -> bool:
+    try:
+        params, _, _ = decode(stored)
+    except ValueError:
+        return True
+    return params != current_params()
+
+# The functions below run in the worker processes
+def init_worker(nice: int):
+    if nice and hasattr(os, "nice"):
+        os.nice(nice)
+
+def hash_password(password: str) -> str:
+    salt = secrets.token_bytes(16)
+    params = current_params()
+    return encode(params, salt, derive(password, salt, params))
+
+def hash_passwords(passwords: list) -> list:
+    return [hash_password(password) for password in passwords]
+
+def verify_password(password: str, stored: str) -> bool:
+    # A missing or unreadable hash still costs one derivation, so a login
+    # for an unknown email takes as long as one with a wrong password.
+    try:
+        params, salt, key = decode(stored)
+    except (AttributeError, ValueError):
+        derive(password, bytes(16), current_params())
+        return False
+    return hmac.compare_digest(derive(password, salt, params), key)
+
+class PasswordPool:
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.completed = 0
+        self.rejected = 0
+
+    def start(self):
+        # Workers are spawned rather than forked, since the app process has
+        # threads and open database connections by the time this runs
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_worker,
+                    initargs=(PASSWORD_NICE,),
+                )
+            return self.executor
+
+    def stop(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def submit(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            raise queue.Full
+        try:
+            future = self.start().submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(self.release)
+        return future
+
+    def release(self, future):
+        self.completed += 1
+        self.slots.release()
+
+    async def run(self, function, *args):
+        return await asyncio.wrap_future(self.submit(function, *args))
+
+    async def hash(self, password: str) -> str:
+        return await self.run(hash_password, password)
+
+    async def hash_many(self, passwords: list) -> list:
+        # One task per worker rather than per password, so a bulk import only
+        # takes as many queue slots as there are workers
+        size = -(-len(passwords) // self.workers) or 1
+        slices = [passwords[i:i + size] for i in range(0, len(passwords), size)]
+        hashed = await asyncio.gather(*(self.run(hash_passwords, passwords) for passwords in slices))
+        return [stored for part in hashed for stored in part]
+
+    async def verify(self, password: str, stored: str) -> bool:
+        return await self.run(verify_password, password, stored)
+
+    def stats(self):
+        return {
+            "algorithm": ALGORITHM,
+            "workers": self.workers,
+            "queue_limit": self.queue_size,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+pool = PasswordPool(PASSWORD_WORKERS, PASSWORD_QUEUE)
@@ -0,0 +1,37 @@
+import asyncio
+import logging
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger("library")
+
+# Runs a blocking maintenance function on a worker thread every `interval`
+# seconds while the app is up. A failed run is logged and the next one goes
+# ahead on schedule.
+class PeriodicTask:
+    def __init__(self, name: str, function, interval: float):
+        self.name = name
+        self.function = function
+        self.interval = interval
+        self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                await run_in_threadpool(self.function)
+            except Exception:
+                logger.exception("%s failed", self.name)
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Json
 from datetime import datetime, timedelta
 
 class CopyBase(BaseModel):
@@ -19,6 +19,44 @@ class Copy(CopyBase):
     class Config:
         orm_mode = True
 
+class BookAvailability(BaseModel):
+    book_id: int
+    total: int = 0
+    available: int = 0
+    attention: int = 0
+
+    class Config:
+        orm_mode = True
+
+class CopyLoans(BaseModel):
+    copy_id: int
+    book_id: int
+    loans: int = 0
+    active: int = 0
+    loan_days: float = 0
+
+    class Config:
+        orm_mode = True
+
+class BookLoans(BaseModel):
+    book_id: int
+    title: str
+    author: str
+    loans: int = 0
+    active: int = 0
+
+    class Config:
+        orm_mode = True
+
+class CategoryMonthLoans(BaseModel):
+    category_id: int
+    name: str
+    month: str
+    loans: int = 0
+
+    class Config:
+        orm_mode = True
+
 class BookBase(BaseModel):
     title: str
     author: str
@@ -87,6 +125,22 @@ class UserCreate(UserBase):
     password: str
     pass
 
+class Change(BaseModel):
+    seq: int
+    table_name: str
+    row_id: int
+    operation: str
+    # The row as stored after an insert or update; None for a delete
+    data: Json = None
+    changed_at: datetime
+
+    class Config:
+        orm_mode = True
+
+class UserLogin(BaseModel):
+    email: str
+    password: str
+
 class User(UserBase):
     id: int
     loans: list[Loan] = []
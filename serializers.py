@@ -0,0 +1,107 @@
+import json
+
+from fastapi.responses import Response
+
+from . import crud, schemas
+from .export import encode_value
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Fast path for read responses. Instead of validating ORM objects into the
+# schemas and running them through jsonable_encoder, these build the same
+# dicts directly (same keys, same order, datetimes in the format of the
+# schemas' json_encoders) and encode them with orjson when it is installed.
+# Routes keep their response_model for the OpenAPI document.
+
+def copy_dict(copy):
+    return {
+        "available": copy.available,
+        "atention": copy.atention,
+        "book_id": copy.book_id,
+        "id": copy.id,
+    }
+
+def book_dict(book):
+    return {
+        "title": book.title,
+        "author": book.author,
+        "editorial": book.editorial,
+        "pub_year": book.pub_year,
+        "edition": book.edition,
+        "category_id": book.category_id,
+        "id": book.id,
+        "copies": [copy_dict(copy) for copy in book.copies],
+    }
+
+def category_dict(category):
+    return {
+        "name": category.name,
+        "id": category.id,
+        "books": [book_dict(book) for book in category.books],
+    }
+
+def loan_dict(loan):
+    return {
+        "loan_date": encode_value(loan.loan_date),
+        "return_date": encode_value(loan.return_date),
+        "active": loan.active,
+        "copy_id": loan.copy_id,
+        "user_id": loan.user_id,
+        "id": loan.id,
+    }
+
+def user_dict(user):
+    return {
+        "name": user.name,
+        "last_name": user.last_name,
+        "email": user.email,
+        "phone": user.phone,
+        "active": user.active,
+        "register_date": encode_value(user.register_date),
+        "expiration_date": encode_value(user.expiration_date),
+        "id": user.id,
+        "loans": [loan_dict(loan) for loan in user.loans],
+    }
+
+SERIALIZERS = {
+    schemas.Copy: copy_dict,
+    schemas.Book: book_dict,
+    schemas.Category: category_dict,
+    schemas.Loan: loan_dict,
+    schemas.User: user_dict,
+}
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, separators=(",", ":")).encode()
+
+# Serializer for a crud.Shape: only the requested columns of the top-level
+# rows and only the expanded relationships, so nothing the query left out is
+# touched (and lazy loaded) here.
+def shaped_serializer(schema, fields=None, expand=frozenset(), prefix: str = ""):
+    columns = fields or crud.schema_columns(schema)
+    nested = [
+        (name, shaped_serializer(schema.__fields__[name].type_, expand=expand, prefix=f"{prefix}{name}."))
+        for name in crud.schema_relationships(schema)
+        if prefix + name in expand
+    ]
+
+    def serialize(row):
+        content = {column: encode_value(getattr(row, column)) for column in columns}
+        for name, serialize_nested in nested:
+            content[name] = [serialize_nested(child) for child in getattr(row, name)]
+        return content
+    return serialize
+
+def to_content(schema, rows, shape=None):
+    serialize = SERIALIZERS[schema] if shape is None else shaped_serializer(schema, shape.fields, shape.expand)
+    if isinstance(rows, list):
+        return [serialize(row) for row in rows]
+    return serialize(rows)
+
+def render(schema, rows, headers=None, shape=None):
+    return Response(dumps(to_content(schema, rows, shape)), media_type="application/json", headers=headers)
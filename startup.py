@@ -0,0 +1,109 @@
+import glob
+import hashlib
+import json
+import os
+
+import fastapi
+import pydantic
+from sqlalchemy import text
+
+from . import crud, migrations
+from .database import READ_POOL_SIZE, WRITE_POOL_SIZE, ReadSessionLocal, async_engine, async_read_engine, engine, read_engine
+
+# Startup lifecycle. Importing main touches no database; on startup the app
+# checks PRAGMA user_version, and only a file behind the latest migration
+# gets create_all and the migrations (or, with LIBRARY_MIGRATE_ON_STARTUP=0,
+# stops the app until `python -m package.manage migrate` has run). Warmup
+# then opens every pooled connection and runs the common reads once, so the
+# first requests do not pay for connects, pragmas and statement compilation,
+# and builds the OpenAPI document. The document is cached in
+# LIBRARY_OPENAPI_CACHE, keyed by the package source and routes, so a
+# restart of the same code loads it instead of rebuilding it.
+MIGRATE_ON_STARTUP = os.environ.get("LIBRARY_MIGRATE_ON_STARTUP", "1") == "1"
+WARMUP = os.environ.get("LIBRARY_WARMUP", "1") == "1"
+OPENAPI_CACHE = os.environ.get("LIBRARY_OPENAPI_CACHE", "./library-openapi.json")
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def check_schema():
+    with read_engine.connect() as conn:
+        version = migrations.current_version(conn)
+    if version >= migrations.LATEST_VERSION:
+        return
+    if not MIGRATE_ON_STARTUP:
+        raise RuntimeError(
+            f"Database schema is at version {version} of {migrations.LATEST_VERSION}, "
+            "run `python -m package.manage migrate`"
+        )
+    migrations.create_schema(engine)
+
+def read_queries(db):
+    # The statements behind the busiest GET routes
+    crud.get_table_versions(db, crud.VERSIONED_TABLES)
+    crud.get_books(db, limit=1)
+    crud.get_book_by_id(db, book_id=1)
+    crud.get_categories(db, limit=1)
+    crud.get_copies_by_book(db, book_id=1)
+    crud.get_users(db, limit=1)
+    crud.get_loans_by_user(db, user_id=1)
+    crud.search_books(db, "warmup", limit=1)
+
+def warm_up():
+    # Every session is held until all have run, so each one gets its own
+    # pooled connection. The compiled statements and ORM loaders are cached
+    # per engine, so the reads only need to run once; the rest of the pool
+    # just has its connections opened. Write connections are not used for a
+    # statement, since that would take the write lock.
+    sessions = [ReadSessionLocal() for _ in range(READ_POOL_SIZE)]
+    connections = [engine.raw_connection() for _ in range(WRITE_POOL_SIZE)]
+    try:
+        read_queries(sessions[0])
+        for db in sessions[1:]:
+            db.execute(text("SELECT 1"))
+    finally:
+        for db in sessions:
+            db.close()
+        for connection in connections:
+            connection.close()
+
+async def warm_up_async():
+    async with async_engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+    async with async_read_engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+
+def openapi_fingerprint(routes):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{fastapi.__version__} {pydantic.VERSION}".encode())
+    for path in sorted(glob.glob(os.path.join(PACKAGE_DIR, "*.py"))):
+        with open(path, "rb") as source:
+            digest.update(source.read())
+    for route in routes:
+        endpoint = getattr(route, "endpoint", None)
+        digest.update(f"{route.path} {sorted(getattr(route, 'methods', None) or ())} {getattr(endpoint, '__module__', '')}".encode())
+    return digest.hexdigest()
+
+def load_openapi(fingerprint: str):
+    if not OPENAPI_CACHE:
+        return None
+    try:
+        with open(OPENAPI_CACHE) as cached:
+            entry = json.load(cached)
+    except (OSError, ValueError):
+        return None
+    if entry.get("fingerprint") != fingerprint:
+        return None
+    return entry["schema"]
+
+def save_openapi(fingerprint: str, schema: dict):
+    if not OPENAPI_CACHE:
+        return
+    # Written next to the cache and renamed over it, so a worker starting at
+    # the same time never reads half a file
+    partial = f"{OPENAPI_CACHE}.{os.getpid()}"
+    try:
+        with open(partial, "w") as cached:
+            json.dump({"fingerprint": fingerprint, "schema": schema}, cached)
+        os.replace(partial, OPENAPI_CACHE)
+    except OSError:
+        pass
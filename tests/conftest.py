@@ -0,0 +1,81 @@
+import contextlib
+import os
+import tempfile
+
+# The database modules resolve ./library-project.db when they are first
+# imported, so the suite moves to a scratch directory before importing the
+# app. Background schedulers and warmup stay off, and password hashing is
+# cheap, so only the requests under test touch the database. Run from the
+# parent directory of the project package:
+#
+#     python -m pytest package/tests
+os.chdir(tempfile.mkdtemp())
+os.environ.setdefault("LIBRARY_OVERDUE_INTERVAL_SECONDS", "0")
+os.environ.setdefault("LIBRARY_CHANGES_COMPACT_INTERVAL_SECONDS", "0")
+os.environ.setdefault("LIBRARY_WARMUP", "0")
+os.environ.setdefault("LIBRARY_SCRYPT_N", "1024")
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from .. import crud
+from ..cache import catalog_cache
+from ..database import async_engine, async_read_engine, engine, read_engine
+from ..main import app
+
+CATEGORIES = 20
+BOOKS_PER_CATEGORY = 2
+COPIES_PER_BOOK = 2
+USERS = 20
+
+
+def seed(client):
+    for c in range(CATEGORIES):
+        client.post("/categories/", json={"name": f"category {c}"})
+    for b in range(CATEGORIES * BOOKS_PER_CATEGORY):
+        client.post("/books/", json={"title": f"title {b}", "author": f"author {b % 5}", "editorial": f"editorial {b % 3}", "pub_year": 2000, "edition": 1, "category_id": b % CATEGORIES + 1})
+    for c in range(CATEGORIES * BOOKS_PER_CATEGORY * COPIES_PER_BOOK):
+        client.post("/copies/", json={"available": True, "atention": False, "book_id": c % (CATEGORIES * BOOKS_PER_CATEGORY) + 1})
+    for u in range(USERS):
+        client.post("/users/", json={"name": "name", "last_name": "last", "email": f"user{u}@example.com", "phone": "5555", "active": True, "password": "secret"})
+    for l in range(2 * USERS):
+        client.post("/loans/", json={"copy_id": l + 1, "user_id": l % USERS + 1})
+
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(app) as client:
+        seed(client)
+        yield client
+
+
+@pytest.fixture(autouse=True)
+def load_strategy(monkeypatch):
+    # The statement counts in the tests are for the default strategy,
+    # whatever LIBRARY_LOAD_STRATEGY the suite runs under
+    monkeypatch.setattr(crud, "LOAD_STRATEGY", "selectin")
+
+
+@pytest.fixture
+def count_queries():
+    # Counts the statements every engine runs inside the block. The catalog
+    # cache is cleared first, so a cached response cannot hide the queries.
+    @contextlib.contextmanager
+    def counting():
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        binds = [engine, read_engine] + [bind.sync_engine for bind in (async_engine, async_read_engine) if bind is not None]
+        catalog_cache.clear()
+        for bind in binds:
+            event.listen(bind, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            for bind in binds:
+                event.remove(bind, "before_cursor_execute", before_cursor_execute)
+
+    return counting
@@ -0,0 +1,79 @@
+import sqlite3
+import time
+
+import pytest
+
+from ..cache import Cache, MemoryBackend, SQLiteBackend
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def cache(request, tmp_path):
+    if request.param == "sqlite":
+        return Cache(SQLiteBackend(10, str(tmp_path / "cache.db")), ttl=60)
+    return Cache(MemoryBackend(10), ttl=60)
+
+
+def test_set_after_invalidate_is_skipped(cache):
+    generation = cache.generation("book:1")
+    cache.invalidate("book:1")
+    cache.set("book:1", b"stale", ["book:1"], generation)
+    assert cache.get("book:1") is None
+    assert cache.stats()["stale"] == 1
+
+
+def test_set_after_other_tag_invalidated_is_stored(cache):
+    generation = cache.generation("book:1")
+    cache.invalidate("book:2")
+    cache.set("book:1", b"fresh", ["book:1"], generation)
+    assert cache.get("book:1") == b"fresh"
+
+
+def test_set_without_tags_is_skipped_after_any_invalidate(cache):
+    generation = cache.generation()
+    cache.invalidate("category:3")
+    cache.set("category_name:c", b"stale", ["category:1"], generation)
+    assert cache.get("category_name:c") is None
+
+
+def test_set_after_clear_is_skipped(cache):
+    generation = cache.generation("book:1")
+    cache.clear()
+    cache.set("book:1", b"stale", ["book:1"], generation)
+    assert cache.get("book:1") is None
+
+
+def test_sqlite_backend_rolls_back_a_failed_write(tmp_path):
+    backend = SQLiteBackend(10, str(tmp_path / "cache.db"))
+    with pytest.raises(sqlite3.Error):
+        backend.set("book:1", b"body", 60, [object()])
+    assert not backend.conn.in_transaction
+    assert backend.set("book:1", b"body", 60, ["book:1"])
+    assert backend.get("book:1") == b"body"
+
+
+def test_sqlite_backend_hit_does_not_wait_for_the_write_lock(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = Cache(SQLiteBackend(10, path, touch_batch=1), ttl=60)
+    cache.set("book:1", b"body", ["book:1"])
+    writer = sqlite3.connect(path, isolation_level=None)
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        started = time.monotonic()
+        assert cache.get("book:1") == b"body"
+        assert time.monotonic() - started < 1
+        assert not cache.backend.conn.in_transaction
+    finally:
+        writer.execute("ROLLBACK")
+        writer.close()
+    assert cache.stats()["hits"] == 1
+
+
+def test_sqlite_backend_evicts_by_batched_touches(tmp_path):
+    backend = SQLiteBackend(2, str(tmp_path / "cache.db"), touch_batch=100)
+    backend.set("a", b"a", 60, [])
+    backend.set("b", b"b", 60, [])
+    assert backend.get("a") == b"a"
+    # The touch on "a" is written with the next set, before it evicts
+    backend.set("c", b"c", 60, [])
+    assert backend.get("a") == b"a"
+    assert backend.get("b") is None
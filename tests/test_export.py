@@ -0,0 +1,46 @@
+import csv
+import io
+import json
+import tracemalloc
+
+import pytest
+from sqlalchemy import create_engine
+
+from .. import export, models
+from ..benchmarks.pagination import seed_loans
+
+
+def loans_engine(path, rows: int):
+    engine = create_engine(f"sqlite:///{path}")
+    models.Base.metadata.create_all(bind=engine)
+    seed_loans(engine, rows)
+    return engine
+
+
+def peak_while_streaming(engine, format: str):
+    tracemalloc.start()
+    try:
+        for _ in export.stream_table("loans", format, bind=engine):
+            pass
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize("format", list(export.FORMATS))
+def test_export_memory_stays_flat(tmp_path, format):
+    # Ten times the rows must not mean ten times the memory
+    small = loans_engine(tmp_path / "small.db", 2 * export.EXPORT_CHUNK)
+    large = loans_engine(tmp_path / "large.db", 20 * export.EXPORT_CHUNK)
+    peak_while_streaming(small, format)
+    assert peak_while_streaming(large, format) < 2 * peak_while_streaming(small, format)
+
+
+def test_loans_export_has_every_column(tmp_path):
+    engine = loans_engine(tmp_path / "loans.db", 1)
+    columns = export.TABLES["loans"][1]
+    assert "overdue" in columns
+    line = b"".join(export.stream_table("loans", "ndjson", bind=engine)).splitlines()[0]
+    assert list(json.loads(line)) == columns
+    header = next(csv.reader(io.StringIO(b"".join(export.stream_table("loans", "csv", bind=engine)).decode())))
+    assert header == columns
@@ -0,0 +1,47 @@
+import re
+
+import pytest
+from sqlalchemy import event
+
+from .. import crud, instrumentation
+from ..database import ReadSessionLocal, read_engine
+
+# Every crud filter path and the index its main query must search, checked
+# with EXPLAIN QUERY PLAN on the statement crud actually sends.
+FILTER_PATHS = [
+    (lambda db: crud.get_user_by_email(db, email="user1@example.com"), "ix_users_email"),
+    (lambda db: crud.get_books_by_author(db, author="author 1"), "ix_books_author"),
+    (lambda db: crud.get_books_by_editorial(db, editorial="editorial 1"), "ix_books_editorial"),
+    (lambda db: crud.get_books_by_category(db, category_id=1), "ix_books_category_id"),
+    (lambda db: crud.get_category_by_name(db, name="category 1"), "ix_categories_name"),
+    (lambda db: crud.get_copies_by_book(db, book_id=1), "ix_copies_book_id_available_atention"),
+    (lambda db: crud.get_copies_available_by_book(db, book_id=1), "ix_copies_book_id_available_atention"),
+    (lambda db: crud.get_loans_by_user(db, user_id=1), "ix_loans_user_id"),
+    (lambda db: crud.get_active_loans_by_user(db, user_id=1), "ix_loans_user_id_active"),
+    (lambda db: crud.get_loans_by_copy(db, copy_id=1), "ix_loans_copy_id"),
+    (lambda db: crud.get_loans(db, limit=10), "ix_loans_loan_date"),
+    (lambda db: crud.get_overdue_loans(db, limit=10), "ix_loans_active_return_date"),
+]
+
+
+def query_plans(function):
+    plans = []
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        plans.append(instrumentation.explain(conn, statement, parameters))
+
+    event.listen(read_engine, "after_cursor_execute", after_cursor_execute)
+    db = ReadSessionLocal()
+    try:
+        function(db)
+    finally:
+        db.close()
+        event.remove(read_engine, "after_cursor_execute", after_cursor_execute)
+    return plans
+
+
+@pytest.mark.parametrize("function, index", FILTER_PATHS, ids=[index for _, index in FILTER_PATHS])
+def test_filter_path_uses_index(client, function, index):
+    plans = query_plans(function)
+    assert plans, "no statement was run"
+    assert re.search(rf"USING (COVERING )?INDEX {index}\b", plans[0]), plans[0]
@@ -0,0 +1,47 @@
+import logging
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+from .. import instrumentation
+
+
+@pytest.fixture
+def slow_engine(monkeypatch):
+    # Every statement counts as slow, on an engine of its own
+    monkeypatch.setattr(instrumentation, "SLOW_QUERY_SECONDS", 0)
+    engine = create_engine("sqlite://")
+    instrumentation.instrument_engine(engine)
+    with engine.connect() as conn:
+        conn.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, email TEXT, password TEXT)"))
+        yield conn
+
+
+def warnings(caplog):
+    return [record.getMessage() for record in caplog.records if record.name == "library.sql"]
+
+
+def test_slow_query_log_leaves_out_batches_and_passwords(slow_engine, caplog):
+    rows = [{"email": f"user{i}@example.com", "password": f"hash{i}"} for i in range(200)]
+    with caplog.at_level(logging.WARNING, logger="library.sql"):
+        slow_engine.execute(text("INSERT INTO users (email, password) VALUES (:email, :password)"), rows)
+        slow_engine.execute(text("SELECT id FROM users WHERE password = :password"), {"password": "hash1"})
+    logged = warnings(caplog)
+    assert "parameters=<200 rows>" in logged[0]
+    assert "parameters=<redacted>" in logged[1]
+    assert not any("hash" in message or "user1@" in message for message in logged)
+
+
+def test_slow_query_log_truncates_parameters(slow_engine, caplog):
+    with caplog.at_level(logging.WARNING, logger="library.sql"):
+        slow_engine.execute(text("SELECT id FROM users WHERE email = :email"), {"email": "x" * 10000})
+    message, = warnings(caplog)
+    assert len(message) < 1000
+    assert message.count("x") <= instrumentation.SLOW_QUERY_PARAMETERS_CHARS
+
+
+def test_failed_statement_pops_its_start_time(slow_engine):
+    with pytest.raises(OperationalError):
+        slow_engine.execute(text("SELECT * FROM missing"))
+    assert slow_engine.info["query_started"] == []
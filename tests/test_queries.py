@@ -0,0 +1,58 @@
+import pytest
+
+from .. import crud
+
+# Statements per request, counted through the engine events. The nested
+# schemas are eager-loaded per response (see crud.load_options), so a list
+# route runs the same queries for a page of 2 rows as for a page of 20.
+LIST_ROUTES = {
+    # table versions for the ETag, categories, books, copies
+    "/categories/?limit={limit}": 4,
+    # table versions, books, copies
+    "/books/?limit={limit}": 3,
+    # users, loans
+    "/users/?limit={limit}": 2,
+    "/copies/?limit={limit}": 1,
+    "/loans/?limit={limit}": 1,
+}
+
+READ_ROUTES = {
+    "/categories/1": 3,
+    "/categories/name/category 1": 3,
+    "/books/1": 2,
+    "/books/category/1": 2,
+    "/users/1": 2,
+    "/users/email/user1@example.com": 2,
+    "/copies/1": 1,
+    "/copies/book/1": 1,
+    "/loans/1": 1,
+    "/loans/user/1": 1,
+}
+
+
+@pytest.mark.parametrize("route, expected", LIST_ROUTES.items())
+def test_list_query_count_does_not_grow_with_page_size(client, count_queries, route, expected):
+    for limit in (2, 20):
+        with count_queries() as statements:
+            response = client.get(route.format(limit=limit))
+        assert response.status_code == 200
+        assert len(response.json()) == limit
+        assert len(statements) == expected, statements
+
+
+@pytest.mark.parametrize("route, expected", READ_ROUTES.items())
+def test_read_query_count(client, count_queries, route, expected):
+    with count_queries() as statements:
+        response = client.get(route)
+    assert response.status_code == 200
+    assert len(statements) == expected, statements
+
+
+def test_joined_strategy_folds_relationships_into_the_main_query(client, count_queries, monkeypatch):
+    monkeypatch.setattr(crud, "LOAD_STRATEGY", "joined")
+    with count_queries() as statements:
+        response = client.get("/users/?limit=20")
+    assert response.status_code == 200
+    assert len(response.json()) == 20
+    assert len(statements) == 1, statements
+    assert "JOIN loans" in statements[0]
@@ -0,0 +1,27 @@
+from .. import crud
+
+
+def search_all(client, q: str, limit: int = 5):
+    books, cursor = [], None
+    while True:
+        response = client.get("/books/search", params={"q": q, "limit": limit, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        books += response.json()
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            return books
+
+
+def test_search_pages_through_every_match(client):
+    books = search_all(client, "title")
+    assert len(books) == len({book["id"] for book in books}) == 40
+
+
+def test_search_ranks_at_most_max_matches(client, monkeypatch):
+    monkeypatch.setattr(crud, "SEARCH_MAX_MATCHES", 12)
+    assert len(search_all(client, "title")) == 12
+
+
+def test_short_last_word_is_matched_whole():
+    assert crud.fts_query("title t") == '"title" "t"'
+    assert crud.fts_query("title ti") == '"title" "ti"*'
@@ -0,0 +1,83 @@
+import re
+
+import pytest
+
+from .. import crud, models, schemas
+from ..database import ReadSessionLocal
+
+# Sparse responses: fields= narrows the top-level SELECT to the requested
+# columns plus the paging keys, and expand= drops the nested relationships
+# that are not listed (see crud.parse_shape).
+SHAPED_ROUTES = {
+    "/books/1?fields=title&expand=": ("books", {"title"}),
+    "/books/?fields=title,author&expand=&limit=2": ("books", {"title", "author"}),
+    "/books/batch?ids=1,2&fields=title&expand=": ("books", {"title"}),
+    "/categories/1?fields=name&expand=": ("categories", {"name"}),
+    "/users/batch?ids=1,2&fields=name&expand=": ("users", {"name"}),
+    "/users/1?fields=email&expand=": ("users", {"email"}),
+    "/copies/?fields=id&limit=2": ("copies", {"id"}),
+    "/loans/?fields=id&limit=2": ("loans", {"id"}),
+}
+
+
+def selected_columns(statements, table):
+    # Columns of the first SELECT ... FROM <table>, by name
+    for statement in statements:
+        match = re.match(rf"SELECT (.*?)\s+FROM {table}\b", statement, re.S)
+        if match:
+            return {column.split(" AS ")[0].split(".")[-1].strip() for column in match.group(1).split(",")}
+    raise AssertionError(f"No SELECT from {table} in {statements}")
+
+
+@pytest.mark.parametrize("route, expected", SHAPED_ROUTES.items())
+def test_fields_narrow_select_and_response(client, count_queries, route, expected):
+    table, fields = expected
+    with count_queries() as statements:
+        response = client.get(route)
+    assert response.status_code == 200, response.text
+    body = response.json()
+    rows = body if isinstance(body, list) else [body]
+    assert rows
+    assert all(set(row) == fields for row in rows), rows
+    # The requested columns plus the paging keys, never the whole row
+    columns = selected_columns(statements, table)
+    assert fields <= columns
+    assert columns <= fields | {"id", "loan_date"}, columns
+
+
+def test_expand_loads_only_listed_relationships(client, count_queries):
+    with count_queries() as statements:
+        response = client.get("/categories/2?expand=books")
+    assert response.status_code == 200
+    category = response.json()
+    assert category["books"]
+    assert all("copies" not in book for book in category["books"])
+    assert not any(re.search(r"\bFROM copies\b", statement) for statement in statements)
+
+    with count_queries() as statements:
+        response = client.get("/categories/2?expand=books.copies")
+    assert response.status_code == 200
+    assert all("copies" in book for book in response.json()["books"])
+    assert any(re.search(r"\bFROM copies\b", statement) for statement in statements)
+
+
+def test_unknown_fields_are_rejected(client):
+    assert client.get("/books/1?fields=nope").status_code == 400
+    assert client.get("/categories/1?expand=copies").status_code == 400
+
+
+def test_loader_memo_is_per_shape(count_queries):
+    # A row loaded with narrowed columns must not be reused for the full shape
+    db = ReadSessionLocal()
+    try:
+        narrow = crud.parse_shape(schemas.Book, fields="title", expand="")
+        with count_queries() as statements:
+            crud.get_many(db, models.Book, [1], schemas.Book, narrow)
+            book, = crud.get_many(db, models.Book, [1], schemas.Book)
+            loaded = len(statements)
+            schemas.Book.from_orm(book)
+        assert loaded == 3, statements
+        # Everything the full response needs came with the second load
+        assert len(statements) == loaded, statements
+    finally:
+        db.close()
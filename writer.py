@@ -0,0 +1,181 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from . import crud, schemas
+from .cache import catalog_cache
+from .database import SQLALCHEMY_DATABASE_URL, configure_write_engine
+
+# Optional group commit for LIBRARY_WRITE_MODE=group. The write routes hand
+# their operation to a single writer thread instead of committing on their
+# own. The writer takes everything queued (up to GROUP_COMMIT_BATCH, waiting
+# at most GROUP_COMMIT_WINDOW_MS for more), runs each operation in its own
+# SAVEPOINT so a failing one only rolls back itself, and commits the batch
+# once. Its connection uses synchronous=FULL, so that commit is on disk
+# before any caller gets an answer; nothing acknowledged is lost on a crash,
+# and the fsync is paid once per batch instead of once per request. The
+# writer is per process: with several workers each one batches its own
+# writes and they still share the database lock.
+WRITE_MODE = os.environ.get("LIBRARY_WRITE_MODE", "direct")
+ENABLED = WRITE_MODE == "group"
+GROUP_COMMIT_BATCH = int(os.environ.get("LIBRARY_GROUP_COMMIT_BATCH", "64"))
+GROUP_COMMIT_WINDOW = float(os.environ.get("LIBRARY_GROUP_COMMIT_WINDOW_MS", "0")) / 1000
+GROUP_COMMIT_QUEUE = int(os.environ.get("LIBRARY_GROUP_COMMIT_QUEUE", "1000"))
+
+# Operations take the writer's session and their arguments and return
+# (result, cache tags to invalidate once committed). Results must not need
+# the session after the commit, so ORM rows are turned into schemas here.
+def create_user(db, user: schemas.UserCreate, password_hash: str = None):
+    # Checked here, inside the batch, since the route must not open a write
+    # transaction of its own while it waits for the writer
+    if crud.get_user_by_email(db, email=user.email) is not None:
+        raise ValueError("Email already registered")
+    return schemas.User.from_orm(crud.add_user(db, user, password_hash)), ()
+
+def create_copy(db, copy: schemas.CopyCreate):
+    db_copy, tags = crud.add_copy(db, copy)
+    return schemas.Copy.from_orm(db_copy), tags
+
+def checkout_loan(db, loan: schemas.LoanCreate):
+    return crud.add_loan(db, loan)
+
+def return_loan(db, loan_id: int):
+    return {"message": "Loan deleted"}, crud.remove_loan(db, loan_id)
+
+class GroupCommitWriter:
+    def __init__(self, session_factory, batch_size: int, window: float, queue_size: int):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.window = window
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.operations = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="group-commit-writer", daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        # Everything queued before the stop is still applied
+        with self.lock:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+
+    def submit(self, operation, *args) -> Future:
+        # Raises queue.Full when GROUP_COMMIT_QUEUE writes are already waiting.
+        # A write after a stop starts the thread again rather than waiting on
+        # a queue nobody reads.
+        if self.thread is None:
+            self.start()
+        future = Future()
+        self.queue.put_nowait((operation, args, future))
+        return future
+
+    def apply(self, operation, *args):
+        return self.submit(operation, *args).result()
+
+    async def apply_async(self, operation, *args):
+        return await asyncio.wrap_future(self.submit(operation, *args))
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.batch_size and batch[-1] is not None:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            stopping = batch[-1] is None
+            if stopping:
+                batch.pop()
+            if batch:
+                self.commit(batch)
+            if stopping:
+                return
+
+    def commit(self, batch):
+        outcomes = []
+        db = self.session_factory()
+        try:
+            for operation, args, future in batch:
+                savepoint = db.begin_nested()
+                try:
+                    result, tags = operation(db, *args)
+                    savepoint.commit()
+                    outcomes.append((future, result, None, tags))
+                except Exception as e:
+                    savepoint.rollback()
+                    crud.forget_loader(db)
+                    outcomes.append((future, None, e, ()))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            for future, _, error, _ in outcomes:
+                future.set_exception(error or e)
+            for _, _, future in batch[len(outcomes):]:
+                future.set_exception(e)
+            return
+        finally:
+            db.close()
+        self.batches += 1
+        self.operations += len(batch)
+        catalog_cache.invalidate(*{tag for _, _, _, tags in outcomes for tag in tags})
+        for future, result, error, _ in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stats(self):
+        return {
+            "mode": WRITE_MODE,
+            "queued": self.queue.qsize(),
+            "batches": self.batches,
+            "operations": self.operations,
+            "average_batch": self.operations / self.batches if self.batches else 0,
+        }
+
+def create_writer():
+    writer_engine = create_engine(
+        SQLALCHEMY_DATABASE_URL,
+        connect_args={"check_same_thread": False},
+        poolclass=QueuePool,
+        pool_size=1,
+        max_overflow=0,
+    )
+    configure_write_engine(writer_engine)
+
+    @event.listens_for(writer_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA synchronous=FULL")
+
+    session_factory = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=writer_engine)
+    writer = GroupCommitWriter(session_factory, GROUP_COMMIT_BATCH, GROUP_COMMIT_WINDOW, GROUP_COMMIT_QUEUE)
+    writer.start()
+    return writer
+
+group_writer = create_writer() if ENABLED else None